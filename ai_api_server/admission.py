@@ -0,0 +1,102 @@
+import asyncio
+import math
+from typing import Dict, Optional, Tuple
+import metrics
+from pipeline import Pipeline, PipelineResult
+from config import ADMISSION_EWMA_ALPHA, ADMISSION_MAX_HOLD_SEC, ADMISSION_POLL_SEC, ADMISSION_SLO_SEC, STAGE_LIMITS
+
+
+# @@ Admission ############################
+class AdmissionController:
+    """ Predicts the completion time of a new order and turns it away when it exceeds the SLO.
+
+    From finished orders, EWMAs of the critical path (service time of an order running alone)
+    and of the run time spent per limited resource. The order queues behind the in-flight ones on
+    its busiest resource: wait = max over resources of inflight * work / STAGE_LIMITS[resource].
+    """
+    def __init__(self, slo_sec: float = ADMISSION_SLO_SEC, alpha: float = ADMISSION_EWMA_ALPHA):
+        """
+        Args:
+            slo_sec (float): Longest accepted predicted completion time, 0 admits every order.
+            alpha (float): Weight of the latest order in the moving averages.
+        """
+        self.slo_sec = slo_sec
+        self.alpha = alpha
+        self.inflight = 0
+        self.service_sec: Optional[float] = None
+        self.resource_sec: Dict[str, float] = {}
+
+    def _ewma(self, previous: Optional[float], value: float) -> float:
+        return value if previous is None else self.alpha * value + (1 - self.alpha) * previous
+
+    def observe(self, pipeline: Pipeline, result: PipelineResult):
+        """ Orders resumed from a checkpoint ran partly, they are not representative. """
+        if result.restored:
+            return
+        path: Dict[str, float] = {}
+        work: Dict[str, float] = {}
+        for stage in pipeline.stages:
+            seconds = result.timings.get(stage.name, 0.0)
+            path[stage.name] = seconds + max((path[dep] for dep in stage.deps), default=0.0)
+            if stage.resource:
+                work[stage.resource] = work.get(stage.resource, 0.0) + seconds
+        self.service_sec = self._ewma(self.service_sec, max(path.values(), default=0.0))
+        for resource, seconds in work.items():
+            self.resource_sec[resource] = self._ewma(self.resource_sec.get(resource), seconds)
+
+    def estimate(self) -> Tuple[Optional[float], float]:
+        """
+        Returns:
+            Tuple[Optional[float], float]: Predicted completion time of a new order, None before the first order, and its queue wait.
+        """
+        if self.service_sec is None:
+            return None, 0.0
+        wait = max((self.inflight * seconds / STAGE_LIMITS.get(resource, 1) for resource, seconds in self.resource_sec.items()),
+                   default=0.0)
+        return wait + self.service_sec, wait
+
+    def check(self) -> Tuple[bool, int]:
+        """
+        Returns:
+            Tuple[bool, int]: Whether to start the order now, else seconds until the backlog should be short enough.
+        """
+        predicted, _ = self.estimate()
+        metrics.ADMISSION_PREDICTED_SECONDS.set(predicted or 0)
+        if not self.slo_sec or predicted is None or predicted <= self.slo_sec or self.inflight == 0:
+            return True, 0
+        return False, max(1, math.ceil(predicted - self.slo_sec))
+
+    async def wait_admitted(self, poll_sec: float = ADMISSION_POLL_SEC, max_hold_sec: float = ADMISSION_MAX_HOLD_SEC) -> bool:
+        """ Holds an RMQ delivery unacked, the broker delivers no more than the prefetch meanwhile.
+
+        Returns:
+            bool: False once max_hold_sec passed without admission, 0 waits without a bound.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max_hold_sec
+        while True:
+            admitted, retry_after = self.check()
+            if admitted:
+                return True
+            remaining = deadline - loop.time()
+            if max_hold_sec and remaining <= 0:
+                return False
+            await asyncio.sleep(min(poll_sec, retry_after, remaining) if max_hold_sec else min(poll_sec, retry_after))
+
+    def start(self):
+        """ Call right after "check", without an await in between, once per run that does the work. """
+        self.inflight += 1
+
+    def finish(self):
+        self.inflight -= 1
+
+    def to_dict(self) -> dict:
+        predicted, wait = self.estimate()
+        return {"slo_sec": self.slo_sec, "inflight": self.inflight,
+                "predicted_sec": None if predicted is None else round(predicted, 1),
+                "queue_wait_sec": round(wait, 1),
+                "service_sec": None if self.service_sec is None else round(self.service_sec, 1),
+                "resource_sec": {resource: round(seconds, 1) for resource, seconds in self.resource_sec.items()}}
+
+
+admission_controller = AdmissionController()
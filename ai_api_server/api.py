@@ -1,13 +1,32 @@
+import asyncio
 import os
+import time
 import PIL.Image as Image
 from logger import logger
 from dto import Background, Gender, Hair
-from config import NEG_PROMPT, POS_PROMPT, WEBUI_URL, CONTROLNET_WEIGHTING
+import config
+from config import NEG_PROMPT, POS_PROMPT, CONTROLNET_WEIGHTING, FACEMODEL_TIMEOUT_SEC, T2I_TIMEOUT_SEC
 import utils
-from typing import Any, List, Optional, Union
+import metrics
+import profiling
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
 from pydantic import BaseModel
-WOMAN_BASE_IMG = utils.encodeImg2Base64(Image.open("female_preset.png"))
-MAN_BASE_IMG = utils.encodeImg2Base64(Image.open("male_preset.png"))
+
+PRESET_PATHS = {"female": "female_preset.png", "male": "male_preset.png"}
+_preset_images: Dict[str, str] = {}
+
+
+def get_preset_image(name: str) -> str:
+    """ Base64 ControlNet preset, encoded on first use and cached on disk across restarts. """
+    if name not in _preset_images:
+        _preset_images[name] = utils.encodeFileCached(PRESET_PATHS[name])
+    return _preset_images[name]
+
+
+def load_presets():
+    for name in PRESET_PATHS:
+        get_preset_image(name)
+
 
 class ControlNetArgs(BaseModel):
     image: str
@@ -216,16 +235,25 @@ async def webui_t2i(gender: Gender,
                     hair: Hair,
                     glasses: bool,
                     # reactor_img: str,
-                    )-> tuple[bool, Union[List[Image.Image], str]]:
+                    base_url: Optional[str] = None,
+                    on_image: Optional[Callable[[int, Image.Image], Awaitable[None]]] = None,
+                    )-> tuple[bool, Union[List[bytes], str]]:
+    """
+    Args:
+        on_image (Callable, optional): Awaited with (index, image) as soon as each generated image is decoded.
+
+    Returns:
+        tuple[bool, Union[List[bytes], str]]: The generated images still encoded, as WebUI sent them, so that they checkpoint compactly.
+    """
     result = []
-    t2i_url = WEBUI_URL + "/sdapi/v1/txt2img"
+    t2i_url = (base_url or config.WEBUI_URL) + "/sdapi/v1/txt2img"
     controlnet_params = []
     neg_prompt = ""
     
     if gender == Gender.GIRL:
         prompt = "a korean girl, " + POS_PROMPT 
         neg_prompt = "boy, man," + NEG_PROMPT
-        controlnet_params.append(ControlNetArgs(image=WOMAN_BASE_IMG, weight=0.4, processor_res=512))
+        controlnet_params.append(ControlNetArgs(image=get_preset_image("female"), weight=0.4, processor_res=512))
         if hair == Hair.SHORT:
             prompt = prompt + ", short hair:1.5,"
         elif hair == Hair.LONG:
@@ -233,11 +261,11 @@ async def webui_t2i(gender: Gender,
     elif gender == Gender.MAN:
         prompt = "a korean man, " + POS_PROMPT
         neg_prompt = "girl, woman," + NEG_PROMPT
-        controlnet_params.append(ControlNetArgs(image=MAN_BASE_IMG, weight=0.4, processor_res=512))
+        controlnet_params.append(ControlNetArgs(image=get_preset_image("male"), weight=0.4, processor_res=512))
     elif gender == Gender.BOY:
         prompt = "a korean boy, " + POS_PROMPT
         neg_prompt = "girl, woman," + NEG_PROMPT
-        controlnet_params.append(ControlNetArgs(image=MAN_BASE_IMG, weight=0.4, processor_res=512))
+        controlnet_params.append(ControlNetArgs(image=get_preset_image("male"), weight=0.4, processor_res=512))
     else:
         return (False, "Invalid_Gender")
     controlnet_params += [ ControlNetArgs(image=img, 
@@ -272,24 +300,40 @@ async def webui_t2i(gender: Gender,
                             seed=seed,
                             sampler_name="Restart",
                             )
-    succ, response = await utils.requestPostAsync(t2i_url, t2i_payload.dict())
-    if succ: 
+
+    async def collect(idx: int, img_bytes: bytes):
+        # Decoded off the loop before it is shared with the merge thread and the stage result
+        img = await asyncio.to_thread(utils.decodeImgBytes, img_bytes)
         if os.environ.get('ENV') == 'dev':
-            [utils.decodeBase642Img(img_str).save(f"res_{idx}.png") for idx, img_str in enumerate(response["images"])]
-        result = [utils.decodeBase642Img(img_str) for img_str in response["images"]]
-    else: 
+            img.save(f"res_{idx}.png")
+        result.append(img_bytes)
+        if on_image is not None:
+            await on_image(idx, img)
+
+    # Images are decoded one by one while the response streams in
+    start = time.perf_counter()
+    succ, response = await utils.requestPostAsyncStream(t2i_url, t2i_payload.dict(), on_item=collect, timeout=T2I_TIMEOUT_SEC,
+                                                         expected=batch_size)
+    metrics.observe_webui(base_url or config.WEBUI_URL, "txt2img", time.perf_counter() - start, succ)
+    profiling.record_event("webui:txt2img", background=background.value, ip_images=len(ip_imgs),
+                           ip_bytes=sum(len(img) for img in ip_imgs), images=len(result), succ=succ)
+    if not succ: 
         logger.error(f"Error-detail:{response}")
-        return (False, "RequestFail")
+        # The detail itself, so that the caller can tell a failing backend from a rejected request
+        return (False, response)
     return succ, result
 
-async def build_face_model(img_list: List[Image.Image], model_name: str):
-    model_url = WEBUI_URL + "/reactor/facemodels"
-    img_str_list = [utils.encodeImg2Base64(img) for img in img_list]
+async def build_face_model(img_list: List[Image.Image], model_name: str, base_url: Optional[str] = None):
+    model_url = (base_url or config.WEBUI_URL) + "/reactor/facemodels"
+    # Hashing and PNG encoding would block the event loop
+    img_str_list = await asyncio.gather(*[asyncio.to_thread(utils.encodeImgCached, img) for img in img_list])
     payload = {
         "source_images": img_str_list,
         "name": model_name,
         "compute_method": 0,
         "shape_check": False
     }
-    succ, response = await utils.requestPostAsync(model_url, payload)
+    start = time.perf_counter()
+    succ, response = await utils.requestPostAsync(model_url, payload, timeout=FACEMODEL_TIMEOUT_SEC)
+    metrics.observe_webui(base_url or config.WEBUI_URL, "facemodels", time.perf_counter() - start, succ)
     return succ, response
@@ -1,19 +1,21 @@
+import asyncio
 import os
 import requests
 import uvicorn
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, Response
 from datetime import datetime
-import face_preprocess
-from api import build_face_model, webui_t2i
 from logger import logger
 import setup
+from admission import admission_controller
 import utils
-import cloud_utils
-from dto import Background, BaseResponse, ProcessRequestParam, ProcessData, ProcessResponse, StatusData, StatusResponse, UpdateUrlParam
-from config import BUCKET_PREFIX, WEBUI_URL
+import metrics
+import profiling
+from webui_pool import webui_pool
+from workflow import run_profile_pipeline
+from dto import BaseResponse, ProcessRequestParam, ProcessData, ProcessResponse, ProfileParam, StatusData, StatusResponse, UpdateUrlParam
+from config import CONFIG_KEY, WEBUI_URL
 import config as config
-import traceback
 
 app = FastAPI(
     title="AI-Profile-Diffusion-Server",
@@ -28,105 +30,133 @@ app = FastAPI(
 # @@ APIHandler ############################
 @app.get("/api/health", tags=["API"])
 def healthCheck()-> BaseResponse:
+    if not setup.startup_state.ready:
+        return JSONResponse(
+                status_code=503,
+                content=BaseResponse(message="ai-api-server failed to start" if setup.startup_state.error else "ai-api-server is starting",
+                                     data=setup.startup_state.to_dict()).dict())
     return JSONResponse(
             status_code=200,
             content=StatusResponse(message="ai-api-server is running", 
                                 data=StatusData(webui_status=True,
-                                                webui_url = WEBUI_URL, 
+                                                webui_url = ",".join(backend.url for backend in webui_pool.backends),
                                                 time = datetime.now().strftime("%Y%m%d-%H:%M:%S")).dict()
                                 ).dict())
 
 @app.get("/api/status", tags=["API"])
 async def checkStatus():
-    webui_status = await utils.checkSuccessGetAsync(f"{WEBUI_URL}/user")
+    statuses = await asyncio.gather(*[utils.checkSuccessGetAsync(f"{backend.url}/user") for backend in webui_pool.backends])
+    webui_status = any(statuses)
+    webui_urls = ",".join(backend.url for backend in webui_pool.backends)
     if webui_status:
         return JSONResponse(
                 status_code=200,
                 content=StatusResponse(message="ai-api-server is connected to webui", 
                                         data=StatusData(webui_status=True,
-                                                        webui_url = WEBUI_URL,
-                                                        time = datetime.now().strftime("%Y%m%d-%H:%M:%S")).dict()
+                                                        webui_url = webui_urls,
+                                                        time = datetime.now().strftime("%Y%m%d-%H:%M:%S"),
+                                                        admission=admission_controller.to_dict()).dict()
                 ).dict())
     else:
         return JSONResponse(
                 status_code=200,
                 content=StatusResponse(message="ai-api-server is NOT connected to webui", 
                                         data=StatusData(webui_status=False,
-                                                        webui_url = WEBUI_URL,
-                                                        time = datetime.now().strftime("%Y%m%d-%H:%M:%S"))
+                                                        webui_url = webui_urls,
+                                                        time = datetime.now().strftime("%Y%m%d-%H:%M:%S"),
+                                                        admission=admission_controller.to_dict())
                 ).dict())
 
 @app.post("/api/process", tags=["API"])
 async def process(req_payload: ProcessRequestParam):
+    if not setup.startup_state.ready:
+        return JSONResponse(status_code=503, content={"error": "Starting"}, headers={"Retry-After": "10"})
+    # Fail fast instead of holding the connection for an order that would miss the SLO
+    admitted, retry_after = admission_controller.check()
+    if not admitted:
+        metrics.ADMISSION_DEFERRED.labels("api").inc()
+        return JSONResponse(status_code=429, content={"error": "Overloaded", "detail": admission_controller.to_dict()},
+                            headers={"Retry-After": str(retry_after)})
     try:
         req_id = req_payload.id
         # TODO: override webui params
-        succ, src_imgs = cloud_utils.download_image_from_gcs(req_payload.imagePaths)
-        if not succ:
-            logger.error(f"Error::id:{req_id}::detail:DownloadFail")
-            raise Exception("DownloadFail")
-
-        result = []
-        for bg in Background:
-
-            processed_images =  face_preprocess.preprocess_image(images=src_imgs, 
-                                                bg=bg,
-                                                face_detector=face_preprocess.face_detector, 
-                                                head_segmenter=face_preprocess.head_segmenter)
-
-            # For first iteration
-            if bg == Background.CRIMSON:
-                succ, response = await build_face_model(img_list=processed_images, model_name=req_id)
-                if not succ:
-                    raise Exception(f"RequestBuildFaceFail:{response}")
-
-            sampled_img_str_list = utils.sample_imgs([utils.encodeImg2Base64(img) for img in processed_images])
-            succ, t2i_result = await webui_t2i(gender=req_payload.param.gender, 
-                                        background=bg, 
-                                        batch_size=2 if bg == Background.IVORY else 3,
-                                        model_name=req_id,
-                                        ip_imgs=sampled_img_str_list, 
-                                        hair=req_payload.param.hair,
-                                        glasses=req_payload.param.glasses,
-                                        # reactor_img=utils.sample_one_img(sampled_img_str_list)
-                                        )
-            if not succ:
-                logger.error(f"Error::id:{req_id}::detail:{t2i_result}")
-                raise Exception(f"{t2i_result}")
-            result += utils.merge_frame(t2i_result, bg)
-
-        # TODO: postprocess image
-        #   X Image Merge
-        img_names = [f"{req_id}/{i}.png" for i in range(1,len(result)+1)]
-        cloud_utils.upload_image_to_gcs(result, img_names)
-
-        FORMAT_DATE = datetime.now().strftime("%Y-%m-%d")
+        # Counted in flight from here, without an await since "check"
+        pipeline_result = await run_profile_pipeline(req_payload)
+        metrics.count_order("api")
+
         return JSONResponse(
                 status_code=200,
                 content=ProcessResponse(message=f"Success created for ID:{req_id}", 
                                         data=ProcessData(id=req_id, 
-                                                         image_paths=[f"{BUCKET_PREFIX}/{FORMAT_DATE}/{img_name}" for img_name in img_names]).dict()
+                                                         image_paths=pipeline_result.results["upload"]).dict()
                 ).dict())
     except Exception as e:
-        logger.error(f"Error::id:{req_id}::detail:{e} :: : {traceback.format_exc()}")
+        metrics.count_order("api", e)
+        logger.error(f"Error::id:{req_id}::detail:{e}", exc_info=True)
         return JSONResponse(status_code=500, content={"error":str(e)})
     except:
-        if os.getenv("ENV") == "prod":
-            requests.post("https://ntfy.sh/horangstudio-engine",
+        if os.getenv("ENV") == "prod" and config.NOTIFY_URL:
+            requests.post(config.NOTIFY_URL,
                 data=f"ProcessError id: {req_id} 🔥\ndetail: swap-face".encode(encoding='utf-8'))
         return JSONResponse(status_code=500, content={"error":"UnknownError"})
 
+@app.get("/metrics", tags=["API"], include_in_schema=False)
+def get_metrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE_LATEST)
+
+def verify_key(k: str):
+    if not CONFIG_KEY or k != CONFIG_KEY:
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+@app.post("/api/profile", tags=["Config"])
+async def arm_profiler(item: ProfileParam):
+    verify_key(item.k)
+    profiling.profile_arm.arm(requests=item.requests, seconds=item.seconds)
+    return {"message": "Profiler armed", "detail": profiling.profile_arm.to_dict()}
+
+@app.delete("/api/profile", tags=["Config"])
+async def disarm_profiler(k: str):
+    verify_key(k)
+    profiling.profile_arm.disarm()
+    return {"message": "Profiler disarmed", "detail": profiling.profile_arm.to_dict()}
+
+@app.get("/api/profile", tags=["Config"])
+async def get_profiler(k: str):
+    verify_key(k)
+    return {"message": "Profiler", "detail": profiling.profile_arm.to_dict()}
+
+@app.get("/api/profile/{req_id}", tags=["Config"])
+async def get_profile(req_id: str, k: str, fmt: str = "speedscope"):
+    verify_key(k)
+    rendered = await asyncio.to_thread(profiling.render_profile, req_id, fmt)
+    if rendered is None:
+        raise HTTPException(status_code=404, detail=f"No profile for {req_id}")
+    if fmt == "html":
+        return Response(content=rendered, media_type="text/html")
+    return Response(content=rendered, media_type="application/json",
+                    headers={"Content-Disposition": f'attachment; filename="{req_id}.speedscope.json"'})
+
+@app.get("/api/timeline/{req_id}", tags=["Config"])
+async def get_timeline(req_id: str, k: str):
+    verify_key(k)
+    timeline = profiling.get_timeline(req_id)
+    if timeline is None:
+        raise HTTPException(status_code=404, detail=f"No timeline for {req_id}")
+    return timeline
+
 @app.patch("/api/url", tags=["Config"])
 async def update_url(item: UpdateUrlParam):
     global WEBUI_URL
     new_url = item.url
     config.WEBUI_URL = new_url
     WEBUI_URL = new_url
+    webui_pool.set_urls([new_url])
     return {"message": "WEBUI_URL updated successfully", "detail":{"1": config.WEBUI_URL, "2": WEBUI_URL}}
 
 @app.get("/api/url", tags=["Config"])
 async def get_url():
-    return {"message": "WEBUI_URL", "detail": {"1": config.WEBUI_URL, "2": WEBUI_URL}}
+    return {"message": "WEBUI_URL", "detail": {"1": config.WEBUI_URL, "2": WEBUI_URL},
+            "backends": [backend.to_dict() for backend in webui_pool.backends]}
 
 # @@ Run ############################
 
@@ -0,0 +1,98 @@
+import asyncio
+from typing import Any, Callable, List, Optional
+import metrics
+from config import MICROBATCH_MAX_SIZE, MICROBATCH_MAX_WAIT_SEC
+
+
+# @@ Micro-batching ############################
+class BatchRequest:
+    def __init__(self, items: List[Any], future: asyncio.Future):
+        self.items = items
+        self.future = future
+
+
+class MicroBatcher:
+    """ Runs the items of concurrent callers as one batch, through a blocking fn in a thread.
+
+    A batch closes at max_size items or max_wait_sec after its first request, whichever comes
+    first. A single request larger than max_size runs alone, fn does its own chunking.
+    """
+    def __init__(self, name: str, fn: Callable[[List[Any]], List[Any]],
+                 max_size: int = MICROBATCH_MAX_SIZE, max_wait_sec: float = MICROBATCH_MAX_WAIT_SEC):
+        """
+        Args:
+            name (str): Label of the batch size metric, e.g. "detect".
+            fn (Callable): Maps a list of items to a list of results of the same length and order.
+        """
+        self.name = name
+        self.fn = fn
+        self.max_size = max_size
+        self.max_wait_sec = max_wait_sec
+        self._queue: Optional[asyncio.Queue] = None
+        self._carry: Optional[BatchRequest] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def submit(self, items: List[Any]) -> List[Any]:
+        if not items:
+            return []
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._carry = None
+            self._task = asyncio.create_task(self._run_batches(), name=f"microbatch:{self.name}")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(BatchRequest(list(items), future))
+        return await future
+
+    async def _collect(self) -> List[BatchRequest]:
+        loop = asyncio.get_running_loop()
+        first, self._carry = self._carry or await self._queue.get(), None
+        batch, size = [first], len(first.items)
+        deadline = loop.time() + self.max_wait_sec
+        while size < self.max_size:
+            try:
+                request = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if size + len(request.items) > self.max_size:
+                self._carry = request
+                break
+            batch.append(request)
+            size += len(request.items)
+        # Callers cancelled while queued are dropped
+        return [request for request in batch if not request.future.done()]
+
+    async def _run_batches(self):
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            # source_idx: the request each item came from
+            items, source_idx = [], []
+            for i, request in enumerate(batch):
+                items += request.items
+                source_idx += [i] * len(request.items)
+            metrics.BATCH_SIZE.labels(self.name).observe(len(items))
+            try:
+                results = await asyncio.to_thread(self.fn, items)
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            routed: List[List[Any]] = [[] for _ in batch]
+            for i, result in zip(source_idx, results):
+                routed[i].append(result)
+            for request, request_results in zip(batch, routed):
+                if not request.future.done():
+                    request.future.set_result(request_results)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,83 @@
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import time
+from typing import Any, List, Tuple
+from logger import logger
+from config import CHECKPOINT_DIR, CHECKPOINT_TTL_SEC
+
+
+# @@ Checkpoint ############################
+class CheckpointStore:
+    """ Disk-backed stage results, "{root}/{req_id}/{stage}.pkl", kept for ttl_sec. """
+    def __init__(self, root: str = CHECKPOINT_DIR, ttl_sec: float = CHECKPOINT_TTL_SEC):
+        self.root = root
+        self.ttl_sec = ttl_sec
+        self._last_sweep = 0.0
+
+    @staticmethod
+    def _safe(name: str) -> str:
+        return re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+
+    def _path(self, req_id: str, stage: str) -> str:
+        return os.path.join(self.root, self._safe(req_id), self._safe(stage) + ".pkl")
+
+    def has(self, req_id: str, stage: str) -> bool:
+        return os.path.exists(self._path(req_id, stage))
+
+    def load(self, req_id: str, stage: str) -> Tuple[bool, Any]:
+        try:
+            with open(self._path(req_id, stage), "rb") as f:
+                return True, pickle.load(f)
+        except FileNotFoundError:
+            return False, None
+        except Exception as e:
+            # Unreadable, the stage just runs again
+            logger.error(f"Error-checkpoint:load:{req_id}:{stage}::detail:{e}")
+            return False, None
+
+    def save(self, req_id: str, stage: str, value: Any):
+        path = self._path(req_id, stage)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Atomic, a crash never leaves a truncated checkpoint behind. The temporary name is
+        # unique, concurrent runs of the same order never write into each other's file
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+            try:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+        os.replace(f.name, path)
+
+    def prune(self, req_id: str, keep: List[str]):
+        """ Drop every stage of req_id except keep. """
+        req_dir = os.path.join(self.root, self._safe(req_id))
+        keep_files = {self._safe(stage) + ".pkl" for stage in keep}
+        if not os.path.isdir(req_dir):
+            return
+        for file_name in os.listdir(req_dir):
+            if file_name not in keep_files:
+                os.remove(os.path.join(req_dir, file_name))
+
+    def sweep(self):
+        """ Remove requests older than ttl_sec. """
+        self._last_sweep = time.time()
+        if not os.path.isdir(self.root):
+            return
+        deadline = self._last_sweep - self.ttl_sec
+        for req_dir in os.listdir(self.root):
+            path = os.path.join(self.root, req_dir)
+            try:
+                if os.path.getmtime(path) < deadline:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+    def sweep_due(self) -> bool:
+        return time.time() - self._last_sweep > self.ttl_sec / 4
+
+
+checkpoint_store = CheckpointStore() if CHECKPOINT_DIR else None
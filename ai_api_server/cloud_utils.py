@@ -1,90 +1,181 @@
+import asyncio
 import datetime
+import json
 import os
 import io
-from typing import List
+import threading
+from typing import Any, Dict, List
 from PIL import Image
 from logger import logger
-from config import BUCKET_PREFIX, BUCKET_NAME, FORMAT_DATE, GCP_CREDENTIAL, GCS_URL_PREFIX
-from google.cloud import storage
-import firebase_admin
-from firebase_admin import credentials, firestore_async
+from config import BUCKET_PREFIX, BUCKET_NAME, FACE_MODEL_PATH, FORMAT_DATE, GCP_CREDENTIAL, GCS_URL_PREFIX, LOCAL_STORAGE_DIR, STORAGE_BACKEND, TRANSFER_WORKERS, UPLOAD_BUCKET_NAME
 
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = GCP_CREDENTIAL
-app = firebase_admin.initialize_app(credentials.Certificate(GCP_CREDENTIAL))
-db_client = firestore_async.client()
 
-def upload_image_to_gcs(images: List[Image.Image], dest_file_names: List[str]) -> bool:
-    """ Upload to GCS
+# @@ Document store ############################
+class LocalDocument:
+    def __init__(self, path: str):
+        self.path = path
+
+    async def set(self, data: Dict[str, Any]):
+        def write():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "w") as f:
+                json.dump(data, f, default=str, ensure_ascii=False)
+        await asyncio.to_thread(write)
+
+
+class LocalCollection:
+    def __init__(self, path: str):
+        self.path = path
+
+    def document(self, document_id: str) -> LocalDocument:
+        return LocalDocument(os.path.join(self.path, f"{document_id}.json"))
+
+
+class LocalFirestore:
+    """ Filesystem stand-in for the Firestore client, "{root}/{collection}/{document}.json", for tests and benchmarks. """
+    def __init__(self, root: str):
+        self.root = root
+
+    def collection(self, name: str) -> LocalCollection:
+        return LocalCollection(os.path.join(self.root, name))
+
+
+_db_client = None
+_db_client_lock = threading.Lock()
+
+
+def get_db_client():
+    """ Firestore client, Firebase is initialized on the first call. """
+    global _db_client
+    if _db_client is None:
+        with _db_client_lock:
+            if _db_client is None:
+                if STORAGE_BACKEND == "local":
+                    _db_client = LocalFirestore(os.path.join(LOCAL_STORAGE_DIR, "firestore"))
+                else:
+                    import firebase_admin
+                    from firebase_admin import credentials, firestore_async
+                    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = GCP_CREDENTIAL
+                    firebase_admin.initialize_app(credentials.Certificate(GCP_CREDENTIAL))
+                    _db_client = firestore_async.client()
+    return _db_client
+
+# @@ Storage backends ############################
+class GCSStorage:
+    """ One storage.Client reused for every transfer. """
+    def __init__(self):
+        self._client = None
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, bucket_name: str) -> "storage.Bucket":
+        # Called from the transfer threads, the client must be created only once
+        bucket = self._buckets.get(bucket_name)
+        if bucket is None:
+            with self._lock:
+                if self._client is None:
+                    from google.cloud import storage
+                    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = GCP_CREDENTIAL
+                    self._client = storage.Client()
+                bucket = self._buckets.get(bucket_name)
+                if bucket is None:
+                    bucket = self._buckets[bucket_name] = self._client.bucket(bucket_name)
+        return bucket
+
+    def read_bytes(self, bucket_name: str, path: str) -> bytes:
+        return self.bucket(bucket_name).blob(path).download_as_bytes()
+
+    def write_bytes(self, bucket_name: str, path: str, data: bytes, content_type: str):
+        self.bucket(bucket_name).blob(path).upload_from_string(data, content_type=content_type)
+
+
+class LocalStorage:
+    """ Filesystem stand-in for GCS, "{root}/{bucket_name}/{path}", for tests and benchmarks. """
+    def __init__(self, root: str):
+        self.root = root
+
+    def read_bytes(self, bucket_name: str, path: str) -> bytes:
+        with open(os.path.join(self.root, bucket_name, path), "rb") as f:
+            return f.read()
+
+    def write_bytes(self, bucket_name: str, path: str, data: bytes, content_type: str):
+        file_path = os.path.join(self.root, bucket_name, path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as f:
+            f.write(data)
+
+
+storage_backend = LocalStorage(LOCAL_STORAGE_DIR) if STORAGE_BACKEND == "local" else GCSStorage()
+_transfer_semaphore: asyncio.Semaphore = None
+
+
+def _get_transfer_semaphore() -> asyncio.Semaphore:
+    global _transfer_semaphore
+    if _transfer_semaphore is None:
+        _transfer_semaphore = asyncio.Semaphore(TRANSFER_WORKERS)
+    return _transfer_semaphore
+
+
+def _encode_png(image: Image.Image) -> bytes:
+    image_bytes = io.BytesIO()
+    image.save(image_bytes, format="PNG")
+    return image_bytes.getvalue()
+
+
+# @@ Transfer ############################
+async def upload_images(images: List[Image.Image], dest_file_names: List[str]) -> bool:
+    """ Concurrent upload, at most TRANSFER_WORKERS in flight.
 
     Args:
         images (List[Image.Image]): PIL.Image
         dest_file_names (List[str]): dir_name WITHOUT date i.e. "my_dir/1.png"
 
     Returns:
-        bool: _description_
+        bool: True if every image was uploaded.
     """
+    FORMAT_DATE = datetime.date.today().strftime("%Y-%m-%d")
+
+    def transfer(image: Image.Image, dest_file_name: str):
+        # PNG encoding also runs in the worker thread
+        storage_backend.write_bytes(UPLOAD_BUCKET_NAME, f"{BUCKET_PREFIX}/{FORMAT_DATE}/{dest_file_name}",
+                                    _encode_png(image), content_type="image/png")
+
+    async def upload(image: Image.Image, dest_file_name: str):
+        async with _get_transfer_semaphore():
+            await asyncio.to_thread(transfer, image, dest_file_name)
+
     try:
-        storage_client = storage.Client()
-        # bucket = storage_client.bucket(BUCKET_NAME)
-        bucket = storage_client.bucket("2024-profile")
-        FORMAT_DATE = datetime.date.today().strftime("%Y-%m-%d")
-        for image, dest_file_name in zip(images, dest_file_names):
-            # Convert the PIL Image to bytes
-            blob = bucket.blob(f"{BUCKET_PREFIX}/{FORMAT_DATE}/{dest_file_name}")
-            image_bytes = io.BytesIO()
-            image.save(image_bytes, format="PNG")
-            image_bytes.seek(0)
-
-            # Upload the bytes to GCS
-            blob.upload_from_file(image_bytes, content_type="image/png")
+        await asyncio.gather(*[upload(image, name) for image, name in zip(images, dest_file_names)])
         return True
     except Exception as e:
         logger.error(f"Error-upload_gcs:{BUCKET_PREFIX}/{FORMAT_DATE}/{dest_file_names}::detail:{e}")
         return False
 
 
+async def download_bytes(source_img_paths: List[str]) -> tuple[bool, List[bytes]| None]:
+    """ Concurrent download of the raw blobs, at most TRANSFER_WORKERS in flight.
 
-def download_image_from_gcs(source_img_paths: List[str]) -> tuple[bool, List[Image.Image]| None]:
-    """ Download from GCS
-    
     Args:
         source_img_paths (List[str]): Bucket dir path, WITHOUT bucketname, e.g. "my_dir/1.png"
 
     Returns:
-        tuple[bool, List[Image.Image]| None]: _description_
+        tuple[bool, List[bytes]| None]: Encoded images in the order of source_img_paths.
     """
+    async def download(source_img_path: str) -> bytes:
+        async with _get_transfer_semaphore():
+            return await asyncio.to_thread(storage_backend.read_bytes, BUCKET_NAME, source_img_path)
+
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(BUCKET_NAME)
-        result = []
-        for source_img_path in source_img_paths:
-            # Get the blob
-            blob = bucket.blob(source_img_path)
-
-            # Download the blob as bytes
-            image_bytes = blob.download_as_bytes()
-            img = Image.open(io.BytesIO(image_bytes))
-            
-            # Create a PIL Image from the downloaded bytes
-            result.append(img)
-            
-        return True, result
+        result = await asyncio.gather(*[download(path) for path in source_img_paths])
+        return True, list(result)
     except Exception as e:
         logger.error(f"Error-download_gcs:{source_img_paths}::detail:{e}")
         return False, None
 
 
 def download_face_model():
-    if os.path.exists("yolov8n-face.onnx"):
+    if os.path.exists(FACE_MODEL_PATH):
         return
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob("models/yolov8n-face.onnx")
-
-    model_bytes = blob.download_as_bytes()
+    model_bytes = storage_backend.read_bytes(BUCKET_NAME, "models/yolov8n-face.onnx")
     
-    open("yolov8n-face.onnx", "wb").write(model_bytes)
-
-
-
-
+    open(FACE_MODEL_PATH, "wb").write(model_bytes)
@@ -14,15 +14,45 @@ FORMAT_DATE = current_date.strftime("%Y-%m-%d")
 
 # @@ Config ############################
 WEBUI_URL = os.environ.get('WEBUI_URL')
+WEBUI_URLS = [url.strip() for url in os.environ.get('WEBUI_URLS', WEBUI_URL or '').split(',') if url.strip()]
+WEBUI_PROBE_INTERVAL_SEC = float(os.environ.get('WEBUI_PROBE_INTERVAL_SEC', '10'))
+WEBUI_EJECT_FAILURES = int(os.environ.get('WEBUI_EJECT_FAILURES', '3'))
 API_BASE_URL = os.environ.get('API_BASE_URL')
 TIMEOUT_SEC = 240
+T2I_TIMEOUT_SEC = float(os.environ.get('T2I_TIMEOUT_SEC', TIMEOUT_SEC))
+FACEMODEL_TIMEOUT_SEC = float(os.environ.get('FACEMODEL_TIMEOUT_SEC', '120'))
+STATUS_TIMEOUT_SEC = float(os.environ.get('STATUS_TIMEOUT_SEC', '5'))
+NOTIFY_TIMEOUT_SEC = float(os.environ.get('NOTIFY_TIMEOUT_SEC', '10'))
+HTTP_MAX_CONNECTIONS = int(os.environ.get('HTTP_MAX_CONNECTIONS', '20'))
+HTTP_MAX_KEEPALIVE = int(os.environ.get('HTTP_MAX_KEEPALIVE', '10'))
+HTTP_KEEPALIVE_SEC = float(os.environ.get('HTTP_KEEPALIVE_SEC', '60'))
+FACE_MODEL_CACHE_SIZE = int(os.environ.get('FACE_MODEL_CACHE_SIZE', '50'))    # per WebUI backend
+REACTOR_FACEMODEL_DIR = os.environ.get('REACTOR_FACEMODEL_DIR')    # mounted models/reactor/faces, only with a single WebUI backend
+# "url=dir,url=dir", the mounted models/reactor/faces of each WebUI backend. Evicted models are only deleted on these
+REACTOR_FACEMODEL_DIRS = {url.strip().rstrip('/'): path.strip() for url, _, path in
+                          (pair.partition('=') for pair in os.environ.get('REACTOR_FACEMODEL_DIRS', '').split(',')) if path.strip()}
+if REACTOR_FACEMODEL_DIR and len(WEBUI_URLS) == 1:
+    REACTOR_FACEMODEL_DIRS.setdefault(WEBUI_URLS[0].rstrip('/'), REACTOR_FACEMODEL_DIR)
+WEBUI_UDS = os.environ.get('WEBUI_UDS')    # only with a single co-located WebUI
 LOG_PATH = os.environ.get('LOG_PATH')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')    # json | text
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', str(50 * 1024 * 1024)))    # per file before rotation
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', '5'))
+LOG_MAX_FIELD_CHARS = int(os.environ.get('LOG_MAX_FIELD_CHARS', '4000'))    # longer messages & fields are truncated, 0: no cap
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))    # records beyond are dropped
+LOG_SAMPLE_BURST = int(os.environ.get('LOG_SAMPLE_BURST', '50'))    # records per call site and window, 0: no sampling
+LOG_SAMPLE_WINDOW_SEC = float(os.environ.get('LOG_SAMPLE_WINDOW_SEC', '10'))
 PRESET_DIR = os.environ.get('PRESET_DIR')
 BUCKET_PREFIX = os.environ.get('BUCKET_PREFIX')
 BUCKET_NAME = os.environ.get('BUCKET_NAME')
 GCP_CREDENTIAL = os.environ.get('GCP_CREDENTIAL')
 GCS_URL_PREFIX="https://storage.cloud.google.com"
+UPLOAD_BUCKET_NAME = os.environ.get('UPLOAD_BUCKET_NAME', '2024-profile')
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'gcs')    # gcs | local, local covers Firestore as well
+LOCAL_STORAGE_DIR = os.environ.get('LOCAL_STORAGE_DIR', 'local_storage')
+TRANSFER_WORKERS = int(os.environ.get('TRANSFER_WORKERS', '8'))
 CONFIG_KEY = os.environ.get('CONFIG_KEY')
+NOTIFY_URL = os.environ.get('NOTIFY_URL', 'https://ntfy.sh/horangstudio-engine')    # empty: no alerts
 ROUND_MASK_PATH = os.environ.get('ROUND_MASK_PATH')
 MASK_PATH = os.environ.get('MASK_PATH')
 FRAME_PATH = "frames"
@@ -35,9 +65,48 @@ RMQ_PORT = int(os.environ.get('RMQ_PORT'))
 RMQ_QUEUE = os.environ.get('RMQ_QUEUE')
 RMQ_USER = os.environ.get('RMQ_USER')
 RMQ_PWD = os.environ.get('RMQ_PWD')
+CHECKPOINT_DIR = os.environ.get('CHECKPOINT_DIR', 'checkpoints')    # empty: disabled
+CHECKPOINT_TTL_SEC = float(os.environ.get('CHECKPOINT_TTL_SEC', str(6 * 60 * 60)))
+CHECKPOINT_DOWNLOAD = bool(int(os.environ.get('CHECKPOINT_DOWNLOAD', '0')))    # 1: also persist the downloaded photos, the expensive stages always are
+RMQ_PREFETCH = int(os.environ.get('RMQ_PREFETCH', '4'))
+ADMISSION_SLO_SEC = float(os.environ.get('ADMISSION_SLO_SEC', '600'))    # 0: admit every order
+ADMISSION_EWMA_ALPHA = float(os.environ.get('ADMISSION_EWMA_ALPHA', '0.2'))
+ADMISSION_POLL_SEC = float(os.environ.get('ADMISSION_POLL_SEC', '5'))    # re-check interval of a held RMQ message
+ADMISSION_MAX_HOLD_SEC = float(os.environ.get('ADMISSION_MAX_HOLD_SEC', '300'))    # then the held RMQ message is requeued
+# Concurrent stage runs across all in-flight orders
+STAGE_LIMITS = {
+    "download": int(os.environ.get('STAGE_LIMIT_DOWNLOAD', '4')),
+    "preprocess": int(os.environ.get('STAGE_LIMIT_PREPROCESS', '2')),
+    "webui": int(os.environ.get('STAGE_LIMIT_WEBUI', str(max(1, len(WEBUI_URLS))))),
+    "upload": int(os.environ.get('STAGE_LIMIT_UPLOAD', '4')),
+}
 POS_PROMPT = os.environ.get('POS_PROMPT')
 NEG_PROMPT = os.environ.get('NEG_PROMPT')
 CONTROLNET_WEIGHTING = json.loads(os.environ.get('CONTROLNET_WEIGHTING'))
+IMG_WIRE_FORMAT = os.environ.get('IMG_WIRE_FORMAT', 'png')    # png | webp | jpeg, for WebUI payloads
+IMG_PNG_COMPRESS_LEVEL = int(os.environ.get('IMG_PNG_COMPRESS_LEVEL', '6'))
+IMG_JPEG_QUALITY = int(os.environ.get('IMG_JPEG_QUALITY', '95'))
+ENCODE_CACHE_SIZE = int(os.environ.get('ENCODE_CACHE_SIZE', '64'))
+ASSET_CACHE_DIR = os.environ.get('ASSET_CACHE_DIR', '.cache/assets')    # empty: no disk cache
+SEG_BATCH_SIZE = int(os.environ.get('SEG_BATCH_SIZE', '8'))
+CLEANUP_MAX_SIDE = int(os.environ.get('CLEANUP_MAX_SIDE', '256'))
+MICROBATCH_MAX_SIZE = int(os.environ.get('MICROBATCH_MAX_SIZE', '16'))    # images per cross-order model batch, 0: per order
+MICROBATCH_MAX_WAIT_SEC = float(os.environ.get('MICROBATCH_MAX_WAIT_SEC', '0.02'))
+DETECT_PROXY_SIDE = int(os.environ.get('DETECT_PROXY_SIDE', '640'))    # shorter side of the photo proxy faces are detected on
+CROP_MIN_SIDE = int(os.environ.get('CROP_MIN_SIDE', '1024'))    # larger face crops are decoded reduced, 0: full resolution
+SEG_DEVICE = os.environ.get('SEG_DEVICE', 'cuda')
+HEAD_SEGMENTER_BACKEND = os.environ.get('HEAD_SEGMENTER_BACKEND', 'torch')    # torch | onnxruntime
+HEAD_SEGMENTER_ONNX_PATH = os.environ.get('HEAD_SEGMENTER_ONNX_PATH', '.cache/models/head_segmentation.onnx')
+HEAD_SEGMENTER_QUANTIZE = os.environ.get('HEAD_SEGMENTER_QUANTIZE', '')    # empty: fp32, int8: dynamic int8 or a prebuilt static one
+FACE_MODEL_PATH = os.environ.get('FACE_MODEL_PATH', 'yolov8n-face.onnx')
+FACE_DETECTOR_BACKEND = os.environ.get('FACE_DETECTOR_BACKEND', 'onnxruntime')    # onnxruntime | ultralytics
+ORT_PROVIDERS = [provider.strip() for provider in os.environ.get('ORT_PROVIDERS', 'CUDAExecutionProvider,CPUExecutionProvider').split(',') if provider.strip()]
+ORT_INTRA_OP_THREADS = int(os.environ.get('ORT_INTRA_OP_THREADS', '0'))    # 0: onnxruntime default
+ORT_INTER_OP_THREADS = int(os.environ.get('ORT_INTER_OP_THREADS', '0'))
+PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', '0'))    # 0: in-process, micro-batched across orders
+TIMELINE_KEEP = int(os.environ.get('TIMELINE_KEEP', '200'))    # 0: no timeline
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '20'))
+PROFILE_INTERVAL_SEC = float(os.environ.get('PROFILE_INTERVAL_SEC', '0.001'))
 
 
 if not os.path.exists(PRESET_DIR):
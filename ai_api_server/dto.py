@@ -34,6 +34,10 @@ class UpdateUrlParam(BaseModel):
 class AuthorizedParam(BaseModel):
     k: str
 
+class ProfileParam(AuthorizedParam):
+    requests: int = 1
+    seconds: Optional[float] = None
+
 
 class BaseResponse (BaseModel):
     message: str = ""
@@ -50,6 +54,7 @@ class StatusData(BaseModel):
     webui_status: bool
     webui_url: str
     time: str
+    admission: Optional[dict] = None
 
 class StatusResponse(BaseResponse):
     data: StatusData
@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+from PIL import Image
+import utils
+from api import build_face_model
+from logger import logger
+from config import FACE_MODEL_CACHE_SIZE, REACTOR_FACEMODEL_DIRS, STATUS_TIMEOUT_SEC
+
+MODEL_PREFIX = "fm_"
+
+
+# @@ Face model cache ############################
+class FaceModelManager:
+    """ Content-addressed ReActor face models, tracked and evicted (LRU) per WebUI backend.
+
+    The model name is derived from the processed input images, so a retried or
+    redelivered order with the same photos reuses the model already on the backend.
+    Models used by an in-flight order are never evicted.
+
+    ReActor has no delete API. An evicted model file is only removed when the model
+    directory of its backend is mounted here (REACTOR_FACEMODEL_DIRS). Otherwise the
+    files pile up on the backend and a warning says so.
+    """
+    def __init__(self, max_models: int = FACE_MODEL_CACHE_SIZE, model_dirs: Dict[str, str] = REACTOR_FACEMODEL_DIRS):
+        """
+        Args:
+            max_models (int, optional): Models kept per backend. Defaults to FACE_MODEL_CACHE_SIZE.
+            model_dirs (Dict[str, str], optional): Backend url -> its mounted model directory. Defaults to REACTOR_FACEMODEL_DIRS.
+        """
+        self.max_models = max_models
+        self.model_dirs = dict(model_dirs)
+        self.models: Dict[str, "OrderedDict[str, float]"] = {}    # backend url -> model name -> last used
+        self.refs: Dict[Tuple[str, str], int] = {}
+        self._building: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._synced: set = set()
+        self._undeletable: set = set()
+
+    @staticmethod
+    def model_name(images: List[Image.Image]) -> str:
+        # ReActor averages the embeddings, so the input order does not matter
+        hasher = hashlib.blake2b(digest_size=12)
+        for digest in sorted(utils.imageDigest(img) for img in images):
+            hasher.update(digest.encode())
+        return MODEL_PREFIX + hasher.hexdigest()
+
+    async def _sync(self, backend_url: str):
+        """ Seed the index with models left on the backend by a previous run. """
+        if backend_url in self._synced:
+            return
+        data = await utils.requestGetAsync(f"{backend_url}/reactor/facemodels", timeout=STATUS_TIMEOUT_SEC)
+        if not isinstance(data, dict) or "error" in data:
+            # Tried again by the next order
+            logger.warning(f"face_models:sync_failed:{backend_url}::detail:{data}")
+            return
+        self._synced.add(backend_url)
+        names = data.get("facemodels", [])
+        models = self.models.setdefault(backend_url, OrderedDict())
+        for name in names:
+            if isinstance(name, str) and name.startswith(MODEL_PREFIX) and name not in models:
+                models[name] = 0.0
+                models.move_to_end(name, last=False)
+
+    async def acquire(self, backend_url: str, images: List[Image.Image]) -> Tuple[bool, Any]:
+        """
+        Returns:
+            tuple[bool, Any]: (True, model name) or (False, error detail). Call "release" once done with the model.
+        """
+        # Hashes every pixel, off the event loop
+        name = await asyncio.to_thread(self.model_name, images)
+        await self._sync(backend_url)
+        models = self.models.setdefault(backend_url, OrderedDict())
+        key = (backend_url, name)
+        if name not in models:
+            # Concurrent orders with the same photos share one build
+            if key not in self._building:
+                self._building[key] = asyncio.create_task(build_face_model(img_list=images, model_name=name, base_url=backend_url))
+            try:
+                succ, response = await asyncio.shield(self._building[key])
+            finally:
+                if key in self._building and self._building[key].done():
+                    del self._building[key]
+            if not succ:
+                return False, response
+            logger.info(f"face_models:built:{backend_url}:{name}")
+        else:
+            logger.info(f"face_models:reused:{backend_url}:{name}")
+        models[name] = time.time()
+        models.move_to_end(name)
+        self.refs[key] = self.refs.get(key, 0) + 1
+        return True, name
+
+    def release(self, backend_url: str, name: str):
+        key = (backend_url, name)
+        self.refs[key] = self.refs.get(key, 1) - 1
+        if self.refs[key] <= 0:
+            del self.refs[key]
+        self._evict(backend_url)
+
+    def _evict(self, backend_url: str):
+        models = self.models.get(backend_url, OrderedDict())
+        for name in list(models.keys()):
+            if len(models) <= self.max_models:
+                break
+            if (backend_url, name) in self.refs:
+                continue
+            del models[name]
+            self._delete(backend_url, name)
+
+    def _delete(self, backend_url: str, name: str):
+        model_dir = self.model_dirs.get(backend_url)
+        if model_dir is None:
+            if backend_url not in self._undeletable:
+                self._undeletable.add(backend_url)
+                logger.warning(f"face_models:no_model_dir:{backend_url}::evicted models stay on the backend, see REACTOR_FACEMODEL_DIRS")
+            logger.info(f"face_models:evicted_without_delete:{backend_url}:{name}")
+            return
+        try:
+            os.remove(os.path.join(model_dir, f"{name}.safetensors"))
+            logger.info(f"face_models:deleted:{backend_url}:{name}")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Error-face_models:delete:{name}::detail:{e}")
+
+
+face_model_manager = FaceModelManager()
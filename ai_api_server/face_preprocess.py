@@ -1,19 +1,31 @@
+import ast
+import io
+import math
 import os
-from typing import List
+import time
+from typing import Dict, List, Optional, Tuple
 import cv2
-import torch
 import numpy as np
 from PIL import Image
-from ultralytics import YOLO
-import head_segmentation.segmentation_pipeline as seg_pipeline
 from dto import Background
+from config import CLEANUP_MAX_SIDE, CROP_MIN_SIDE, DETECT_PROXY_SIDE, FACE_DETECTOR_BACKEND, HEAD_SEGMENTER_BACKEND, ORT_INTER_OP_THREADS, ORT_INTRA_OP_THREADS, ORT_PROVIDERS, SEG_BATCH_SIZE
 
+BG_COLORS = {
+    Background.CRIMSON: [0x79, 0x00, 0x30],
+    Background.IVORY: [0xFF, 0xFF, 0xF0],
+    Background.BLACK: [0x33, 0x33, 0x33],
+}
+
+# torch, ultralytics & head_segmentation are imported by the model classes only,
+# so that importing this module (e.g. for color_background) stays cheap
 class FaceDetector: 
     def __init__(self, model_path):
+        from ultralytics import YOLO
         self.model = YOLO(model_path, task='detect', verbose=False)
         self.warmup_model(imgsz=640)  
 
     def warmup_model(self, imgsz=640):
+        import torch
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         dummy_img = torch.zeros((1, 3, imgsz, imgsz), device=device)
         self.model.predict(dummy_img, task='detect', verbose=False)
@@ -56,17 +68,166 @@ class FaceDetector:
     
 
     def calculate_margins(self, x1, y1, x2, y2, margin, i, image):
-        bbox_width = x2 - x1
-        bbox_height = y2 - y1
-        image_width, image_height = image[i].shape[1], image[i].shape[0]
-        new_x1 = max(0, x1 - margin * 0.2 * bbox_width)
-        new_y1 = max(0, y1 - margin * 0.3 * bbox_height)
-        new_x2 = min(image_width, x2 + margin * 0.2 * bbox_width) 
-        new_y2 = min(image_height, y2 + margin * 0.2 * bbox_height) 
-        return int(new_x1), int(new_y1), int(new_x2), int(new_y2)
+        return margin_box(x1, y1, x2, y2, margin, image[i].shape[1], image[i].shape[0])
+
+
+def margin_box(x1, y1, x2, y2, margin, image_width, image_height):
+    bbox_width = x2 - x1
+    bbox_height = y2 - y1
+    new_x1 = max(0, x1 - margin * 0.2 * bbox_width)
+    new_y1 = max(0, y1 - margin * 0.3 * bbox_height)
+    new_x2 = min(image_width, x2 + margin * 0.2 * bbox_width) 
+    new_y2 = min(image_height, y2 + margin * 0.2 * bbox_height) 
+    return int(new_x1), int(new_y1), int(new_x2), int(new_y2)
+
+
+def ort_session(model_path: str, providers: List[str] = ORT_PROVIDERS,
+                intra_op_threads: int = ORT_INTRA_OP_THREADS, inter_op_threads: int = ORT_INTER_OP_THREADS):
+    """ onnxruntime session on the first available of providers, CPU if none is. """
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    available = ort.get_available_providers()
+    providers = [provider for provider in providers if provider in available] or ["CPUExecutionProvider"]
+    return ort.InferenceSession(model_path, sess_options=options, providers=providers)
+
+
+class OrtBoxes:
+    """ Subset of ultralytics Boxes used by "crop_faces". """
+    def __init__(self, xyxy: np.ndarray, conf: np.ndarray, cls: np.ndarray):
+        self.xyxy = xyxy
+        self.conf = conf
+        self.cls = cls
+
+    def __len__(self):
+        return len(self.xyxy)
+
+
+class OrtResult:
+    def __init__(self, boxes: OrtBoxes, orig_shape: Tuple[int, int]):
+        self.boxes = boxes
+        self.orig_shape = orig_shape
+
+
+class OrtFaceDetector(FaceDetector):
+    """ yolov8n-face.onnx run directly on onnxruntime, same "detect"/"crop_faces" contract as FaceDetector.
+
+    Letterboxing, NMS and box rescaling are done in NumPy, without ultralytics & torch.
+    """
+    PAD_VALUE = 114
+
+    def __init__(self, model_path, providers: List[str] = ORT_PROVIDERS,
+                 intra_op_threads: int = ORT_INTRA_OP_THREADS, inter_op_threads: int = ORT_INTER_OP_THREADS):
+        self.session = ort_session(model_path, providers, intra_op_threads, inter_op_threads)
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        batch, _, height, width = model_input.shape
+        # Static exports take one image per run, dynamic ones the whole batch
+        self.max_batch = batch if isinstance(batch, int) else None
+        self.input_size = height if isinstance(height, int) and height == width else None
+        names = self.session.get_modelmeta().custom_metadata_map.get("names")
+        try:
+            self.num_classes = len(ast.literal_eval(names)) if names else 1
+        except (ValueError, SyntaxError):
+            self.num_classes = 1
+        self.warmup_model(imgsz=self.input_size or 640)
+
+    def warmup_model(self, imgsz=640):
+        self.session.run(None, {self.input_name: np.zeros((self.max_batch or 1, 3, imgsz, imgsz), dtype=np.float32)})
+
+    def letterbox(self, images: List[np.ndarray], imgsz: int) -> Tuple[np.ndarray, List[Tuple[float, int, int]]]:
+        """ Resize keeping the aspect ratio and pad to imgsz x imgsz, as ultralytics does.
+
+        Returns:
+            Tuple[numpy.ndarray, List]: NCHW float32 batch, (scale, pad_left, pad_top) per image.
+        """
+        batch = np.full((len(images), imgsz, imgsz, 3), self.PAD_VALUE, dtype=np.uint8)
+        transforms = []
+        for i, image in enumerate(images):
+            height, width = image.shape[:2]
+            scale = min(imgsz / height, imgsz / width)
+            new_w, new_h = int(round(width * scale)), int(round(height * scale))
+            left, top = (imgsz - new_w) // 2, (imgsz - new_h) // 2
+            resized = image if (new_w, new_h) == (width, height) else cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+            batch[i, top:top + new_h, left:left + new_w] = resized[..., :3]
+            transforms.append((scale, left, top))
+        # ultralytics takes ndarrays as BGR and flips them, kept for identical detections on our RGB arrays
+        return np.ascontiguousarray(batch[..., ::-1].transpose(0, 3, 1, 2), dtype=np.float32) / 255.0, transforms
+
+    @staticmethod
+    def nms(boxes: np.ndarray, scores: np.ndarray, iou_thres: float) -> np.ndarray:
+        x1, y1, x2, y2 = boxes.T
+        areas = (x2 - x1).clip(0) * (y2 - y1).clip(0)
+        order = scores.argsort()[::-1]
+        keep = []
+        while order.size:
+            i = order[0]
+            keep.append(i)
+            rest = order[1:]
+            inter_w = (np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest])).clip(0)
+            inter_h = (np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest])).clip(0)
+            inter = inter_w * inter_h
+            iou = inter / (areas[i] + areas[rest] - inter + 1e-7)
+            order = rest[iou <= iou_thres]
+        return np.array(keep, dtype=np.int64)
+
+    def postprocess(self, pred: np.ndarray, transform: Tuple[float, int, int], orig_shape: Tuple[int, int],
+                    max_det: int, conf_thres: float, iou_thres: float) -> OrtResult:
+        # (4 + classes + keypoints, anchors) -> (anchors, ...)
+        pred = pred.T
+        scores = pred[:, 4:4 + self.num_classes]
+        cls = scores.argmax(axis=1)
+        conf = scores[np.arange(len(scores)), cls]
+        keep = conf > conf_thres
+        xywh, conf, cls = pred[keep, :4], conf[keep], cls[keep]
+        xyxy = np.concatenate([xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, :2] + xywh[:, 2:] / 2], axis=1)
+        if len(xyxy):
+            # Offset per class, so that NMS never merges boxes of different classes
+            offsets = cls[:, None].astype(np.float32) * 7680
+            idx = self.nms(xyxy + offsets, conf, iou_thres)[:max_det]
+            xyxy, conf, cls = xyxy[idx], conf[idx], cls[idx]
+            scale, left, top = transform
+            xyxy = (xyxy - np.array([left, top, left, top], dtype=np.float32)) / scale
+            xyxy[:, [0, 2]] = xyxy[:, [0, 2]].clip(0, orig_shape[1])
+            xyxy[:, [1, 3]] = xyxy[:, [1, 3]].clip(0, orig_shape[0])
+        return OrtResult(OrtBoxes(xyxy, conf, cls), orig_shape)
+
+    def detect(self, images, imgsz=640, max_det=1, conf_thres=0.25, iou_thres=0.7):
+        """
+        Args:
+            images (List[numpy.ndarray]): A List of images for detecting.
+            imgsz (int, optional): Resizing size, ignored for models exported with a fixed size. Defaults to 640.
+            max_det (int, optional): Maximum # of detections per image. Defaults to 1.
+
+        Returns:
+            List[OrtResult]: One result per image, "boxes.xyxy" in original image coordinates.
+        """
+        if len(images) == 0:
+            return []
+        imgsz = self.input_size or imgsz
+        step = self.max_batch or len(images)
+        results = []
+        for start in range(0, len(images), step):
+            chunk = images[start:start + step]
+            batch, transforms = self.letterbox(chunk, imgsz)
+            preds = self.session.run(None, {self.input_name: batch})[0]
+            results += [self.postprocess(pred, transform, image.shape[:2], max_det, conf_thres, iou_thres)
+                        for pred, transform, image in zip(preds, transforms, chunk)]
+        return results
+
+
+def build_face_detector(model_path: str, backend: str = FACE_DETECTOR_BACKEND) -> FaceDetector:
+    """ backend: "onnxruntime" or "ultralytics". """
+    if backend == "ultralytics":
+        return FaceDetector(model_path)
+    return OrtFaceDetector(model_path)
+
 
 class HeadSegmenter:
     def __init__(self, device='cpu'):
+        import head_segmentation.segmentation_pipeline as seg_pipeline
         self.device = device
         self.segmentation_pipeline = seg_pipeline.HumanHeadSegmentationPipeline(device=device)
 
@@ -78,18 +239,130 @@ class HeadSegmenter:
         Returns:
             List[PIL.Image.Image]
         """
-        segmented_images = []
-        for image in images:
-            segmented_image = self.segment_head(image, bg_color)
-            segmented_images.append(Image.fromarray(segmented_image))
-        return segmented_images
+        masks = self.segment_masks(images)
+        return [Image.fromarray(composite_background(image, mask, bg_color)) for image, mask in zip(images, masks)]
+
+    def segment_masks(self, images, batch_size: int = SEG_BATCH_SIZE) -> List[np.ndarray]:
+        """
+        Args:
+            images (List[numpy.ndarray]): A list of (cropped) images, may span several requests.
+            batch_size (int, optional): Maximum # of images per forward pass. Defaults to SEG_BATCH_SIZE.
+
+        Returns:
+            List[numpy.ndarray]: A list of boolean head masks, one per image.
+        """
+        masks = []
+        for start in range(0, len(images), batch_size):
+            masks += self._predict_batch(images[start:start + batch_size])
+        return masks
+
+    def _predict_batch(self, images) -> List[np.ndarray]:
+        import torch
+        if len(images) == 0:
+            return []
+        # Same preprocessing as HumanHeadSegmentationPipeline.predict, stacked into one tensor
+        with torch.inference_mode():
+            batch = torch.cat([self.segmentation_pipeline._preprocess_image(image) for image in images])
+            segmaps = self.segmentation_pipeline._model(batch).argmax(dim=1).to(torch.uint8).cpu().numpy()
+        return [cv2.resize(segmap, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_NEAREST) != 0
+                for segmap, image in zip(segmaps, images)]
+
+    def segment_head(self, image, bg_color: List[int] = [0x79, 0x00, 0x30]):
+        mask = self.segmentation_pipeline.predict(image) != 0
+        return composite_background(image, mask, bg_color)
+
+
+class OrtHeadSegmenter(HeadSegmenter):
+    """ Exported (optionally int8) head segmentation network on onnxruntime, see segmenter_export.py.
+
+    Same "segment_masks"/"segment_and_color" contract as HeadSegmenter, without torch at runtime.
+    """
+    def __init__(self, model_path: str, providers: List[str] = ORT_PROVIDERS):
+        self.session = ort_session(model_path, providers)
+        self.input_name = self.session.get_inputs()[0].name
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.resolution = int(metadata.get("resolution") or self.session.get_inputs()[0].shape[-1])
+        self._predict_batch([np.zeros((self.resolution, self.resolution, 3), dtype=np.uint8)])
+
+    def _predict_batch(self, images) -> List[np.ndarray]:
+        import segmenter_export
+        if len(images) == 0:
+            return []
+        logits = self.session.run(None, {self.input_name: segmenter_export.preprocess(images, self.resolution)})[0]
+        segmaps = logits.argmax(axis=1).astype(np.uint8)
+        return [cv2.resize(segmap, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_NEAREST) != 0
+                for segmap, image in zip(segmaps, images)]
 
     def segment_head(self, image, bg_color: List[int] = [0x79, 0x00, 0x30]):
-        segmentation_map = self.segmentation_pipeline.predict(image)
-        segmentation_overlay = cv2.cvtColor(segmentation_map, cv2.COLOR_GRAY2RGB)
-        segmentation_overlay[segmentation_map == 0] = bg_color
-        result_image = np.where(segmentation_overlay == bg_color, segmentation_overlay, image)
-        return result_image.astype('uint8')
+        return composite_background(image, self._predict_batch([image])[0], bg_color)
+
+
+def build_head_segmenter(device: str, backend: str = HEAD_SEGMENTER_BACKEND) -> HeadSegmenter:
+    """ backend: "torch" (eager, on device) or "onnxruntime" (exported artifact, cached on first use). """
+    if backend == "onnxruntime":
+        import segmenter_export
+        providers = ORT_PROVIDERS if device.startswith("cuda") else ["CPUExecutionProvider"]
+        return OrtHeadSegmenter(segmenter_export.ensure_artifact(), providers)
+    return HeadSegmenter(device)
+
+class LazyImage:
+    """ Downloaded photo kept as bytes, decoded at the resolution each step needs.
+
+    JPEGs, and the MPOs many phones save, are decoded with DCT scaling (PIL "draft"), a small
+    proxy for detection and a reduced one for cropping when the face is large enough. A face
+    smaller than CROP_MIN_SIDE needs every pixel, its photo is decoded at full resolution and
+    dropped once cropped. Other formats are decoded once.
+    Sizes & coordinates are those of the EXIF aligned, full resolution image.
+    """
+    def __init__(self, data: bytes):
+        self.data = data
+        with Image.open(io.BytesIO(data)) as image:
+            self.format = image.format
+            width, height = image.size
+            exif = image._getexif() if hasattr(image, '_getexif') else None
+        orientation = exif.get(0x0112) if exif else None
+        self.size = (height, width) if orientation in (6, 8) else (width, height)
+        self._decoded: Optional[Image.Image] = None
+
+    def decode(self, min_side: int = 0) -> Image.Image:
+        """ Aligned RGB image whose shorter side is at least min_side, 0 for full resolution. """
+        if self.format not in ("JPEG", "MPO"):
+            if self._decoded is None:
+                self._decoded = align_pil_image(Image.open(io.BytesIO(self.data))).convert("RGB")
+            return self._decoded
+        image = Image.open(io.BytesIO(self.data))
+        if min_side:
+            # Decodes at 1/2, 1/4 or 1/8 scale, the smallest that keeps both sides >= min_side
+            image.draft("RGB", (min_side, min_side))
+        image = align_pil_image(image)
+        return image if image.mode == "RGB" else image.convert("RGB")
+
+    def proxy(self, side: int = DETECT_PROXY_SIDE) -> Tuple[np.ndarray, float, float]:
+        """
+        Returns:
+            Tuple[numpy.ndarray, float, float]: Reduced RGB array for detection, its x & y scale to the full image.
+        """
+        image = self.decode(side)
+        factor = min(image.size) // side
+        if factor > 1:
+            image = image.reduce(factor)
+        return np.asarray(image), image.size[0] / self.size[0], image.size[1] / self.size[1]
+
+    def crop(self, box: Tuple[int, int, int, int], min_side: int = CROP_MIN_SIDE) -> np.ndarray:
+        """ Region of the full image, decoded at a reduced scale that keeps its longer side >= min_side.
+
+        A region whose longer side is already below min_side is cut from a full resolution decode.
+        """
+        x1, y1, x2, y2 = box
+        reduction = max(x2 - x1, y2 - y1) / min_side if min_side else 1
+        image = self.decode(math.ceil(min(self.size) / reduction) if reduction > 1 else 0)
+        sx, sy = image.size[0] / self.size[0], image.size[1] / self.size[1]
+        region = image.crop((int(x1 * sx), int(y1 * sy), int(x2 * sx), int(y2 * sy)))
+        return convert_to_rgb(np.array(region))
+
+    def release(self):
+        self._decoded = None
+
 
 def align_pil_image(img: Image.Image)->Image.Image:
     if hasattr(img, '_getexif'):
@@ -113,6 +386,51 @@ def convert_to_rgb(image_array):
         rgb_image = image_array
     return rgb_image
 
+def largest_component_mask(mask: np.ndarray, max_side: int = CLEANUP_MAX_SIDE) -> np.ndarray:
+    """ The component to keep is chosen on a downscaled copy of the mask, the full resolution mask is then cut to it.
+
+    Args:
+        mask (numpy.ndarray): A boolean head mask.
+        max_side (int, optional): Longest side of the mask used for labeling. Defaults to CLEANUP_MAX_SIDE.
+
+    Returns:
+        numpy.ndarray: A boolean mask keeping only the largest connected component.
+    """
+    height, width = mask.shape[:2]
+    scale = min(1.0, max_side / max(height, width))
+    small = mask.astype(np.uint8)
+    if scale < 1.0:
+        small = cv2.resize(small, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_NEAREST)
+
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(small, connectivity=8)
+    if len(stats) < 2:
+        return mask
+    largest = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+    keep = (labels == largest).astype(np.uint8)
+    if scale < 1.0:
+        # Grown by one downscaled pixel, the nearest neighbour upsampling would otherwise eat into the outline
+        keep = cv2.dilate(keep, np.ones((3, 3), np.uint8))
+        keep = cv2.resize(keep, (width, height), interpolation=cv2.INTER_NEAREST)
+    return mask & (keep != 0)
+
+def composite_background(image: np.ndarray, mask: np.ndarray, bg_color: List[int], out: np.ndarray = None) -> np.ndarray:
+    """
+    Args:
+        image (numpy.ndarray): RGB image.
+        mask (numpy.ndarray): Boolean foreground mask of the same height & width.
+        bg_color (List[int]): RGB color written where the mask is False.
+        out (numpy.ndarray, optional): Buffer to write into. Defaults to a copy of image.
+
+    Returns:
+        numpy.ndarray: RGB uint8 image.
+    """
+    if out is None:
+        out = image.copy()
+    elif out is not image:
+        np.copyto(out, image)
+    out[~mask] = bg_color
+    return out
+
 def remove_smaller_components_pil(image: Image.Image, bg_color: List[int]):
     """
 
@@ -124,49 +442,92 @@ def remove_smaller_components_pil(image: Image.Image, bg_color: List[int]):
         output (Image.Image):
     """
     image = np.array(image)
-    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-    background_mask = np.all(image == np.array(list(reversed(bg_color))), axis=-1)
-    foreground = np.where(background_mask[..., None], 0, image)
+    mask = ~np.all(image == np.array(bg_color, dtype=image.dtype), axis=-1)
+    mask = largest_component_mask(mask)
+    output = composite_background(image, mask, bg_color, out=image)
+    return Image.fromarray(output)
+
+def get_bg_color(bg: Background) -> List[int]:
+    if bg not in BG_COLORS:
+        print("Invalid Background color", bg)
+        raise ValueError("Invalid Background color")
+    return BG_COLORS[bg]
 
-    gray = cv2.cvtColor(foreground, cv2.COLOR_RGB2GRAY) 
-    _, binary = cv2.threshold(gray, 1, 255, cv2.THRESH_BINARY)
+class SegmentedHead:
+    """ Cropped face image with its cleaned head mask, independent of the background color. """
+    def __init__(self, crop: np.ndarray, mask: np.ndarray):
+        self.crop = crop
+        self.mask = mask
 
-    _, labels, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
-    largest = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
-    output = np.full_like(image, list(reversed(bg_color)))
-    output[labels == largest] = image[labels == largest]
-    output = cv2.cvtColor(output, cv2.COLOR_BGR2RGB)
-    output = Image.fromarray(output)
+def to_rgb_array(image: Image.Image) -> np.ndarray:
+    return convert_to_rgb(np.array(align_pil_image(image)))
 
-    return output
+def segment_photos(photos: List[bytes], face_detector: FaceDetector, head_segmenter: HeadSegmenter,
+                   margin: float = 2.5, timings: Optional[Dict[str, float]] = None) -> List[SegmentedHead]:
+    """ Detect and segment once, so that every background can reuse the result.
+
+    JPEGs are only decoded at full resolution when a face is smaller than CROP_MIN_SIDE,
+    one photo at a time.
+
+    Args:
+        photos (List[bytes]): Encoded photos as downloaded.
+        timings (Dict[str, float], optional): Filled with the seconds spent in "decode", "detect", "head_segment" and "cleanup". Defaults to None.
 
-def preprocess_image(images: List[Image.Image], bg: Background, face_detector: FaceDetector, head_segmenter: HeadSegmenter) -> List[Image.Image]:
+    Returns:
+        List[SegmentedHead]: A list of cropped faces with their head masks.
     """
+    timings = timings if timings is not None else {}
+    start = time.perf_counter()
+    images, proxies = decode_proxies(photos)
+    timings["decode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = face_detector.detect([proxy for proxy, _, _ in proxies])
+    timings["detect"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cropped_images = crop_detected(images, proxies, results, margin)
+    timings["decode"] += time.perf_counter() - start
+    return segment_crops(cropped_images, head_segmenter, timings)
+
+def decode_proxies(photos: List[bytes]) -> Tuple[List[LazyImage], List[Tuple[np.ndarray, float, float]]]:
+    images = [LazyImage(data) for data in photos]
+    return images, [image.proxy() for image in images]
+
+def crop_detected(images: List[LazyImage], proxies: List[Tuple[np.ndarray, float, float]], results, margin: float = 2.5) -> List[np.ndarray]:
+    """ Crops around the boxes found on the proxies, decoded from the full images. """
+    cropped_images = []
+    for image, (_, sx, sy), result in zip(images, proxies, results):
+        for box in result.boxes.xyxy:
+            x1, y1, x2, y2 = (float(v) for v in box[:4])
+            region = margin_box(x1 / sx, y1 / sy, x2 / sx, y2 / sy, margin, *image.size)
+            cropped_images.append(image.crop(region))
+        image.release()
+    return cropped_images
+
+def segment_crops(cropped_images: List[np.ndarray], head_segmenter: HeadSegmenter, timings: Dict[str, float]) -> List[SegmentedHead]:
+    start = time.perf_counter()
+    masks = head_segmenter.segment_masks(cropped_images)
+    timings["head_segment"] = time.perf_counter() - start
+    return clean_heads(cropped_images, masks, timings)
 
+def clean_heads(cropped_images: List[np.ndarray], masks: List[np.ndarray], timings: Dict[str, float]) -> List[SegmentedHead]:
+    start = time.perf_counter()
+    heads = [SegmentedHead(crop=crop, mask=largest_component_mask(mask)) for crop, mask in zip(cropped_images, masks)]
+    timings["cleanup"] = time.perf_counter() - start
+    return heads
+
+def color_background(heads: List[SegmentedHead], bg: Background) -> List[Image.Image]:
+    """
     Args:
-        images (List[Image.Image]): A list of PIL.Image.Image.
-        face_detector (FaceDetector): 
-        head_segmenter (HeadSegmenter): 
+        heads (List[SegmentedHead]): Result of "segment_photos".
+        bg (Background): 
 
     Returns:
         preprcessed_images (List[Image.Image]): A list of PIL.Image.Image.
     """
-    if bg == Background.CRIMSON:
-        bg_color = [0x79, 0x00, 0x30]
-    elif bg == Background.IVORY:
-        bg_color = [0xFF, 0xFF, 0xF0]
-    elif bg == Background.BLACK:
-        bg_color = [0x33, 0x33, 0x33]
-    else:
-        print("Invalid Background color", bg)
-        raise ValueError("Invalid Background color")
-
-    images = [align_pil_image(image) for image in images]
-    ndarr_images = [convert_to_rgb(np.array(image)) for image in images]    
-    results = face_detector.detect(ndarr_images)
-    cropped_images = face_detector.crop_faces(results=results, image=ndarr_images, margin=2.5)
-    processed_images = head_segmenter.segment_and_color(images=cropped_images, bg_color=bg_color)
-    processed_images = [remove_smaller_components_pil(image=image, bg_color=bg_color) for image in processed_images]
+    bg_color = get_bg_color(bg)
+    processed_images = [Image.fromarray(composite_background(head.crop, head.mask, bg_color)) for head in heads]
 
     if os.environ.get('ENV') == 'dev':
         for idx, img in enumerate(processed_images):
@@ -187,10 +548,10 @@ if __name__ == "__main__":
     cv2.cvtColor(cv2.imread(img_path, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB) 
     for img_path in image_paths
     ]
-    a = [Image.open('qwe.jpeg'),
-        Image.open('qwe1.jpeg'),
+    a = [open('qwe.jpeg', 'rb').read(),
+        open('qwe1.jpeg', 'rb').read(),
         ]
-    results = preprocess_image(a, face_detector, head_segmenter)
+    results = color_background(segment_photos(a, face_detector, head_segmenter), Background.CRIMSON)
     # results = face_detector.detect(a)
     # cropped_images = face_detector.crop_faces(results=results, image=a, margin=2)
     # # cropped_images = [ x.resize((512, 512)) for x in cropped_images]
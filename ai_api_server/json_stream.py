@@ -0,0 +1,104 @@
+import base64
+from typing import List, Optional
+
+
+# @@ Streaming JSON ############################
+class Base64ArrayExtractor:
+    """ Incremental scanner for the base64 strings of one top-level array, e.g. {"images": ["iVBOR...", ...], ...}
+
+    Chunks are fed as they arrive, every string of the array is base64 decoded
+    while it streams in and returned as soon as its closing quote is seen.
+    The rest of the document is scanned but not kept.
+    """
+    KEY_MAX_LEN = 64
+
+    def __init__(self, key: str = "images"):
+        self.key = key.encode()
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.capture = False                # inside a string of the target array
+        self.target_depth: Optional[int] = None
+        self.key_buf = bytearray()          # last string seen at depth 1, truncated
+        self.last_string: Optional[bytes] = None
+        self.current_key: Optional[bytes] = None
+        self._b64_tail = b""
+        self._decoded = bytearray()
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        """
+        Args:
+            chunk (bytes): Next part of the JSON document.
+
+        Returns:
+            List[bytes]: Decoded items completed within this chunk.
+        """
+        items = []
+        i, n = 0, len(chunk)
+        while i < n:
+            if self.in_string:
+                if self.escape:
+                    self._string_data(chunk[i:i + 1])
+                    self.escape = False
+                    i += 1
+                    continue
+                quote = chunk.find(b'"', i)
+                backslash = chunk.find(b"\\", i, quote if quote != -1 else n)
+                end = backslash if backslash != -1 else quote
+                if end == -1:
+                    self._string_data(chunk[i:])
+                    break
+                self._string_data(chunk[i:end])
+                if end == backslash:
+                    self.escape = True
+                    i = end + 1
+                else:
+                    item = self._close_string()
+                    if item is not None:
+                        items.append(item)
+                    i = end + 1
+                continue
+
+            c = chunk[i]
+            if c == 0x22:    # "
+                self.in_string = True
+                self.capture = self.target_depth is not None and self.depth == self.target_depth
+                self.key_buf.clear()
+            elif c == 0x7B or c == 0x5B:    # { [
+                self.depth += 1
+                if c == 0x5B and self.depth == 2 and self.current_key == self.key:
+                    self.target_depth = self.depth
+            elif c == 0x7D or c == 0x5D:    # } ]
+                if self.target_depth is not None and self.depth == self.target_depth:
+                    self.target_depth = None
+                self.depth -= 1
+            elif c == 0x3A and self.depth == 1:    # :
+                self.current_key = self.last_string
+            elif c == 0x2C and self.depth == 1:    # ,
+                self.current_key = None
+            i += 1
+        return items
+
+    def _string_data(self, data: bytes):
+        if self.capture:
+            self._feed_base64(data)
+        elif self.depth == 1 and len(self.key_buf) < self.KEY_MAX_LEN:
+            self.key_buf += data[:self.KEY_MAX_LEN - len(self.key_buf)]
+
+    def _close_string(self) -> Optional[bytes]:
+        self.in_string = False
+        if self.capture:
+            self.capture = False
+            self._feed_base64(b"", final=True)
+            item, self._decoded = bytes(self._decoded), bytearray()
+            return item
+        if self.depth == 1:
+            self.last_string = bytes(self.key_buf)
+        return None
+
+    def _feed_base64(self, data: bytes, final: bool = False):
+        data = self._b64_tail + data
+        usable = len(data) if final else len(data) - len(data) % 4
+        if usable:
+            self._decoded += base64.b64decode(data[:usable])
+        self._b64_tail = data[usable:]
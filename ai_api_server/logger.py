@@ -1,13 +1,146 @@
-import logging 
-from config import LOG_PATH
+import atexit
+import contextlib
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from config import (LOG_BACKUP_COUNT, LOG_FORMAT, LOG_MAX_BYTES, LOG_MAX_FIELD_CHARS, LOG_PATH, LOG_QUEUE_SIZE,
+                    LOG_SAMPLE_BURST, LOG_SAMPLE_WINDOW_SEC)
 
 
 # @@ Logging ############################
+# Callers only enqueue records, a listener thread formats them and does the I/O
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+
+@contextlib.contextmanager
+def request_context(req_id: str):
+    """ Tags the records of the current task, and of tasks it creates, with req_id. """
+    token = request_id_var.set(req_id)
+    try:
+        yield
+    finally:
+        request_id_var.reset(token)
+
+
+def truncate(text: str, limit: int = LOG_MAX_FIELD_CHARS) -> str:
+    if limit and len(text) > limit:
+        return f"{text[:limit]}...(+{len(text) - limit} chars)"
+    return text
+
+
+class SamplingFilter(logging.Filter):
+    """ At most burst records per call site and window, the count of dropped ones goes on the next kept record. """
+    def __init__(self, burst: int = LOG_SAMPLE_BURST, window_sec: float = LOG_SAMPLE_WINDOW_SEC):
+        super().__init__()
+        self.burst = burst
+        self.window_sec = window_sec
+        self._sites: Dict[Tuple[str, int], list] = {}    # call site -> [window start, kept, dropped]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not self.burst:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.setdefault((record.pathname, record.lineno), [now, 0, 0])
+            if now - site[0] >= self.window_sec:
+                site[0], site[1] = now, 0
+            if site[1] >= self.burst:
+                site[2] += 1
+                return False
+            site[1] += 1
+            if site[2]:
+                record.sampled_out, site[2] = site[2], 0
+        return True
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """ Enqueues the record unformatted, with the request id of the calling task. Drops when the queue is full. """
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.request_id = request_id_var.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            ContextQueueHandler.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", None),
+            "message": truncate(record.getMessage()),
+        }
+        # logger.info(msg, extra={"fields": {...}}) adds structured values next to the message
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry["fields"] = {key: value if value is None or isinstance(value, (bool, int, float)) else truncate(str(value))
+                               for key, value in fields.items()}
+        if getattr(record, "sampled_out", 0):
+            entry["sampled_out"] = record.sampled_out
+        if record.exc_info:
+            entry["exception"] = truncate(self.formatException(record.exc_info))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s - %(levelname)s - %(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        record.message = truncate(record.getMessage())
+        record.asctime = self.formatTime(record, self.datefmt)
+        line = self.formatMessage(record)
+        if getattr(record, "request_id", None):
+            line += f" [id:{record.request_id}]"
+        if getattr(record, "sampled_out", 0):
+            line += f" [sampled_out:{record.sampled_out}]"
+        if record.exc_info:
+            line += "\n" + truncate(self.formatException(record.exc_info))
+        return line
+
 
 logging.basicConfig(level=logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-handler = logging.FileHandler(LOG_PATH, mode="a")
-handler.setFormatter(formatter)
+formatter = JsonFormatter() if LOG_FORMAT == "json" else TextFormatter()
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(TextFormatter())
+handlers = [console_handler]
+# Only the server process writes the log file, spawned preprocess workers importing this module
+# would each rotate it on their own. Their records go to the inherited console
+if multiprocessing.current_process().name == "MainProcess":
+    handler = logging.handlers.RotatingFileHandler(LOG_PATH, mode="a", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    handler.setFormatter(formatter)
+    handlers.insert(0, handler)
+log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+listener.start()
+
+
+def stop_logging():
+    """ Flushes queued records, safe to call more than once. """
+    if listener._thread is not None:
+        listener.stop()
+
+
+atexit.register(stop_logging)
+
+queue_handler = ContextQueueHandler(log_queue)
+queue_handler.addFilter(SamplingFilter())
 logger = logging.getLogger(__name__)
-logger.addHandler(handler)
-# TODO: logger async 
+logger.addHandler(queue_handler)
+# The console handler of basicConfig would write on the caller's thread
+logger.propagate = False
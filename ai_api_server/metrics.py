@@ -0,0 +1,65 @@
+import re
+from typing import Dict
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+
+# @@ Metrics ############################
+# Process RSS, CPU and open fds come from the default process collector (process_resident_memory_bytes, ...)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+
+STAGE_SECONDS = Histogram("aiprofile_stage_seconds",
+                          "Run time of pipeline stages and preprocessing steps",
+                          ["stage"], buckets=LATENCY_BUCKETS)
+STAGE_WAIT_SECONDS = Histogram("aiprofile_stage_wait_seconds",
+                               "Time spent waiting for the stage limiter",
+                               ["stage"], buckets=LATENCY_BUCKETS)
+ORDERS = Counter("aiprofile_orders_total",
+                 "Finished orders by source, result and error class",
+                 ["source", "result", "error"])
+BATCH_SIZE = Histogram("aiprofile_batch_size",
+                       "Images per micro-batched model run",
+                       ["model"], buckets=(1, 2, 4, 8, 16, 32, 64))
+RMQ_INFLIGHT = Gauge("aiprofile_rmq_inflight", "RMQ messages being processed")
+RMQ_PREFETCH = Gauge("aiprofile_rmq_prefetch", "RMQ prefetch count of the consumer channel")
+ADMISSION_PREDICTED_SECONDS = Gauge("aiprofile_admission_predicted_seconds",
+                                    "Predicted completion time of a new order at the last admission check")
+ADMISSION_DEFERRED = Counter("aiprofile_admission_deferred_total",
+                             "Orders turned away (api) or held back (rmq) for exceeding the SLO",
+                             ["source"])
+WEBUI_SECONDS = Histogram("aiprofile_webui_request_seconds",
+                          "Latency of WebUI calls by backend and endpoint",
+                          ["backend", "endpoint"], buckets=LATENCY_BUCKETS)
+WEBUI_FAILURES = Counter("aiprofile_webui_failures_total",
+                         "Failed WebUI calls by backend and endpoint",
+                         ["backend", "endpoint"])
+
+
+def observe_stages(timings: Dict[str, float]):
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+def observe_webui(backend: str, endpoint: str, seconds: float, succ: bool):
+    WEBUI_SECONDS.labels(backend, endpoint).observe(seconds)
+    if not succ:
+        WEBUI_FAILURES.labels(backend, endpoint).inc()
+
+
+def error_class(e: BaseException) -> str:
+    """ Bare Exception("UploadFail") carries its class in the message, keep label values bounded. """
+    if type(e) is Exception:
+        match = re.match(r"[A-Za-z_]+", str(e))
+        if match:
+            return match.group(0)[:40]
+    return type(e).__name__
+
+
+def count_order(source: str, e: BaseException = None):
+    if e is None:
+        ORDERS.labels(source, "success", "").inc()
+    else:
+        ORDERS.labels(source, "failure", error_class(e)).inc()
+
+
+def render() -> bytes:
+    return generate_latest()
@@ -0,0 +1,183 @@
+import asyncio
+import contextlib
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+import metrics
+import profiling
+from checkpoint import CheckpointStore
+from config import STAGE_LIMITS
+
+
+# @@ Stage limits ############################
+_stage_limiters: Dict[str, asyncio.Semaphore] = {}
+
+
+def get_stage_limiter(resource: str) -> asyncio.Semaphore:
+    """ Process-wide semaphore per resource, shared by every running pipeline. """
+    if resource not in _stage_limiters:
+        _stage_limiters[resource] = asyncio.Semaphore(STAGE_LIMITS[resource])
+    return _stage_limiters[resource]
+
+
+# @@ Stage graph ############################
+class Stage:
+    def __init__(self, name: str, fn: Callable[[Dict[str, Any]], Awaitable[Any]], deps: List[str] = [], resource: Optional[str] = None,
+                 checkpoint: bool = False):
+        """
+        Args:
+            name (str): Unique stage name, e.g. "t2i:crimson".
+            fn (Callable): Coroutine function called with a dict of {dep_name: dep_result}.
+            deps (List[str], optional): Names of the stages this stage waits for. Defaults to [].
+            resource (str, optional): Key of STAGE_LIMITS bounding concurrent runs across pipelines. Defaults to None.
+            checkpoint (bool, optional): Persist the result, a later run restores it instead of running the stage. Defaults to False.
+        """
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.resource = resource
+        self.checkpoint = checkpoint
+
+
+class PipelineResult:
+    def __init__(self, results: Dict[str, Any], timings: Dict[str, float], waits: Dict[str, float], restored: List[str]):
+        self.results = results
+        self.timings = timings
+        self.waits = waits
+        self.restored = restored
+
+
+class Pipeline:
+    """ Runs every stage as soon as its dependencies are done, independent stages overlap. """
+    def __init__(self, stages: List[Stage], on_finish: List[Callable[[], None]] = [],
+                 checkpoint_store: Optional[CheckpointStore] = None, checkpoint_key: Optional[str] = None):
+        """
+        Args:
+            stages (List[Stage]):
+            on_finish (List[Callable], optional): Called after the run, whether it succeeded or not. Defaults to [].
+            checkpoint_store (CheckpointStore, optional): Where checkpointed stages are saved. Defaults to None, no checkpoint.
+            checkpoint_key (str, optional): Key of this run in the store, e.g. the request id. Defaults to None.
+        """
+        self.stages = self._sort(stages)
+        self.on_finish = list(on_finish)
+        self.checkpoint_store = checkpoint_store
+        self.checkpoint_key = checkpoint_key
+
+    @staticmethod
+    def _sort(stages: List[Stage]) -> List[Stage]:
+        by_name = {stage.name: stage for stage in stages}
+        if len(by_name) != len(stages):
+            raise ValueError("Duplicated stage name")
+        ordered, visiting, done = [], set(), set()
+
+        def visit(stage: Stage):
+            if stage.name in done:
+                return
+            if stage.name in visiting:
+                raise ValueError(f"Cyclic stage dependency: {stage.name}")
+            visiting.add(stage.name)
+            for dep in stage.deps:
+                if dep not in by_name:
+                    raise ValueError(f"Unknown dependency {dep} of stage {stage.name}")
+                visit(by_name[dep])
+            visiting.discard(stage.name)
+            done.add(stage.name)
+            ordered.append(stage)
+
+        for stage in stages:
+            visit(stage)
+        return ordered
+
+    def _checkpointed(self) -> Set[str]:
+        if self.checkpoint_store is None or self.checkpoint_key is None:
+            return set()
+        return {stage.name for stage in self.stages
+                if stage.checkpoint and self.checkpoint_store.has(self.checkpoint_key, stage.name)}
+
+    def _needed(self, checkpointed: Set[str]) -> Set[str]:
+        """ Sinks are always needed, a dependency only if a needed stage has to actually run. """
+        needed: Set[str] = set()
+        dependents: Dict[str, List[str]] = {stage.name: [] for stage in self.stages}
+        for stage in self.stages:
+            for dep in stage.deps:
+                dependents[dep].append(stage.name)
+        for stage in reversed(self.stages):
+            users = dependents[stage.name]
+            if not users or any(user in needed and user not in checkpointed for user in users):
+                needed.add(stage.name)
+        return needed
+
+    async def run(self) -> PipelineResult:
+        """
+        Returns:
+            PipelineResult: Result of every stage, its run time and the time spent waiting for its limiter, in seconds.
+
+        Raises:
+            The first exception raised by a stage, remaining stages are cancelled.
+        """
+        tasks: Dict[str, asyncio.Task] = {}
+        results: Dict[str, Any] = {}
+        timings: Dict[str, float] = {}
+        waits: Dict[str, float] = {}
+        restored: List[str] = []
+        checkpointed = await asyncio.to_thread(self._checkpointed)
+
+        def ensure_task(name: str) -> asyncio.Task:
+            if name not in tasks:
+                tasks[name] = asyncio.create_task(run_stage(by_name[name]), name=name)
+            return tasks[name]
+
+        async def run_stage(stage: Stage):
+            if stage.name in checkpointed:
+                succ, result = await asyncio.to_thread(self.checkpoint_store.load, self.checkpoint_key, stage.name)
+                if succ:
+                    restored.append(stage.name)
+                    results[stage.name] = result
+                    profiling.record_span(stage.name, time.perf_counter(), time.perf_counter(), restored=True, **profiling.describe(result))
+                    return result
+            # Dependencies skipped for a checkpoint that turned out unreadable are started here
+            inputs = {dep: await ensure_task(dep) for dep in stage.deps}
+            queued = time.perf_counter()
+            limiter = get_stage_limiter(stage.resource) if stage.resource else contextlib.nullcontext()
+            async with limiter:
+                start = time.perf_counter()
+                waits[stage.name] = start - queued
+                metrics.STAGE_WAIT_SECONDS.labels(stage.name).observe(waits[stage.name])
+                result = error = None
+                try:
+                    result = await stage.fn(inputs)
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    end = time.perf_counter()
+                    timings[stage.name] = end - start
+                    metrics.STAGE_SECONDS.labels(stage.name).observe(timings[stage.name])
+                    profiling.record_span(stage.name, start, end, wait=round(waits[stage.name], 6),
+                                          error=type(error).__name__ if error is not None else None,
+                                          **profiling.describe(result))
+            if stage.checkpoint and self.checkpoint_store is not None and self.checkpoint_key is not None:
+                await asyncio.to_thread(self.checkpoint_store.save, self.checkpoint_key, stage.name, result)
+            results[stage.name] = result
+            return result
+
+        # Stages are topologically sorted, so dependencies normally have a task already
+        by_name = {stage.name: stage for stage in self.stages}
+        needed = self._needed(checkpointed)
+        for stage in self.stages:
+            if stage.name in needed:
+                ensure_task(stage.name)
+        try:
+            # Tasks may be added while running, when a checkpoint can not be restored
+            pending = set()
+            while len(pending) != len(tasks):
+                pending = set(tasks.values())
+                await asyncio.gather(*pending)
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        finally:
+            for callback in self.on_finish:
+                callback()
+        return PipelineResult(results=results, timings=timings, waits=waits, restored=restored)
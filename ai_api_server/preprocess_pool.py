@@ -0,0 +1,212 @@
+import asyncio
+import itertools
+import multiprocessing
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import face_preprocess
+import metrics
+from batching import MicroBatcher
+from face_preprocess import SegmentedHead
+from logger import logger
+from config import FACE_MODEL_PATH, MICROBATCH_MAX_SIZE, PREPROCESS_WORKERS, SEG_DEVICE
+
+
+# @@ Shared memory transport ############################
+class SharedArray:
+    """ Picklable descriptor of an ndarray stored in shared memory. """
+    def __init__(self, name: str, shape: Tuple[int, ...], dtype: str):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+
+def put_shared(array: np.ndarray, name: Optional[str] = None) -> Tuple[SharedMemory, SharedArray]:
+    shm = SharedMemory(name=name, create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, SharedArray(shm.name, array.shape, array.dtype.str)
+
+
+def get_shared(desc: SharedArray) -> Tuple[SharedMemory, np.ndarray]:
+    """ Returns a view on the shared block, drop the view before closing the block. """
+    shm = SharedMemory(name=desc.name)
+    return shm, np.ndarray(desc.shape, dtype=np.dtype(desc.dtype), buffer=shm.buf)
+
+
+def release_shared(blocks: List[SharedMemory], unlink: bool = False):
+    for shm in blocks:
+        try:
+            shm.close()
+            if unlink:
+                shm.unlink()
+        except (BufferError, FileNotFoundError) as e:
+            logger.error(f"Error-shared_memory:{shm.name}::detail:{e}")
+
+
+def unlink_numbered(prefix: str):
+    """ Unlinks the blocks named "{prefix}_0", "{prefix}_1", ... up to the first missing one. """
+    for i in itertools.count():
+        try:
+            shm = SharedMemory(name=f"{prefix}_{i}")
+        except FileNotFoundError:
+            return
+        release_shared([shm], unlink=True)
+
+
+# @@ Worker process ############################
+_face_detector: face_preprocess.FaceDetector = None
+_head_segmenter: face_preprocess.HeadSegmenter = None
+
+
+def _init_worker(face_model_path: str, seg_device: str):
+    global _face_detector, _head_segmenter
+    _face_detector = face_preprocess.build_face_detector(face_model_path)
+    _head_segmenter = face_preprocess.build_head_segmenter(seg_device)
+
+
+def _ping() -> bool:
+    return True
+
+
+def _segment_in_worker(photo_descs: List[SharedArray], out_prefix: str) -> Tuple[List[Tuple[SharedArray, SharedArray]], Dict[str, float]]:
+    """ Encoded photos are read from shared memory and decoded here, outputs are written to new blocks owned by the caller.
+
+    Output blocks are numbered after out_prefix, so the caller can unlink them even when this fails half way.
+
+    Step timings are returned as well, metrics are only collected in the parent process.
+    """
+    in_blocks, photos = [], []
+    for desc in photo_descs:
+        shm, data = get_shared(desc)
+        in_blocks.append(shm)
+        photos.append(bytes(data))
+        del data
+
+    timings: Dict[str, float] = {}
+    heads = face_preprocess.segment_photos(photos, face_detector=_face_detector, head_segmenter=_head_segmenter, timings=timings)
+    out_blocks, out_descs = [], []
+    names = (f"{out_prefix}_{i}" for i in itertools.count())
+    for head in heads:
+        crop_shm, crop_desc = put_shared(head.crop, next(names))
+        mask_shm, mask_desc = put_shared(head.mask, next(names))
+        out_blocks += [crop_shm, mask_shm]
+        out_descs.append((crop_desc, mask_desc))
+
+    del photos, heads
+    release_shared(in_blocks)
+    # Closing only detaches this process, the caller unlinks after reading
+    release_shared(out_blocks)
+    return out_descs, timings
+
+
+# @@ Pool ############################
+class PreprocessPool:
+    """ Worker processes, each holding its own FaceDetector & HeadSegmenter. """
+    def __init__(self, workers: int, face_model_path: str = FACE_MODEL_PATH, seg_device: str = SEG_DEVICE):
+        self.workers = workers
+        # spawn: CUDA can not be re-initialized in a forked child
+        self.executor = ProcessPoolExecutor(max_workers=workers,
+                                            mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=_init_worker,
+                                            initargs=(face_model_path, seg_device))
+
+    async def warmup(self):
+        """ Spawn every worker and load its models before the first request. """
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, _ping) for _ in range(self.workers)])
+
+    async def segment_photos(self, photos: List[bytes]) -> List[SegmentedHead]:
+        """ Runs one order on a worker with its own models, the cross-order micro-batching does not apply. """
+        # Still encoded, the worker decodes only what detection & cropping need
+        shared = [put_shared(np.frombuffer(data, dtype=np.uint8)) for data in photos]
+        in_blocks = [shm for shm, _ in shared]
+        out_prefix = f"pp_{uuid.uuid4().hex[:16]}"
+        future = self.executor.submit(_segment_in_worker, [desc for _, desc in shared], out_prefix)
+        try:
+            out_descs, timings = await asyncio.wrap_future(future)
+            metrics.observe_stages(timings)
+            heads = []
+            for crop_desc, mask_desc in out_descs:
+                crop_shm, crop = get_shared(crop_desc)
+                mask_shm, mask = get_shared(mask_desc)
+                heads.append(SegmentedHead(crop=crop.copy(), mask=mask.copy()))
+                del crop, mask
+                release_shared([crop_shm, mask_shm])
+            return heads
+        finally:
+            release_shared(in_blocks, unlink=True)
+            # Also once a worker still running for a cancelled order is done, or after it failed half way
+            future.add_done_callback(lambda _: unlink_numbered(out_prefix))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+preprocess_pool: PreprocessPool = None
+
+
+def start(workers: int = PREPROCESS_WORKERS) -> PreprocessPool:
+    global preprocess_pool
+    if workers > 0:
+        preprocess_pool = PreprocessPool(workers)
+    return preprocess_pool
+
+
+def stop():
+    global preprocess_pool
+    detect_batcher.close()
+    segment_batcher.close()
+    if preprocess_pool is not None:
+        preprocess_pool.shutdown()
+        preprocess_pool = None
+
+
+# @@ In-process micro-batching ############################
+# Orders in flight share detection and segmentation batches, the models run one batch at a time
+detect_batcher = MicroBatcher("detect", lambda proxies: face_preprocess.face_detector.detect(proxies))
+segment_batcher = MicroBatcher("head_segment", lambda crops: face_preprocess.head_segmenter.segment_masks(crops))
+
+
+async def _segment_batched(photos: List[bytes]) -> List[SegmentedHead]:
+    """ "detect" & "head_segment" timings include the wait for the batch to fill. """
+    timings: Dict[str, float] = {}
+    start = time.perf_counter()
+    images, proxies = await asyncio.to_thread(face_preprocess.decode_proxies, photos)
+    timings["decode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = await detect_batcher.submit([proxy for proxy, _, _ in proxies])
+    timings["detect"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cropped_images = await asyncio.to_thread(face_preprocess.crop_detected, images, proxies, results)
+    timings["decode"] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    masks = await segment_batcher.submit(cropped_images)
+    timings["head_segment"] = time.perf_counter() - start
+    heads = await asyncio.to_thread(face_preprocess.clean_heads, cropped_images, masks, timings)
+    metrics.observe_stages(timings)
+    return heads
+
+
+async def segment_photos(photos: List[bytes]) -> List[SegmentedHead]:
+    """ Runs in the process pool when started, otherwise with the in-process models, micro-batched across orders.
+
+    The pool bypasses the micro-batching, set PREPROCESS_WORKERS=0 for cross-order batches.
+    """
+    if preprocess_pool is not None:
+        return await preprocess_pool.segment_photos(photos)
+    if MICROBATCH_MAX_SIZE > 0:
+        return await _segment_batched(photos)
+    timings: Dict[str, float] = {}
+    heads = await asyncio.to_thread(face_preprocess.segment_photos,
+                                    photos=photos,
+                                    face_detector=face_preprocess.face_detector,
+                                    head_segmenter=face_preprocess.head_segmenter,
+                                    timings=timings)
+    metrics.observe_stages(timings)
+    return heads
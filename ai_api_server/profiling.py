@@ -0,0 +1,161 @@
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+from logger import logger
+from config import PROFILE_INTERVAL_SEC, PROFILE_KEEP, TIMELINE_KEEP
+
+
+# @@ Timeline ############################
+class Timeline:
+    """ Spans & events of one order, offsets in seconds from the start of the order. """
+    def __init__(self, req_id: str):
+        self.req_id = req_id
+        self.started_at = time.time()
+        self.t0 = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self.events: List[Dict[str, Any]] = []
+        self.duration: Optional[float] = None
+
+    def add_span(self, name: str, start: float, end: float, **attrs):
+        self.spans.append({"name": name, "start": round(start - self.t0, 6), "end": round(end - self.t0, 6), **attrs})
+
+    def add_event(self, name: str, **attrs):
+        self.events.append({"name": name, "at": round(time.perf_counter() - self.t0, 6), **attrs})
+
+    def to_dict(self) -> dict:
+        return {"id": self.req_id, "startedAt": self.started_at, "duration": self.duration,
+                "spans": sorted(self.spans, key=lambda span: span["start"]), "events": self.events}
+
+
+_current: contextvars.ContextVar[Optional[Timeline]] = contextvars.ContextVar("timeline", default=None)
+_timelines: "OrderedDict[str, Timeline]" = OrderedDict()
+
+
+def describe(value: Any) -> Dict[str, int]:
+    """ Item count and byte size of a stage result, when they can be told cheaply. """
+    if isinstance(value, (bytes, str)):
+        return {"bytes": len(value)}
+    if isinstance(value, (list, tuple)):
+        info = {"count": len(value)}
+        nbytes = sum(len(item) for item in value if isinstance(item, (bytes, str)))
+        if nbytes:
+            info["bytes"] = nbytes
+        return info
+    return {}
+
+
+def record_span(name: str, start: float, end: float, **attrs):
+    timeline = _current.get()
+    if timeline is not None:
+        timeline.add_span(name, start, end, **attrs)
+
+
+def record_event(name: str, **attrs):
+    timeline = _current.get()
+    if timeline is not None:
+        timeline.add_event(name, **attrs)
+
+
+def get_timeline(req_id: str) -> Optional[dict]:
+    timeline = _timelines.get(req_id)
+    return timeline.to_dict() if timeline is not None else None
+
+
+# @@ Sampling profiler ############################
+class ProfileArm:
+    """ Profile the next "remaining" orders, until "deadline" if given. """
+    def __init__(self):
+        self.remaining = 0
+        self.deadline: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def arm(self, requests: int = 1, seconds: Optional[float] = None):
+        with self._lock:
+            self.remaining = max(0, requests)
+            self.deadline = time.time() + seconds if seconds else None
+
+    def disarm(self):
+        self.arm(0)
+
+    @property
+    def armed(self) -> bool:
+        if self.remaining <= 0:
+            return False
+        if self.deadline is not None and time.time() > self.deadline:
+            self.remaining = 0
+            return False
+        return True
+
+    def take(self) -> bool:
+        # Unlocked fast path, nothing is paid while disarmed
+        if self.remaining <= 0:
+            return False
+        with self._lock:
+            if not self.armed:
+                return False
+            self.remaining -= 1
+            return True
+
+    def to_dict(self) -> dict:
+        return {"armed": self.armed, "remaining": self.remaining, "deadline": self.deadline,
+                "profiles": list(_profiles.keys())}
+
+
+profile_arm = ProfileArm()
+_profiles: "OrderedDict[str, Any]" = OrderedDict()    # req_id -> pyinstrument Session
+
+
+def render_profile(req_id: str, fmt: str = "speedscope") -> Optional[str]:
+    """
+    Args:
+        fmt (str, optional): "speedscope" (JSON for speedscope.app) or "html" (flamegraph-like call tree). Defaults to "speedscope".
+    """
+    session = _profiles.get(req_id)
+    if session is None:
+        return None
+    from pyinstrument.renderers import HTMLRenderer, SpeedscopeRenderer
+    renderer = HTMLRenderer() if fmt == "html" else SpeedscopeRenderer()
+    return renderer.render(session)
+
+
+def _keep(store: OrderedDict, key: str, value: Any, limit: int):
+    store[key] = value
+    store.move_to_end(key)
+    while len(store) > limit:
+        store.popitem(last=False)
+
+
+@contextmanager
+def capture(req_id: str) -> Iterator[Optional[Timeline]]:
+    """ Timeline of the order, plus a sampling profile when armed.
+
+    Only the coroutines of the order are sampled (async context aware),
+    work offloaded to threads or the preprocess pool shows up as await time.
+    """
+    timeline = Timeline(req_id) if TIMELINE_KEEP > 0 else None
+    token = _current.set(timeline)
+    profiler = None
+    if profile_arm.take():
+        try:
+            from pyinstrument import Profiler
+            profiler = Profiler(interval=PROFILE_INTERVAL_SEC, async_mode="enabled")
+            profiler.start()
+        except Exception as e:
+            logger.error(f"Error-profiling:start:{req_id}::detail:{e}")
+            profiler = None
+    try:
+        yield timeline
+    finally:
+        if profiler is not None:
+            try:
+                _keep(_profiles, req_id, profiler.stop(), PROFILE_KEEP)
+                logger.info(f"profiling:captured:{req_id}")
+            except Exception as e:
+                logger.error(f"Error-profiling:stop:{req_id}::detail:{e}")
+        if timeline is not None:
+            timeline.duration = round(time.perf_counter() - timeline.t0, 6)
+            _keep(_timelines, req_id, timeline, TIMELINE_KEEP)
+        _current.reset(token)
@@ -1,103 +1,68 @@
 import asyncio
-import traceback
 import aio_pika
 import json
 import datetime
-from api import build_face_model, webui_t2i
-import cloud_utils
-from cloud_utils import db_client
-import face_preprocess
+from cloud_utils import get_db_client
 import utils
-from dto import Background, ProcessErrorParam, ProcessRequestParam, ProcessResponseParam
+import metrics
+from admission import admission_controller
+from dto import ProcessErrorParam, ProcessRequestParam
+from workflow import run_profile_pipeline
 from aiormq import DeliveryError
 from logger import logger
-from config import BUCKET_PREFIX, RMQ_HOST, RMQ_PORT, RMQ_PWD, RMQ_QUEUE, RMQ_USER, WEBUI_URL
-CONCUR_LIMIT = 1
+from config import RMQ_HOST, RMQ_PORT, RMQ_PREFETCH, RMQ_PWD, RMQ_QUEUE, RMQ_USER
 
 async def process_message(
     message: aio_pika.IncomingMessage,
+) -> None:
+    metrics.RMQ_INFLIGHT.inc()
+    try:
+        admitted, _ = admission_controller.check()
+        if not admitted:
+            # Held unacked, so the broker stops delivering once the prefetch is used up
+            metrics.ADMISSION_DEFERRED.labels("rmq").inc()
+            if not await admission_controller.wait_admitted():
+                # Back to the queue, another consumer or a later delivery may take it
+                logger.warning("Admission:held too long::requeued")
+                await message.nack(requeue=True)
+                return
+        await _process_message(message)
+    finally:
+        metrics.RMQ_INFLIGHT.dec()
+
+async def _process_message(
+    message: aio_pika.IncomingMessage,
 ) -> None:
     async with message.process(ignore_processed=True, reject_on_redelivered=True):
-        logger.debug(f"RECV: {message.body}")
+        # Formatted only if debug is enabled, in the logging thread
+        logger.debug("RECV: %s", message.body)
+        req_id = None
         try:
             json_body = json.loads(message.body)
             req_payload = ProcessRequestParam.validate(json_body)
             req_id = req_payload.id
             # TODO: override webui params
 
-            # GCS get images
-            succ, src_imgs = cloud_utils.download_image_from_gcs(req_payload.imagePaths)
-            if not succ:
-                logger.error(f"Error::id:{req_id}::detail:DownloadFail")
-                raise Exception("DownloadFail")
-
-            result = []
-            for bg in Background:
-                # Preprocess images
-                processed_images =  face_preprocess.preprocess_image(images=src_imgs, 
-                                                    bg=bg,
-                                                    face_detector=face_preprocess.face_detector, 
-                                                    head_segmenter=face_preprocess.head_segmenter)
-
-                # For first iteration
-                if bg == Background.CRIMSON:
-                    succ, response = await build_face_model(img_list=processed_images, model_name=req_id)
-                    if not succ:
-                        raise Exception(f"RequestBuildFaceFail:{response}")
-
-                # T2I
-                sampled_img_str_list = utils.sample_imgs([utils.encodeImg2Base64(img) for img in processed_images])
-                succ, t2i_result = await webui_t2i(gender=req_payload.param.gender, 
-                                            background=bg, 
-                                            batch_size=2 if bg == Background.IVORY else 3,
-                                            model_name=req_id,
-                                            ip_imgs=sampled_img_str_list, 
-                                            hair=req_payload.param.hair,
-                                            glasses=req_payload.param.glasses,
-                                            # reactor_img=utils.sample_one_img(sampled_img_str_list)
-                                            )
-                if not succ:
-                    logger.error(f"Error::id:{req_id}::detail:{t2i_result}")
-                    raise Exception(f"{t2i_result}")
-                result += utils.merge_frame(t2i_result, bg)
-
-            # GCS upload images
-            img_names = [f"{req_id}/{i}.png" for i in range(1,len(result)+1)]
-            upload_succ = cloud_utils.upload_image_to_gcs(result, img_names)
-            if not upload_succ:
-                logger.error(f"Error:{req_id}::detail:UploadFail")
-                raise Exception("UploadFail")
-
-            # DB response
-            FORMAT_DATE = datetime.date.today().strftime("%Y-%m-%d")
-            response = ProcessResponseParam(id=req_id, 
-                                   email=req_payload.email, 
-                                   imagePaths=[ f"{BUCKET_PREFIX}/{FORMAT_DATE}/{img}" for img in img_names],
-                                   requestedAt=req_payload.requestedAt,
-                                   createdAt=datetime.datetime.now(),
-                                   title=req_payload.title,
-                                   userId=req_payload.userId)
-            await db_client.collection("profile_responses").document(req_id).set(response.dict())
+            await run_profile_pipeline(req_payload, write_db=True)
             logger.info(f"Success:{req_id}")
+            metrics.count_order("rmq")
 
         except Exception as e:
+            metrics.count_order("rmq", e)
             await message.reject(requeue=False)
             if req_id is not None:
-                logger.error(f"Error:{req_payload.id}::detail:{e} : {traceback.format_exc()}")
+                logger.error(f"Error:{req_payload.id}::detail:{e}", exc_info=True)
                 response = ProcessErrorParam(id=req_payload.id, 
                                             createdAt=datetime.datetime.now(),
                                             error=str(e) if e is not None else "Unknown",)
-                await db_client.collection("profile_errors").document(req_id).set(response.dict())
-                await utils.requestPostAsyncData("https://ntfy.sh/horangstudio-engine",
-                    payload=f"ProcessException id: {req_payload.id} 🔥\ndetail: {e}".encode(encoding='utf-8'))
+                await get_db_client().collection("profile_errors").document(req_id).set(response.dict())
+                await utils.notifyAsync(f"ProcessException id: {req_payload.id} 🔥\ndetail: {e}")
             else:
-                logger.error(f"Error:InvalidMsgFmt::detail:{message.body} : {traceback.format_exc()}")
-                await utils.requestPostAsyncData("https://ntfy.sh/horangstudio-engine",
-                    payload=f"ProcessException id: unknown 🔥\ndetail: {e}".encode(encoding='utf-8'))
+                logger.error("Error:InvalidMsgFmt::detail:%s", message.body, exc_info=True)
+                await utils.notifyAsync(f"ProcessException id: unknown 🔥\ndetail: {e}")
         except:
             await message.reject(requeue=False)
-            await utils.requestPostAsyncData("https://ntfy.sh/horangstudio-engine",
-                payload=f"ProcessError id: {req_id} 🔥\ndetail: unknown".encode(encoding='utf-8'))
+            await utils.notifyAsync(f"ProcessError id: {req_id} 🔥\ndetail: unknown")
         # @ TODO @@ Inner catch does not on occur outer exception
         # @ TODO @@ Issue publish_message not working 
 
@@ -111,14 +76,14 @@ async def setup_queue(loop: asyncio.AbstractEventLoop) -> None:
             loop=loop
         )
         channel = await connection.channel()
-        await channel.set_qos(prefetch_count=CONCUR_LIMIT)
+        await channel.set_qos(prefetch_count=RMQ_PREFETCH)
+        metrics.RMQ_PREFETCH.set(RMQ_PREFETCH)
         queue = await channel.declare_queue(RMQ_QUEUE, auto_delete=False, durable=True, arguments={"x-max-priority": 10})
         logger.info(f"Connected to RMQ: {RMQ_HOST}:{RMQ_PORT}:{RMQ_QUEUE}")
         await queue.consume(process_message)
 
     except Exception as e:
-        datetime_str = datetime.now().strftime("%Y%m%d-%H:%M:%S")
-        logger.error(f"{datetime_str} SetupRMQ: {e} {traceback.format_exc()}")
+        logger.error(f"SetupRMQ: {e}", exc_info=True)
 
     try:
         await asyncio.Future()
@@ -0,0 +1,176 @@
+""" ONNX export, int8 quantization and accuracy check of the head segmentation network.
+
+    python ai_api_server/segmenter_export.py                                   # fp32 artifact
+    python ai_api_server/segmenter_export.py --quantize dynamic --check crops/
+    python ai_api_server/segmenter_export.py --quantize static --calibration crops/ --check crops/
+
+--check compares the masks of the exported model with the eager PyTorch ones on head crops
+(the images "HeadSegmenter.segment_masks" receives) and fails below --min-iou.
+"""
+import argparse
+import glob
+import os
+import sys
+from typing import Dict, List, Optional
+import cv2
+import numpy as np
+from logger import logger
+from config import HEAD_SEGMENTER_ONNX_PATH, HEAD_SEGMENTER_QUANTIZE
+
+# albumentations Resize + Normalize of head_segmentation's PreprocessingPipeline
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+OPSET = 17
+
+
+# @@ Preprocessing ############################
+def preprocess(images: List[np.ndarray], resolution: int) -> np.ndarray:
+    """ NumPy version of HumanHeadSegmentationPipeline._preprocess_image, stacked to NCHW float32. """
+    batch = np.empty((len(images), resolution, resolution, 3), dtype=np.float32)
+    for i, image in enumerate(images):
+        batch[i] = cv2.resize(image[..., :3], (resolution, resolution), interpolation=cv2.INTER_LINEAR)
+    batch = (batch / 255.0 - MEAN) / STD
+    return np.ascontiguousarray(batch.transpose(0, 3, 1, 2), dtype=np.float32)
+
+
+def artifact_path(path: str = HEAD_SEGMENTER_ONNX_PATH, quantize: str = HEAD_SEGMENTER_QUANTIZE) -> str:
+    """ "model.onnx" for fp32, "model.int8.onnx" for a quantized artifact. """
+    if not quantize:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.int8{ext}"
+
+
+def _atomic_target(path: str) -> str:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return f"{path}.{os.getpid()}.tmp"
+
+
+# @@ Export ############################
+def export_onnx(path: str = HEAD_SEGMENTER_ONNX_PATH) -> str:
+    """ Trace the eager network once on CPU with a dynamic batch axis. Needs torch & head_segmentation. """
+    import torch
+    import head_segmentation.segmentation_pipeline as seg_pipeline
+    pipeline = seg_pipeline.HumanHeadSegmentationPipeline(device="cpu")
+    model = pipeline._model.eval()
+    probe = np.random.default_rng(0).integers(0, 256, size=(300, 240, 3), dtype=np.uint8)
+    with torch.inference_mode():
+        reference = pipeline._preprocess_image(probe).cpu().numpy()
+    resolution = reference.shape[-1]
+    # The runtime preprocesses in NumPy, refuse to export if it drifted from the pipeline's
+    drift = float(np.abs(preprocess([probe], resolution) - reference.reshape(1, 3, resolution, resolution)).max())
+    if drift > 1e-2:
+        raise RuntimeError(f"Head segmentation preprocessing differs from the pipeline, max abs diff {drift:.4f}")
+
+    import onnx
+    tmp_path = _atomic_target(path)
+    dummy = torch.zeros((1, 3, resolution, resolution))
+    torch.onnx.export(model, dummy, tmp_path, input_names=["image"], output_names=["logits"],
+                      dynamic_axes={"image": {0: "batch"}, "logits": {0: "batch"}}, opset_version=OPSET)
+    exported = onnx.load(tmp_path)
+    exported.metadata_props.add(key="resolution", value=str(resolution))
+    onnx.save(exported, tmp_path)
+    os.replace(tmp_path, path)
+    logger.info(f"Head segmenter exported:{path}")
+    return path
+
+
+class CalibrationReader:
+    """ onnxruntime CalibrationDataReader over head crops, one image per batch. """
+    def __init__(self, images: List[np.ndarray], resolution: int, input_name: str):
+        self._batches = iter([{input_name: preprocess([image], resolution)} for image in images])
+
+    def get_next(self) -> Optional[Dict[str, np.ndarray]]:
+        return next(self._batches, None)
+
+
+def quantize_int8(src: str, dst: str, mode: str = "dynamic", calibration: Optional[List[np.ndarray]] = None) -> str:
+    """
+    Args:
+        mode (str): "dynamic" quantizes weights only, "static" activations as well and needs calibration images.
+    """
+    import onnx
+    from onnxruntime import quantization
+    tmp_path = _atomic_target(dst)
+    if mode == "static":
+        if not calibration:
+            raise ValueError("Static quantization needs calibration images")
+        model = onnx.load(src)
+        resolution = int({prop.key: prop.value for prop in model.metadata_props}["resolution"])
+        reader = CalibrationReader(calibration, resolution, model.graph.input[0].name)
+        quantization.quantize_static(src, tmp_path, reader, quant_format=quantization.QuantFormat.QDQ,
+                                     activation_type=quantization.QuantType.QUInt8, weight_type=quantization.QuantType.QInt8,
+                                     per_channel=True)
+    elif mode == "dynamic":
+        quantization.quantize_dynamic(src, tmp_path, weight_type=quantization.QuantType.QInt8)
+    else:
+        raise ValueError(f"Unknown quantization mode: {mode}")
+    os.replace(tmp_path, dst)
+    logger.info(f"Head segmenter quantized:{mode}:{dst}")
+    return dst
+
+
+def ensure_artifact(path: str = HEAD_SEGMENTER_ONNX_PATH, quantize: str = HEAD_SEGMENTER_QUANTIZE) -> str:
+    """ Cached artifact for the runtime, exported (& dynamically quantized) on first use. """
+    target = artifact_path(path, quantize)
+    if os.path.exists(target):
+        return target
+    if not os.path.exists(path):
+        export_onnx(path)
+    if quantize:
+        quantize_int8(path, target, "dynamic")
+    return target
+
+
+# @@ Accuracy ############################
+def mask_iou(a: np.ndarray, b: np.ndarray) -> float:
+    union = np.logical_or(a, b).sum()
+    return float(np.logical_and(a, b).sum() / union) if union else 1.0
+
+
+def compare_masks(reference, candidate, images: List[np.ndarray]) -> Dict[str, float]:
+    """ IoU of candidate.segment_masks against reference.segment_masks, e.g. exported vs eager. """
+    ious = [mask_iou(a, b) for a, b in zip(reference.segment_masks(images), candidate.segment_masks(images))]
+    return {"images": len(ious), "mean_iou": float(np.mean(ious)), "min_iou": float(np.min(ious))}
+
+
+def load_images(image_dir: str) -> List[np.ndarray]:
+    paths = sorted(path for ext in ("jpg", "jpeg", "png") for path in glob.glob(os.path.join(image_dir, f"*.{ext}")))
+    return [cv2.cvtColor(cv2.imread(path, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB) for path in paths]
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default=HEAD_SEGMENTER_ONNX_PATH, help="fp32 artifact path")
+    parser.add_argument("--quantize", choices=["", "dynamic", "static"], default="")
+    parser.add_argument("--calibration", help="Directory of head crops for static quantization")
+    parser.add_argument("--check", help="Directory of head crops to compare against the eager model")
+    parser.add_argument("--min-iou", type=float, default=0.95, help="Minimum mean IoU for --check")
+    parser.add_argument("--force", action="store_true", help="Re-export even if the artifact exists")
+    args = parser.parse_args(argv)
+
+    if args.force or not os.path.exists(args.output):
+        export_onnx(args.output)
+    target = args.output
+    if args.quantize:
+        target = artifact_path(args.output, args.quantize)
+        calibration = load_images(args.calibration) if args.calibration else None
+        quantize_int8(args.output, target, args.quantize, calibration)
+    print(f"artifact: {target}")
+
+    if args.check:
+        import face_preprocess
+        images = load_images(args.check)
+        if not images:
+            print(f"No images in {args.check}")
+            return 1
+        result = compare_masks(face_preprocess.HeadSegmenter("cpu"), face_preprocess.OrtHeadSegmenter(target), images)
+        print(f"images: {result['images']}, mean IoU: {result['mean_iou']:.4f}, min IoU: {result['min_iou']:.4f}")
+        if result["mean_iou"] < args.min_iou:
+            print(f"Mean IoU below {args.min_iou}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,26 +1,125 @@
 import asyncio
+import sys
+import time
 from contextlib import asynccontextmanager
+from typing import Callable, Dict, Optional
 from fastapi import FastAPI
-import torch
-from cloud_utils import download_face_model
+from cloud_utils import download_face_model, get_db_client
+import api
 import face_preprocess
+import preprocess_pool
+import utils
+from checkpoint import checkpoint_store
+from logger import logger
+from webui_pool import webui_pool
+from config import FACE_MODEL_PATH, PREPROCESS_WORKERS, RMQ_HOST, SEG_DEVICE
 from rmq_app import setup_queue
 
+
+class StartupState:
+    """ Readiness of the service, "/api/health" answers 503 until every phase is done. """
+    def __init__(self):
+        self.ready = False
+        self.error: Optional[str] = None
+        self.started_at = time.perf_counter()
+        self.timings: Dict[str, float] = {}
+        self._ready_event: Optional[asyncio.Event] = None
+
+    @property
+    def ready_event(self) -> asyncio.Event:
+        if self._ready_event is None:
+            self._ready_event = asyncio.Event()
+        return self._ready_event
+
+    async def wait_ready(self):
+        await self.ready_event.wait()
+
+    def to_dict(self) -> dict:
+        return {"ready": self.ready, "error": self.error,
+                "phases": {name: round(sec, 3) for name, sec in self.timings.items()}}
+
+
+startup_state = StartupState()
+
+
+async def phase(name: str, fn: Callable, *args):
+    """ Run a blocking startup step in a thread and record its duration. """
+    start = time.perf_counter()
+    try:
+        return await asyncio.to_thread(fn, *args)
+    finally:
+        startup_state.timings[name] = time.perf_counter() - start
+
+
+async def load_face_detector():
+    await phase("download_face_model", download_face_model)
+    face_preprocess.face_detector = await phase("face_detector", face_preprocess.build_face_detector, FACE_MODEL_PATH)
+
+
+async def load_head_segmenter():
+    face_preprocess.head_segmenter = await phase("head_segmenter", face_preprocess.build_head_segmenter, SEG_DEVICE)
+
+
+async def start_preprocess_pool():
+    await phase("download_face_model", download_face_model)
+    # Models live in the worker processes only
+    start = time.perf_counter()
+    await preprocess_pool.start(PREPROCESS_WORKERS).warmup()
+    startup_state.timings["preprocess_pool"] = time.perf_counter() - start
+
+
 async def on_startup(loop):
-    download_face_model()
-    face_preprocess.face_detector = face_preprocess.FaceDetector('yolov8n-face.onnx')
-    face_preprocess.head_segmenter = face_preprocess.HeadSegmenter('cuda')
-    asyncio.create_task(setup_queue(loop))
+    utils.openHttpClients()
+    # Independent phases overlap, model loading mostly waits on I/O and native code
+    steps = [
+        phase("frames", utils.frame_store.load),
+        phase("presets", api.load_presets),
+        phase("db_client", get_db_client),
+    ]
+    if checkpoint_store is not None:
+        steps.append(phase("checkpoint_sweep", checkpoint_store.sweep))
+    if PREPROCESS_WORKERS > 0:
+        steps.append(start_preprocess_pool())
+    else:
+        steps += [load_face_detector(), load_head_segmenter()]
+    await asyncio.gather(*steps)
+
+    webui_pool.start_probing()
+    if RMQ_HOST:
+        asyncio.create_task(setup_queue(loop))
+
+
+async def run_startup(loop):
+    try:
+        await on_startup(loop)
+        startup_state.ready = True
+    except Exception as e:
+        startup_state.error = f"{type(e).__name__}: {e}"
+        logger.error(f"Error-startup::detail:{startup_state.error}")
+        raise
+    finally:
+        startup_state.timings["total"] = time.perf_counter() - startup_state.started_at
+        logger.info("Startup:" + ", ".join(f"{name}={sec:.2f}s" for name, sec in startup_state.timings.items()))
+        startup_state.ready_event.set()
 
 
 def on_shutdown():
-    del face_preprocess.face_detector, face_preprocess.head_segmenter
-    if torch.cuda.is_available():
+    preprocess_pool.stop()
+    face_preprocess.face_detector, face_preprocess.head_segmenter = None, None
+    # Only if a model actually imported torch
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
         torch.cuda.empty_cache()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     loop = asyncio.get_event_loop()
-    await on_startup(loop)
+    # Serve right away, health reports unready until the models are warm
+    startup_task = asyncio.create_task(run_startup(loop))
     yield
-    on_shutdown()
\ No newline at end of file
+    if not startup_task.done():
+        startup_task.cancel()
+    await asyncio.gather(startup_task, return_exceptions=True)
+    on_shutdown()
+    await webui_pool.stop_probing()
+    await utils.closeHttpClients()
@@ -1,12 +1,20 @@
 import os
 import io
+import hashlib
+import threading
+import time
+import weakref
+from collections import OrderedDict
 from PIL import Image
-from typing import List
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 import httpx
 import base64
+import json
+from json_stream import Base64ArrayExtractor
+import metrics
 from dto import Background
 from logger import logger
-from config import TIMEOUT_SEC, PRESET_DIR, ROUND_MASK_PATH, MASK_PATH, FRAME_PATH
+from config import TIMEOUT_SEC, PRESET_DIR, ROUND_MASK_PATH, MASK_PATH, FRAME_PATH, HTTP_KEEPALIVE_SEC, HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE, NOTIFY_TIMEOUT_SEC, NOTIFY_URL, STATUS_TIMEOUT_SEC, WEBUI_UDS, ENCODE_CACHE_SIZE, ASSET_CACHE_DIR, IMG_JPEG_QUALITY, IMG_PNG_COMPRESS_LEVEL, IMG_WIRE_FORMAT
 import random
 from fastapi import HTTPException
 
@@ -31,77 +39,250 @@ def convertStrList2Img(img_str_list: List[str]) -> List[Image.Image]:
     return res
 
 
-async def checkSuccessGetAsync(url):
-    async with httpx.AsyncClient() as client:
-        try:
-            # Send async GET request to the external API
-            response = await client.get(url)
-
-            # Check if the request was successful (status code 200)
-            if response.status_code // 100 == 2:
-                return True
-        except httpx.RequestError as e:
-            logger.error(f"Error - simple_req - url: {url} - detail: {e}")
-        return False
-
-
-async def requestGetAsync(url):
-    async with httpx.AsyncClient() as client:
-        try:
-            # Send async GET request to the external API
-            response = await client.get(url)
-
-            # Check if the request was successful (status code 200)
-            if response.status_code // 100 == 2:
-                data = response.json()  # Parse JSON response
-                return data
-            else:
-                return {"error": "Failed to retrieve data from external API"}
-        except httpx.RequestError as e:
-            return {"error": f"Request error: {e}"}
-
-
-async def requestPostAsync(url, payload):
-    async with httpx.AsyncClient(verify=False) as client:
-        try:
-            # Send async POST request to the external API
-            response = await client.post(url, json=payload, timeout=httpx.Timeout(TIMEOUT_SEC))
-
-            # Check if the request was successful (status code 200)
-            if response.status_code // 100 == 2:
-                data = response.json()  # Parse JSON response
-                return (True, data)
-            else:
+# @@ HTTP Client ############################
+_http_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def _build_http_client(name: str) -> httpx.AsyncClient:
+    limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                          max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                          keepalive_expiry=HTTP_KEEPALIVE_SEC)
+    if name == "webui" and WEBUI_UDS:
+        # Co-located WebUI, host part of the url is ignored
+        transport = httpx.AsyncHTTPTransport(uds=WEBUI_UDS, limits=limits, verify=False)
+        return httpx.AsyncClient(transport=transport, verify=False)
+    return httpx.AsyncClient(limits=limits, verify=False)
+
+
+def getHttpClient(name: str = "default") -> httpx.AsyncClient:
+    """ Long-lived client per backend, "webui" for WebUI calls and "default" for the rest. """
+    client = _http_clients.get(name)
+    if client is None or client.is_closed:
+        client = _build_http_client(name)
+        _http_clients[name] = client
+    return client
+
+
+def openHttpClients():
+    for name in ("webui", "default"):
+        getHttpClient(name)
+
+
+async def closeHttpClients():
+    clients = list(_http_clients.values())
+    _http_clients.clear()
+    for client in clients:
+        await client.aclose()
+
+
+async def checkSuccessGetAsync(url, timeout=STATUS_TIMEOUT_SEC, client_name="webui"):
+    client = getHttpClient(client_name)
+    try:
+        # Send async GET request to the external API
+        response = await client.get(url, timeout=httpx.Timeout(timeout))
+
+        # Check if the request was successful (status code 200)
+        if response.status_code // 100 == 2:
+            return True
+    except httpx.RequestError as e:
+        logger.error(f"Error - simple_req - url: {url} - detail: {e}")
+    return False
+
+
+async def requestGetAsync(url, timeout=STATUS_TIMEOUT_SEC, client_name="webui"):
+    client = getHttpClient(client_name)
+    try:
+        # Send async GET request to the external API
+        response = await client.get(url, timeout=httpx.Timeout(timeout))
+
+        # Check if the request was successful (status code 200)
+        if response.status_code // 100 == 2:
+            data = response.json()  # Parse JSON response
+            return data
+        else:
+            return {"error": "Failed to retrieve data from external API"}
+    except httpx.RequestError as e:
+        return {"error": f"Request error: {e}"}
+
+
+class ServerError(Exception):
+    """ 5xx response, or a 2xx one without its payload. The backend failed rather than rejected the request. """
+    def __init__(self, status_code: int, detail):
+        super().__init__(f"{status_code}:{detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _error_detail(status_code: int, body: bytes):
+    """ Decoded body of a non-2xx response, wrapped in ServerError for 5xx. """
+    try:
+        detail = json.loads(body)
+    except ValueError:
+        detail = body.decode("utf-8", errors="replace")
+    return ServerError(status_code, detail) if status_code >= 500 else detail
+
+
+async def requestPostAsync(url, payload, timeout=TIMEOUT_SEC, client_name="webui"):
+    """
+    Returns:
+        tuple[bool, Any]: (True, JSON body) or (False, error detail). The detail is the httpx.RequestError
+            of a transport failure or timeout, a ServerError for 5xx, else the decoded body.
+    """
+    client = getHttpClient(client_name)
+    try:
+        # Send async POST request to the external API
+        response = await client.post(url, json=payload, timeout=httpx.Timeout(timeout))
+
+        # Check if the request was successful (status code 200)
+        if response.status_code // 100 == 2:
+            data = response.json()  # Parse JSON response
+            return (True, data)
+        else:
+            logger.error("Error-"+"POST-" + "url:" + url + "-" +"detail:"+str(response))
+            return (False, _error_detail(response.status_code, response.content))
+    except httpx.RequestError as e:
+        logger.error("Error-"+"POST-" + "url:" + url + "-" +"detail:"+str(e))
+        return (False, e)
+
+async def requestPostAsyncStream(url, payload, on_item: Callable[[int, bytes], Awaitable[None]], key="images", timeout=TIMEOUT_SEC, client_name="webui",
+                                 expected: Optional[int] = None):
+    """ POST and decode the base64 strings of response[key] one by one while the body streams in.
+
+    Args:
+        on_item (Callable): Awaited with (index, decoded bytes) as soon as each item is complete.
+        expected (int, optional): # of items the response must hold. Defaults to None, at least one.
+
+    Returns:
+        tuple[bool, int | Any]: (True, # of items) or (False, error detail), see "requestPostAsync". A response
+            without the expected items fails with a ServerError.
+    """
+    client = getHttpClient(client_name)
+    try:
+        async with client.stream("POST", url, json=payload, timeout=httpx.Timeout(timeout)) as response:
+            if response.status_code // 100 != 2:
+                body = await response.aread()
                 logger.error("Error-"+"POST-" + "url:" + url + "-" +"detail:"+str(response))
-                return (False, response.json())
-        except httpx.RequestError as e:
-            logger.error("Error-"+"POST-" + "url:" + url + "-" +"detail:"+str(e))
-            return (False, e)
-
-async def requestPostAsyncData(url, payload):
-    async with httpx.AsyncClient(verify=False) as client:
-        try:
-            # Send async POST request to the external API
-            response = await client.post(url, data=payload, timeout=httpx.Timeout(TIMEOUT_SEC))
-
-            # Check if the request was successful (status code 200)
-            if response.status_code // 100 == 2:
-                data = response.json()  # Parse JSON response
-                return (True, data)
-            else:
-                logger.error("Error-"+"POST-" + "url:" + url + "-" +"detail:"+str(response))
-                return (False, response.json())
-        except httpx.RequestError as e:
-            logger.error("Error-"+"POST-" + "url:" + url + "-" +"detail:"+str(e))
-            return (False, e)
-
-
-def encodeImg2Base64(img: Image.Image) -> str:
+                return (False, _error_detail(response.status_code, body))
+
+            extractor = Base64ArrayExtractor(key)
+            count = 0
+            async for chunk in response.aiter_bytes():
+                for item in extractor.feed(chunk):
+                    await on_item(count, item)
+                    count += 1
+            if count == 0 or (expected is not None and count != expected):
+                detail = ServerError(response.status_code, f"{count} of {expected or 'any'} items in \"{key}\"")
+                logger.error("Error-"+"POST-" + "url:" + url + "-" +"detail:"+str(detail))
+                return (False, detail)
+            return (True, count)
+    except httpx.RequestError as e:
+        logger.error("Error-"+"POST-" + "url:" + url + "-" +"detail:"+str(e))
+        return (False, e)
+
+async def requestPostAsyncData(url, payload, timeout=NOTIFY_TIMEOUT_SEC, client_name="default"):
+    client = getHttpClient(client_name)
+    try:
+        # Send async POST request to the external API
+        response = await client.post(url, data=payload, timeout=httpx.Timeout(timeout))
+
+        # Check if the request was successful (status code 200)
+        if response.status_code // 100 == 2:
+            data = response.json()  # Parse JSON response
+            return (True, data)
+        else:
+            logger.error("Error-"+"POST-" + "url:" + url + "-" +"detail:"+str(response))
+            return (False, response.json())
+    except httpx.RequestError as e:
+        logger.error("Error-"+"POST-" + "url:" + url + "-" +"detail:"+str(e))
+        return (False, e)
+
+
+async def notifyAsync(message: str):
+    """ Alert to NOTIFY_URL (ntfy topic), skipped when unset. """
+    if not NOTIFY_URL:
+        return (False, None)
+    return await requestPostAsyncData(NOTIFY_URL, payload=message.encode(encoding='utf-8'))
+
+
+def encodeImg2Base64(img: Image.Image, fmt: str = "png") -> str:
+    """
+    Args:
+        img (Image.Image):
+        fmt (str, optional): "png", lossless "webp" or "jpeg". Defaults to "png".
+
+    Returns:
+        str: base64 encoded image.
+    """
     image_bytes = io.BytesIO()
-    img.save(image_bytes, format="PNG")
-    image_bytes.seek(0)
-
-    return base64.b64encode(image_bytes.read()).decode("utf-8")
+    if fmt == "webp":
+        img.save(image_bytes, format="WEBP", lossless=True)
+    elif fmt == "jpeg":
+        img.convert("RGB").save(image_bytes, format="JPEG", quality=IMG_JPEG_QUALITY, subsampling=0)
+    else:
+        img.save(image_bytes, format="PNG", compress_level=IMG_PNG_COMPRESS_LEVEL)
+
+    return base64.b64encode(image_bytes.getbuffer()).decode("utf-8")
+
+
+_encode_cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+_digest_by_id: Dict[int, Tuple[weakref.ref, str]] = {}
+_encode_lock = threading.Lock()
+
+
+def imageDigest(img: Image.Image) -> str:
+    """ Content hash, remembered per live image object so each image is hashed once. Called from worker threads. """
+    entry = _digest_by_id.get(id(img))
+    if entry is not None and entry[0]() is img:
+        return entry[1]
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(f"{img.mode}{img.size}".encode())
+    hasher.update(img.tobytes())
+    digest = hasher.hexdigest()
+    key = id(img)
+    _digest_by_id[key] = (weakref.ref(img, lambda _: _digest_by_id.pop(key, None)), digest)
+    return digest
+
+
+def encodeImgCached(img: Image.Image, fmt: str = IMG_WIRE_FORMAT) -> str:
+    """ encodeImg2Base64 memoized on image content, LRU bounded by ENCODE_CACHE_SIZE. """
+    key = (imageDigest(img), fmt)
+    with _encode_lock:
+        if key in _encode_cache:
+            _encode_cache.move_to_end(key)
+            return _encode_cache[key]
+    start = time.perf_counter()
+    encoded = encodeImg2Base64(img, fmt)
+    metrics.STAGE_SECONDS.labels("encode").observe(time.perf_counter() - start)
+    with _encode_lock:
+        _encode_cache[key] = encoded
+        while len(_encode_cache) > ENCODE_CACHE_SIZE:
+            _encode_cache.popitem(last=False)
+    return encoded
+
+
+def encodeFileCached(path: str, cache_dir: str = ASSET_CACHE_DIR) -> str:
+    """ encodeImg2Base64 of an image file, kept on disk under the digest of the file content. """
+    with open(path, "rb") as f:
+        data = f.read()
+    if not cache_dir:
+        return encodeImg2Base64(Image.open(io.BytesIO(data)))
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    cache_path = os.path.join(cache_dir, f"{os.path.basename(path)}.{digest}.png.b64")
+    try:
+        with open(cache_path, "r") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    encoded = encodeImg2Base64(Image.open(io.BytesIO(data)))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(encoded)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.error(f"Error-asset_cache:{cache_path}::detail:{e}")
+    return encoded
 
 
 def decodeBase642Img(base64_str: str)-> Image.Image:
@@ -109,6 +290,12 @@ def decodeBase642Img(base64_str: str)-> Image.Image:
     image_bytes_io = io.BytesIO(decoded_bytes)
     return Image.open(image_bytes_io)
 
+def decodeImgBytes(img_bytes: bytes) -> Image.Image:
+    """ Fully decoded, safe to share between threads unlike a lazily loaded Image.open result. """
+    img = Image.open(io.BytesIO(img_bytes))
+    img.load()
+    return img
+
 
 
 # @@ Preprocess Utils ############################
@@ -133,27 +320,56 @@ def getFrame(idx: int)-> Image.Image:
     return Image.open(f"{FRAME_PATH}/{idx}.png").convert("RGBA")
 
 
+FRAME_INDICES = {
+    Background.CRIMSON: [1, 2, 3],
+    Background.BLACK: [4, 5, 6],
+    Background.IVORY: [7, 8],
+}
+# 512x720 txt2img output upscaled x2 by ReActor
+GENERATED_SIZE = (1024, 1440)
+
+
+class FrameStore:
+    """ Frames decoded once and kept in memory, so merging does no disk I/O. """
+    def __init__(self, frame_dir: str = FRAME_PATH):
+        self.frame_dir = frame_dir
+        self.frames: Dict[int, Image.Image] = {}
+        self.offsets: Dict[Tuple[int, Tuple[int, int]], Tuple[int, int]] = {}
+
+    def load(self) -> "FrameStore":
+        for idx in sorted(idx for indices in FRAME_INDICES.values() for idx in indices):
+            frame = Image.open(f"{self.frame_dir}/{idx}.png").convert("RGBA")
+            self.frames[idx] = frame
+            self.offset(idx, GENERATED_SIZE)
+        return self
+
+    def get(self, idx: int) -> Image.Image:
+        if idx not in self.frames:
+            self.frames[idx] = Image.open(f"{self.frame_dir}/{idx}.png").convert("RGBA")
+        return self.frames[idx]
+
+    def offset(self, idx: int, size: Tuple[int, int]) -> Tuple[int, int]:
+        key = (idx, size)
+        if key not in self.offsets:
+            frame = self.get(idx)
+            self.offsets[key] = ((frame.size[0] - size[0]) // 2, (frame.size[1] - size[1]) // 2)
+        return self.offsets[key]
+
+    def compose(self, idx: int, image: Image.Image) -> Image.Image:
+        # The cached frame is never modified, each output gets its own copy
+        frame = self.get(idx).copy()
+        frame.paste(image, self.offset(idx, image.size))
+        return frame
+
+
+frame_store = FrameStore()
+
+
+def merge_one_frame(image: Image.Image, bg: Background, idx: int)-> Optional[Image.Image]:
+    """ Merge the idx-th generated image of bg, None if bg has no frame for it. """
+    indices = FRAME_INDICES[bg]
+    return frame_store.compose(indices[idx], image) if idx < len(indices) else None
+
+
 def merge_frame(images: List[Image.Image], bg: Background)->List[Image.Image]:
-    mask = Image.new("L", (1024, 1440), 255)
-    # mask = images[0].convert("L")
-    dummy_frame = getFrame(1)
-    pos = ((dummy_frame.size[0] - images[0].size[0]) // 2, (dummy_frame.size[1] - images[0].size[1]) // 2)
-    result = []
-    if bg == Background.CRIMSON:
-        for idx in range(1,4):
-            frame = getFrame(idx)
-            frame.paste(images[idx-1], pos, mask)
-            result.append(frame)
-        return result
-    elif bg == Background.BLACK:
-        for idx in range(4,7):
-            frame = getFrame(idx)
-            frame.paste(images[idx-4], pos, mask)
-            result.append(frame)
-        return result
-    elif bg == Background.IVORY:
-        for idx in range(7,9):
-            frame = getFrame(idx)
-            frame.paste(images[idx-7], pos, mask)
-            result.append(frame)
-        return result
+    return [frame_store.compose(idx, image) for idx, image in zip(FRAME_INDICES[bg], images)]
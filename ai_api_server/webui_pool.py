@@ -0,0 +1,117 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, List
+import httpx
+import utils
+import metrics
+from logger import logger
+from config import STATUS_TIMEOUT_SEC, WEBUI_EJECT_FAILURES, WEBUI_PROBE_INTERVAL_SEC, WEBUI_URLS
+
+
+class WebUIBackend:
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.outstanding = 0     # orders currently pinned to this backend
+        self.queue_depth = 0     # jobs reported by /sdapi/v1/progress
+        self.failures = 0        # consecutive failures
+        self.healthy = True
+
+    @property
+    def load(self) -> int:
+        return self.outstanding + self.queue_depth
+
+    def to_dict(self) -> dict:
+        return {"url": self.url, "healthy": self.healthy, "outstanding": self.outstanding,
+                "queue_depth": self.queue_depth, "failures": self.failures}
+
+
+def is_backend_failure(detail: Any) -> bool:
+    return isinstance(detail, (httpx.RequestError, utils.ServerError))
+
+
+class WebUIPool:
+    """ Least-outstanding routing over several WebUI backends.
+
+    A whole order is leased to one backend, since the ReActor face model
+    built for the order only exists on that backend.
+    """
+    def __init__(self, urls: List[str]):
+        self.backends = [WebUIBackend(url) for url in urls]
+        self._probe_task: asyncio.Task = None
+
+    def set_urls(self, urls: List[str]):
+        self.backends = [WebUIBackend(url) for url in urls]
+
+    def pick(self) -> WebUIBackend:
+        candidates = [backend for backend in self.backends if backend.healthy]
+        if not candidates:
+            # Everything ejected, fall back to the least failing one rather than refusing work
+            candidates = sorted(self.backends, key=lambda backend: backend.failures)[:1]
+        if not candidates:
+            raise RuntimeError("No WebUI backend configured")
+        return min(candidates, key=lambda backend: backend.load)
+
+    @asynccontextmanager
+    async def lease(self) -> AsyncIterator[WebUIBackend]:
+        backend = self.pick()
+        backend.outstanding += 1
+        try:
+            yield backend
+        finally:
+            backend.outstanding -= 1
+
+    def report(self, backend: WebUIBackend, succ: bool, detail: Any = None):
+        """
+        Args:
+            detail (Any, optional): Error detail of a failed request, see "utils.requestPostAsync". Only transport
+                errors, timeouts and 5xx count toward ejection, a request the backend rejected (e.g. no face found)
+                says nothing about its health. None always counts, as for a failed probe.
+        """
+        if succ:
+            backend.failures = 0
+            return
+        if detail is not None and not is_backend_failure(detail):
+            return
+        backend.failures += 1
+        if backend.healthy and backend.failures >= WEBUI_EJECT_FAILURES:
+            backend.healthy = False
+            logger.error(f"Error-webui_pool:ejected:{backend.url}::failures:{backend.failures}")
+
+    async def probe(self, backend: WebUIBackend):
+        client = utils.getHttpClient("webui")
+        start = time.perf_counter()
+        try:
+            response = await client.get(f"{backend.url}/sdapi/v1/progress",
+                                        params={"skip_current_image": "true"},
+                                        timeout=httpx.Timeout(STATUS_TIMEOUT_SEC))
+            response.raise_for_status()
+            state = response.json().get("state", {})
+            backend.queue_depth = max(0, int(state.get("job_count", 0) or 0))
+            metrics.observe_webui(backend.url, "progress", time.perf_counter() - start, True)
+            if not backend.healthy:
+                logger.info(f"webui_pool:readmitted:{backend.url}")
+            backend.healthy = True
+            backend.failures = 0
+        except (httpx.HTTPError, ValueError) as e:
+            metrics.observe_webui(backend.url, "progress", time.perf_counter() - start, False)
+            self.report(backend, False)
+            logger.error(f"Error-webui_pool:probe:{backend.url}::detail:{e}")
+
+    async def _probe_loop(self, interval: float):
+        while True:
+            await asyncio.gather(*[self.probe(backend) for backend in self.backends])
+            await asyncio.sleep(interval)
+
+    def start_probing(self, interval: float = WEBUI_PROBE_INTERVAL_SEC):
+        if self._probe_task is None:
+            self._probe_task = asyncio.create_task(self._probe_loop(interval))
+
+    async def stop_probing(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            await asyncio.gather(self._probe_task, return_exceptions=True)
+            self._probe_task = None
+
+
+webui_pool = WebUIPool(WEBUI_URLS)
@@ -0,0 +1,216 @@
+import asyncio
+import datetime
+from typing import Any, Dict, List, Tuple
+import cloud_utils
+import face_preprocess
+import preprocess_pool
+import profiling
+import utils
+from admission import admission_controller
+from api import webui_t2i
+from checkpoint import checkpoint_store
+from face_models import face_model_manager
+from dto import Background, ProcessRequestParam, ProcessResponseParam
+from logger import logger, request_context
+from config import BUCKET_PREFIX, CHECKPOINT_DOWNLOAD
+from pipeline import Pipeline, PipelineResult, Stage
+from webui_pool import WebUIBackend, webui_pool
+
+
+# @@ Profile generation ############################
+def build_profile_pipeline(req_payload: ProcessRequestParam, backend: WebUIBackend, write_db: bool = False) -> Pipeline:
+    """ Stage graph of one order, shared by the HTTP API and the RMQ consumer.
+
+    Args:
+        req_payload (ProcessRequestParam):
+        backend (WebUIBackend): WebUI leased for the whole order.
+        write_db (bool, optional): Write the result to Firestore after upload. Defaults to False.
+
+    Returns:
+        Pipeline:
+    """
+    req_id = req_payload.id
+    backgrounds = list(Background)
+    # Merges started while txt2img images are still streaming in
+    merge_tasks: Dict[Background, Dict[int, asyncio.Task]] = {bg: {} for bg in backgrounds}
+
+    async def cancel_merges(bg: Background):
+        tasks = list(merge_tasks[bg].values())
+        merge_tasks[bg].clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def cancel_pending_merges():
+        """ After a failed run, merges whose stage never awaited them are cancelled or their error retrieved. """
+        for tasks in merge_tasks.values():
+            for task in tasks.values():
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()
+
+    async def download(inputs: Dict[str, Any]):
+        # Raw bytes, so that the checkpoint keeps EXIF orientation
+        succ, src_bytes = await cloud_utils.download_bytes(req_payload.imagePaths)
+        if not succ:
+            logger.error(f"Error::id:{req_id}::detail:DownloadFail")
+            raise Exception("DownloadFail")
+        return src_bytes
+
+    async def segment(inputs: Dict[str, Any]):
+        # Decoded lazily, at the resolution detection and cropping need
+        return await preprocess_pool.segment_photos(inputs["download"])
+
+    def color(bg: Background):
+        async def fn(inputs: Dict[str, Any]):
+            return await asyncio.to_thread(face_preprocess.color_background, heads=inputs["segment"], bg=bg)
+        return fn
+
+    acquired_models: List[str] = []
+
+    async def face_model(inputs: Dict[str, Any]):
+        succ, response = await face_model_manager.acquire(backend.url, inputs[f"color:{Background.CRIMSON.value}"])
+        webui_pool.report(backend, succ, response)
+        if not succ:
+            raise Exception(f"RequestBuildFaceFail:{response}")
+        acquired_models.append(response)
+        return response
+
+    def release_face_models():
+        for name in acquired_models:
+            face_model_manager.release(backend.url, name)
+
+    def t2i(bg: Background):
+        async def fn(inputs: Dict[str, Any]):
+            processed_images = inputs[f"color:{bg.value}"]
+            # Sample first, only the images actually sent get encoded
+            sampled_img_str_list = await asyncio.gather(*[asyncio.to_thread(utils.encodeImgCached, img)
+                                                          for img in utils.sample_imgs(processed_images)])
+
+            async def on_image(idx: int, img):
+                merge_tasks[bg][idx] = asyncio.create_task(asyncio.to_thread(utils.merge_one_frame, img, bg, idx))
+
+            try:
+                succ, t2i_result = await webui_t2i(gender=req_payload.param.gender,
+                                                   background=bg,
+                                                   batch_size=2 if bg == Background.IVORY else 3,
+                                                   model_name=inputs["face_model"],
+                                                   ip_imgs=sampled_img_str_list,
+                                                   hair=req_payload.param.hair,
+                                                   glasses=req_payload.param.glasses,
+                                                   base_url=backend.url,
+                                                   on_image=on_image,
+                                                   )
+                webui_pool.report(backend, succ, t2i_result)
+                if not succ:
+                    logger.error(f"Error::id:{req_id}::detail:{t2i_result}")
+                    raise Exception(f"{t2i_result}")
+            except BaseException:
+                await cancel_merges(bg)
+                raise
+            return t2i_result
+        return fn
+
+    def merge_encoded(img_bytes: bytes, bg: Background, idx: int):
+        return utils.merge_one_frame(utils.decodeImgBytes(img_bytes), bg, idx)
+
+    def merge(bg: Background):
+        async def fn(inputs: Dict[str, Any]):
+            # Frames merged while streaming are reused, the others (e.g. restored t2i) are decoded and merged here
+            merged = await asyncio.gather(*[merge_tasks[bg].get(idx) or asyncio.to_thread(merge_encoded, img_bytes, bg, idx)
+                                            for idx, img_bytes in enumerate(inputs[f"t2i:{bg.value}"])])
+            return [frame for frame in merged if frame is not None]
+        return fn
+
+    async def upload(inputs: Dict[str, Any]):
+        result = []
+        for bg in backgrounds:
+            result += inputs[f"merge:{bg.value}"]
+        img_names = [f"{req_id}/{i}.png" for i in range(1,len(result)+1)]
+        upload_succ = await cloud_utils.upload_images(result, img_names)
+        if not upload_succ:
+            logger.error(f"Error:{req_id}::detail:UploadFail")
+            raise Exception("UploadFail")
+        FORMAT_DATE = datetime.date.today().strftime("%Y-%m-%d")
+        return [f"{BUCKET_PREFIX}/{FORMAT_DATE}/{img}" for img in img_names]
+
+    async def db(inputs: Dict[str, Any]):
+        response = ProcessResponseParam(id=req_id,
+                                        email=req_payload.email,
+                                        imagePaths=inputs["upload"],
+                                        requestedAt=req_payload.requestedAt,
+                                        createdAt=datetime.datetime.now(),
+                                        title=req_payload.title,
+                                        userId=req_payload.userId)
+        await cloud_utils.get_db_client().collection("profile_responses").document(req_id).set(response.dict())
+
+    stages = [
+        # A restored "segment" skips the download, which is cheaper to redo than to persist
+        Stage("download", download, resource="download", checkpoint=CHECKPOINT_DOWNLOAD),
+        Stage("segment", segment, deps=["download"], resource="preprocess", checkpoint=True),
+        Stage("face_model", face_model, deps=[f"color:{Background.CRIMSON.value}"], resource="webui"),
+    ]
+    prev_t2i: List[str] = []
+    for bg in backgrounds:
+        stages.append(Stage(f"color:{bg.value}", color(bg), deps=["segment"], resource="preprocess"))
+        # WebUI runs one generation at a time, so t2i calls are chained while
+        # recoloring and merging of other backgrounds overlap with them
+        stages.append(Stage(f"t2i:{bg.value}", t2i(bg), deps=[f"color:{bg.value}", "face_model"] + prev_t2i,
+                            resource="webui", checkpoint=True))
+        stages.append(Stage(f"merge:{bg.value}", merge(bg), deps=[f"t2i:{bg.value}"]))
+        prev_t2i = [f"t2i:{bg.value}"]
+    stages.append(Stage("upload", upload, deps=[f"merge:{bg.value}" for bg in backgrounds], resource="upload", checkpoint=True))
+    if write_db:
+        stages.append(Stage("db", db, deps=["upload"], resource="upload", checkpoint=True))
+    return Pipeline(stages, on_finish=[release_face_models, cancel_pending_merges], checkpoint_store=checkpoint_store, checkpoint_key=req_id)
+
+
+# Kept after success so that a duplicate of a finished order returns right away
+FINAL_STAGES = ["upload", "db"]
+_inflight: Dict[Tuple[str, bool], asyncio.Task] = {}
+
+
+async def _run(req_payload: ProcessRequestParam, write_db: bool) -> PipelineResult:
+    with request_context(req_payload.id), profiling.capture(req_payload.id):
+        async with webui_pool.lease() as backend:
+            profiling.record_event("lease", backend=backend.url, load=backend.load)
+            pipeline = build_profile_pipeline(req_payload, backend, write_db=write_db)
+            result = await pipeline.run()
+    admission_controller.observe(pipeline, result)
+    timings = ", ".join(f"{name}={sec:.2f}s" for name, sec in result.timings.items())
+    logger.info(f"Timings:{req_payload.id}::{timings}::restored:{result.restored}",
+                extra={"fields": {**{f"{name}_sec": round(sec, 3) for name, sec in result.timings.items()},
+                                  "restored": ",".join(result.restored)}})
+
+    if checkpoint_store is not None:
+        await asyncio.to_thread(checkpoint_store.prune, req_payload.id, FINAL_STAGES)
+        if checkpoint_store.sweep_due():
+            await asyncio.to_thread(checkpoint_store.sweep)
+    return result
+
+
+async def run_profile_pipeline(req_payload: ProcessRequestParam, write_db: bool = False) -> PipelineResult:
+    """ All WebUI calls of the order are pinned to one backend.
+
+    A retried order resumes after its last checkpointed stage, and a duplicate
+    arriving while the same order is running joins that run instead of starting another.
+
+    Returns:
+        PipelineResult: "upload" holds the uploaded image paths.
+    """
+    key = (req_payload.id, write_db)
+    task = _inflight.get(key)
+    if task is None:
+        # Only the run that does the work counts toward admission, not the duplicates joining it
+        admission_controller.start()
+        task = asyncio.create_task(_run(req_payload, write_db))
+        _inflight[key] = task
+
+        def finished(_):
+            _inflight.pop(key, None)
+            admission_controller.finish()
+        task.add_done_callback(finished)
+    else:
+        logger.info(f"Duplicate:{req_payload.id}::joined in-flight run")
+    return await asyncio.shield(task)
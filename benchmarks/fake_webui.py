@@ -0,0 +1,209 @@
+""" Stand-in for the Stable Diffusion WebUI, enough of its API for load tests without a GPU.
+
+    python benchmarks/fake_webui.py --port 7860 --t2i-latency lognormal:6,0.3 --webui-concurrency 1 --failure-rate 0.01
+
+Latency specs: "fixed:S", "uniform:LO,HI", "normal:MEAN,STD" or "lognormal:MEDIAN,SIGMA", in seconds.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+import harness
+
+
+# @@ Config ############################
+class LatencySpec:
+    def __init__(self, spec: str):
+        self.spec = spec
+        kind, _, args = spec.partition(":")
+        self.kind = kind
+        self.args = [float(arg) for arg in args.split(",") if arg]
+        if kind not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            return self.args[0]
+        if self.kind == "uniform":
+            return rng.uniform(self.args[0], self.args[1])
+        if self.kind == "normal":
+            return max(0.0, rng.gauss(self.args[0], self.args[1]))
+        return rng.lognormvariate(0, self.args[1]) * self.args[0]
+
+
+class FakeWebUIConfig:
+    def __init__(self,
+                 t2i_latency: str = "lognormal:6,0.3",
+                 facemodel_latency: str = "uniform:1,3",
+                 concurrency: int = 1,
+                 failure_rate: float = 0.0,
+                 facemodel_failure_rate: float = 0.0,
+                 image_size: Tuple[int, int] = (1024, 1440),
+                 time_scale: float = 1.0,
+                 seed: Optional[int] = None):
+        """
+        Args:
+            t2i_latency (str): Generation time per txt2img request, batch size independent like a batched sampler.
+            concurrency (int): Requests processed at once, the WebUI runs one job at a time. Others queue.
+            failure_rate (float): Share of txt2img requests answered with HTTP 500.
+            image_size (Tuple[int, int]): Width, height of the returned images.
+            time_scale (float): Multiplier on every latency, e.g. 0.01 to replay a run 100x faster.
+        """
+        self.t2i_latency = LatencySpec(t2i_latency)
+        self.facemodel_latency = LatencySpec(facemodel_latency)
+        self.concurrency = concurrency
+        self.failure_rate = failure_rate
+        self.facemodel_failure_rate = facemodel_failure_rate
+        self.image_size = image_size
+        self.time_scale = time_scale
+        self.seed = seed
+
+
+# @@ Server ############################
+class FakeWebUI:
+    def __init__(self, config: FakeWebUIConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.facemodels: Set[str] = set()
+        self.queued = 0
+        self.running = 0
+        self.requests: Dict[str, int] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._images: List[str] = []
+
+    def images(self, count: int) -> List[str]:
+        # Photo-like PNGs, so that response sizes and decode costs are realistic
+        while len(self._images) < min(count, 4):
+            image = harness.synthetic_photo(self.config.image_size, seed=len(self._images))
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG")
+            self._images.append(base64.b64encode(buffer.getvalue()).decode("utf-8"))
+        return [self._images[i % len(self._images)] for i in range(count)]
+
+    async def run_job(self, latency: LatencySpec, failure_rate: float) -> bool:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.config.concurrency)
+        self.queued += 1
+        waiting = True
+        try:
+            async with self._semaphore:
+                self.queued -= 1
+                waiting = False
+                self.running += 1
+                try:
+                    await asyncio.sleep(latency.sample(self.rng) * self.config.time_scale)
+                finally:
+                    self.running -= 1
+        finally:
+            # Client gave up while queued
+            if waiting:
+                self.queued -= 1
+        return self.rng.random() >= failure_rate
+
+    def count(self, endpoint: str):
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def create_app(self) -> FastAPI:
+        app = FastAPI(title="Fake WebUI")
+
+        @app.get("/user")
+        async def user():
+            self.count("user")
+            return {}
+
+        @app.get("/sdapi/v1/progress")
+        async def progress():
+            self.count("progress")
+            return {"progress": 0.0, "eta_relative": 0.0,
+                    "state": {"job_count": self.queued + self.running}}
+
+        @app.post("/sdapi/v1/txt2img")
+        async def txt2img(request: Request):
+            self.count("txt2img")
+            payload = await request.json()
+            batch_size = int(payload.get("batch_size", 1) or 1) * int(payload.get("n_iter", 1) or 1)
+            if not await self.run_job(self.config.t2i_latency, self.config.failure_rate):
+                return JSONResponse(status_code=500, content={"error": "FakeFailure"})
+            images = await asyncio.to_thread(self.images, batch_size)
+            return {"images": images, "parameters": {}, "info": "{}"}
+
+        @app.get("/reactor/facemodels")
+        async def list_facemodels():
+            self.count("facemodels:get")
+            return {"facemodels": sorted(self.facemodels)}
+
+        @app.post("/reactor/facemodels")
+        async def build_facemodel(request: Request):
+            self.count("facemodels:post")
+            payload = await request.json()
+            if not await self.run_job(self.config.facemodel_latency, self.config.facemodel_failure_rate):
+                return JSONResponse(status_code=500, content={"error": "FakeFailure"})
+            self.facemodels.add(payload.get("name", ""))
+            return {"facemodel": payload.get("name", "")}
+
+        return app
+
+
+class FakeWebUIServer:
+    """ uvicorn in a background thread, for load tests that drive the API server in-process. """
+    def __init__(self, config: FakeWebUIConfig, host: str = "127.0.0.1", port: int = 7860):
+        self.fake = FakeWebUI(config)
+        self.url = f"http://{host}:{port}"
+        self.server = uvicorn.Server(uvicorn.Config(self.fake.create_app(), host=host, port=port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self, timeout: float = 10) -> "FakeWebUIServer":
+        self.thread.start()
+        deadline = time.time() + timeout
+        while not self.server.started:
+            if time.time() > deadline or not self.thread.is_alive():
+                raise RuntimeError(f"Fake WebUI did not start on {self.url}")
+            time.sleep(0.05)
+        return self
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--t2i-latency", default="lognormal:6,0.3")
+    parser.add_argument("--facemodel-latency", default="uniform:1,3")
+    parser.add_argument("--webui-concurrency", type=int, default=1, help="Jobs run at once, the rest queue")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--facemodel-failure-rate", type=float, default=0.0)
+    parser.add_argument("--image-size", default="1024x1440", help="WIDTHxHEIGHT of generated images")
+    parser.add_argument("--time-scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int)
+
+
+def config_from_args(args: argparse.Namespace) -> FakeWebUIConfig:
+    width, height = (int(side) for side in args.image_size.lower().split("x"))
+    return FakeWebUIConfig(t2i_latency=args.t2i_latency,
+                           facemodel_latency=args.facemodel_latency,
+                           concurrency=args.webui_concurrency,
+                           failure_rate=args.failure_rate,
+                           facemodel_failure_rate=args.facemodel_failure_rate,
+                           image_size=(width, height),
+                           time_scale=args.time_scale,
+                           seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7860)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(FakeWebUI(config_from_args(args)).create_app(), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import glob
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_DIR = os.path.join(ROOT, "ai_api_server")
+
+# Portrait phone photos, stored landscape with an EXIF rotation like most phone cameras do
+PHONE_RESOLUTIONS = {
+    "12mp": (3024, 4032),
+    "3mp": (1512, 2016),
+}
+EXIF_ORIENTATION = 0x0112
+
+
+# @@ Environment ############################
+def setup_env():
+    """ Make the server modules importable as they are in the container: flat imports, cwd at the repo root, CPU only. """
+    tmp_dir = os.path.join(tempfile.gettempdir(), "ai-api-server-bench")
+    os.makedirs(tmp_dir, exist_ok=True)
+    defaults = {
+        "BATCH_NO": "0",
+        "RMQ_PORT": "5672",
+        "CONTROLNET_WEIGHTING": "[]",
+        "PRESET_DIR": os.path.join(tmp_dir, "preset"),
+        "LOG_PATH": os.path.join(tmp_dir, "bench.log"),
+        "CHECKPOINT_DIR": "",
+        "CUDA_VISIBLE_DEVICES": "",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+    os.environ.pop("ENV", None)    # dev mode writes every intermediate image to disk
+    os.chdir(ROOT)
+    if SERVER_DIR not in sys.path:
+        sys.path.insert(0, SERVER_DIR)
+
+
+# @@ Inputs ############################
+def synthetic_photo(size: Tuple[int, int], seed: int = 0) -> Image.Image:
+    """ Background gradient, a skin toned head and sensor noise, so that codecs see photo-like entropy. """
+    width, height = size
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = np.empty((height, width, 3), dtype=np.float32)
+    image[..., 0] = 90 + 80 * xs / width
+    image[..., 1] = 110 + 60 * ys / height
+    image[..., 2] = 140 - 40 * xs / width
+    cx, cy, rx, ry = width * 0.5, height * 0.42, width * 0.2, height * 0.17
+    head = ((xs - cx) / rx) ** 2 + ((ys - cy) / ry) ** 2 <= 1
+    image[head] = (224, 172, 140)
+    image += rng.normal(0, 6, size=image.shape).astype(np.float32)
+    return Image.fromarray(np.clip(image, 0, 255).astype(np.uint8))
+
+
+def phone_jpeg(size: Tuple[int, int], seed: int = 0, quality: int = 90) -> bytes:
+    """ JPEG of a portrait photo stored landscape with EXIF orientation 6, as phone cameras write them. """
+    width, height = size
+    photo = synthetic_photo((width, height), seed).transpose(Image.ROTATE_90)
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION] = 6
+    buffer = io.BytesIO()
+    photo.save(buffer, format="JPEG", quality=quality, exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+def load_fixtures(fixture_dir: Optional[str]) -> List[bytes]:
+    """ Real photos, e.g. benchmarks/fixtures/*.jpg. Not shipped with the repo. """
+    if not fixture_dir or not os.path.isdir(fixture_dir):
+        return []
+    paths = sorted(path for ext in ("jpg", "jpeg", "png") for path in glob.glob(os.path.join(fixture_dir, f"*.{ext}")))
+    blobs = []
+    for path in paths:
+        with open(path, "rb") as f:
+            blobs.append(f.read())
+    return blobs
+
+
+# @@ Measurement ############################
+def measure_time(fn: Callable[[], Any], repeat: int, warmup: int = 1) -> List[float]:
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def measure_memory(fn: Callable[[], Any]) -> Dict[str, float]:
+    """ Peak and net allocation of one call, as seen by tracemalloc.
+
+    Python objects and NumPy buffers are traced, native allocations of
+    OpenCV, PIL decoders and torch are not.
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        del result
+    finally:
+        tracemalloc.stop()
+    diff = after.compare_to(before, "filename")
+    return {
+        "peak_kib": round((peak - base) / 1024, 1),
+        "alloc_kib": round(sum(stat.size_diff for stat in diff if stat.size_diff > 0) / 1024, 1),
+        "alloc_blocks": sum(stat.count_diff for stat in diff if stat.count_diff > 0),
+    }
+
+
+def run_case(fn: Callable[[], Any], items: int, repeat: int, memory: bool = True) -> Dict[str, float]:
+    times = measure_time(fn, repeat)
+    median = statistics.median(times)
+    result = {
+        "items": items,
+        "median_s": round(median, 6),
+        "min_s": round(min(times), 6),
+        "throughput": round(items / median, 3) if median > 0 else None,
+    }
+    if memory:
+        result.update(measure_memory(fn))
+    return result
+
+
+# @@ Baseline ############################
+def machine_info() -> Dict[str, Any]:
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "processor": platform.processor(), "cpu_count": os.cpu_count(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def save_baseline(path: str, results: Dict[str, Dict[str, float]]):
+    with open(path, "w") as f:
+        json.dump({"machine": machine_info(), "results": results}, f, indent=2, sort_keys=True)
+
+
+def load_baseline(path: str) -> Dict[str, Dict[str, float]]:
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], threshold: float) -> List[str]:
+    """ Returns the cases slower than the baseline by more than threshold, e.g. 0.1 for 10%. """
+    regressions = []
+    for case_id, result in results.items():
+        base = baseline.get(case_id)
+        if not base or not base.get("median_s") or "median_s" not in result:
+            continue
+        change = result["median_s"] / base["median_s"] - 1
+        result["vs_baseline"] = round(change, 4)
+        if change > threshold:
+            regressions.append(case_id)
+    return regressions
+
+
+def format_table(results: Dict[str, Dict[str, Any]]) -> str:
+    header = f"{'case':<44} {'items':>5} {'median ms':>10} {'items/s':>9} {'peak KiB':>10} {'alloc KiB':>10} {'blocks':>8} {'vs base':>8}"
+    lines = [header, "-" * len(header)]
+    for case_id, result in results.items():
+        if "skipped" in result:
+            lines.append(f"{case_id:<44} skipped: {result['skipped']}")
+            continue
+        change = result.get("vs_baseline")
+        lines.append(f"{case_id:<44} {result['items']:>5} {result['median_s'] * 1000:>10.2f} {result['throughput'] or 0:>9.2f} "
+                     f"{result.get('peak_kib', 0):>10.1f} {result.get('alloc_kib', 0):>10.1f} {result.get('alloc_blocks', 0):>8} "
+                     f"{'' if change is None else f'{change:+.1%}':>8}")
+    return "\n".join(lines)
@@ -0,0 +1,360 @@
+""" End-to-end load generator for the API server, against the fake WebUI by default.
+
+    python benchmarks/loadgen.py --mode http --orders 40 --concurrency 4 --time-scale 0.1
+    python benchmarks/loadgen.py --mode rmq --orders 40 --prefetch 4 --rate 0.5
+    python benchmarks/loadgen.py --mode http --target http://localhost:9001 --webui-url http://localhost:7860
+
+In-process runs start the server lifespan (models on CPU, storage and Firestore
+on local disk) and feed orders through httpx.ASGITransport ("http") or an
+in-process broker calling rmq_app.process_message ("rmq").
+Needs the preset images and FACE_MODEL_PATH in the repo root, as the container does.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+import harness
+from fake_webui import FakeWebUIServer, add_arguments, config_from_args
+
+
+# @@ In-process broker ############################
+class FakeIncomingMessage:
+    """ The part of aio_pika.IncomingMessage used by rmq_app.process_message. """
+    def __init__(self, broker: "InProcessBroker", body: bytes, redelivered: bool = False):
+        self.broker = broker
+        self.body = body
+        self.redelivered = redelivered
+        self.processed = False
+        self.outcome: Optional[str] = None
+        self.published_at = time.perf_counter()
+        self.settled_at: Optional[float] = None
+
+    async def ack(self):
+        self._settle("ack")
+
+    async def reject(self, requeue: bool = False):
+        self._settle("reject")
+        if requeue:
+            await self.broker.publish(self.body, redelivered=True, published_at=self.published_at)
+
+    async def nack(self, requeue: bool = True):
+        await self.reject(requeue=requeue)
+
+    def _settle(self, outcome: str):
+        if self.processed:
+            raise RuntimeError("Message already processed")
+        self.processed = True
+        self.outcome = outcome
+        self.settled_at = time.perf_counter()
+        self.broker.settled(self)
+
+    @asynccontextmanager
+    async def process(self, requeue: bool = False, reject_on_redelivered: bool = False,
+                      ignore_processed: bool = False) -> AsyncIterator["FakeIncomingMessage"]:
+        try:
+            yield self
+        except BaseException:
+            if not self.processed:
+                await self.reject(requeue=requeue and not (reject_on_redelivered and self.redelivered))
+            raise
+        else:
+            if not self.processed:
+                await self.ack()
+
+
+class InProcessBroker:
+    """ One queue, at most "prefetch" unsettled messages handed to the consumer, like basic.qos. """
+    def __init__(self, prefetch: int):
+        self.prefetch = prefetch
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.done: List[FakeIncomingMessage] = []
+        self._workers: List[asyncio.Task] = []
+
+    async def publish(self, body: bytes, redelivered: bool = False, published_at: Optional[float] = None) -> FakeIncomingMessage:
+        message = FakeIncomingMessage(self, body, redelivered=redelivered)
+        if published_at is not None:
+            message.published_at = published_at
+        await self.queue.put(message)
+        return message
+
+    def settled(self, message: FakeIncomingMessage):
+        self.done.append(message)
+
+    def consume(self, callback: Callable[[FakeIncomingMessage], Awaitable[None]]):
+        async def worker():
+            while True:
+                message = await self.queue.get()
+                try:
+                    await callback(message)
+                except Exception:
+                    pass    # process_message reports and settles on its own
+                finally:
+                    self.queue.task_done()
+        self._workers = [asyncio.create_task(worker()) for _ in range(self.prefetch)]
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+
+# @@ Orders ############################
+def make_order(order_id: str, image_paths: List[str], rng: random.Random) -> Dict[str, Any]:
+    gender = rng.choice(["girl", "man", "boy"])
+    return {"id": order_id,
+            "param": {"gender": gender, "hair": rng.choice(["short", "long"]), "glasses": rng.random() < 0.2},
+            "email": "loadgen@example.com",
+            "userId": "loadgen",
+            "imagePaths": image_paths,
+            "requestedAt": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "title": "loadgen"}
+
+
+def stage_input_photos(photos: List[bytes], images_per_order: int) -> List[str]:
+    """ Write the photos into the local bucket, returns the paths of one order. """
+    import cloud_utils
+    from config import BUCKET_NAME
+    paths = []
+    for i in range(images_per_order):
+        path = f"loadgen/{i}.jpg"
+        cloud_utils.storage_backend.write_bytes(BUCKET_NAME, path, photos[i % len(photos)], "image/jpeg")
+        paths.append(path)
+    return paths
+
+
+async def arrivals(count: int, rate: Optional[float], concurrency: int, rng: random.Random,
+                   submit: Callable[[int], Awaitable[None]]):
+    """ Open loop (Poisson at "rate" orders/s) when rate is given, otherwise closed loop with "concurrency" clients. """
+    if rate:
+        tasks = []
+        for i in range(count):
+            tasks.append(asyncio.create_task(submit(i)))
+            await asyncio.sleep(rng.expovariate(rate))
+        await asyncio.gather(*tasks)
+        return
+    next_index = iter(range(count))
+
+    async def client():
+        for i in next_index:
+            await submit(i)
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+
+
+# @@ Report ############################
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    # Nearest rank
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    return {f"p{q}": None if percentile(values, q) is None else round(percentile(values, q), 4) for q in (50, 95, 99)}
+
+
+def stage_breakdown(timelines: List[dict]) -> Dict[str, Dict[str, Any]]:
+    durations: Dict[str, List[float]] = {}
+    waits: Dict[str, List[float]] = {}
+    for timeline in timelines:
+        for span in timeline.get("spans", []):
+            if span.get("restored"):
+                continue
+            durations.setdefault(span["name"], []).append(span["end"] - span["start"])
+            if span.get("wait") is not None:
+                waits.setdefault(span["name"], []).append(span["wait"])
+    return {name: {"count": len(values), "run": summarize(values), "wait": summarize(waits.get(name, []))}
+            for name, values in durations.items()}
+
+
+def report(mode: str, latencies: List[float], failures: Dict[str, int], wall: float, timelines: List[dict],
+           webui_requests: Optional[Dict[str, int]]) -> Dict[str, Any]:
+    return {"mode": mode,
+            "ok": len(latencies),
+            "failed": sum(failures.values()),
+            "failures": failures,
+            "wall_s": round(wall, 3),
+            "throughput": round(len(latencies) / wall, 4) if wall > 0 else None,
+            "latency": summarize(latencies),
+            "stages": stage_breakdown(timelines),
+            "webui_requests": webui_requests}
+
+
+def print_report(result: Dict[str, Any]):
+    print(f"mode={result['mode']} ok={result['ok']} failed={result['failed']} wall={result['wall_s']}s "
+          f"throughput={result['throughput']} orders/s")
+    print("latency s: " + " ".join(f"{k}={v}" for k, v in result["latency"].items()))
+    if result["failures"]:
+        print("failures: " + ", ".join(f"{k}={v}" for k, v in result["failures"].items()))
+    if result["stages"]:
+        print(f"\n{'stage':<16} {'n':>4} {'run p50':>8} {'run p95':>8} {'run p99':>8} {'wait p50':>9} {'wait p95':>9}")
+        for name, stage in sorted(result["stages"].items()):
+            run, wait = stage["run"], stage["wait"]
+            print(f"{name:<16} {stage['count']:>4} {run['p50'] or 0:>8.3f} {run['p95'] or 0:>8.3f} {run['p99'] or 0:>8.3f} "
+                  f"{wait['p50'] or 0:>9.3f} {wait['p95'] or 0:>9.3f}")
+    if result["webui_requests"]:
+        print("\nwebui requests: " + ", ".join(f"{k}={v}" for k, v in sorted(result["webui_requests"].items())))
+
+
+# @@ Runs ############################
+async def run_http(args, orders: List[Dict[str, Any]], rng: random.Random):
+    import httpx
+    latencies, failures, timelines = [], {}, []
+    if args.target:
+        client = httpx.AsyncClient(base_url=args.target, timeout=None)
+        lifespan = None
+    else:
+        import profiling
+        import setup
+        from app import app
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://loadgen", timeout=None)
+        lifespan = setup.lifespan(app)
+        await lifespan.__aenter__()
+        await setup.startup_state.wait_ready()
+
+    async def submit(i: int):
+        start = time.perf_counter()
+        try:
+            response = await client.post("/api/process", json=orders[i])
+            ok = response.status_code == 200
+            error = None if ok else f"http_{response.status_code}:{response.json().get('error', '')[:40]}"
+        except httpx.HTTPError as e:
+            ok, error = False, type(e).__name__
+        if ok:
+            latencies.append(time.perf_counter() - start)
+        else:
+            failures[error] = failures.get(error, 0) + 1
+
+    try:
+        start = time.perf_counter()
+        await arrivals(len(orders), args.rate, args.concurrency, rng, submit)
+        wall = time.perf_counter() - start
+        for order in orders:
+            if args.target:
+                if args.config_key:
+                    response = await client.get(f"/api/timeline/{order['id']}", params={"k": args.config_key})
+                    if response.status_code == 200:
+                        timelines.append(response.json())
+            else:
+                timeline = profiling.get_timeline(order["id"])
+                if timeline is not None:
+                    timelines.append(timeline)
+    finally:
+        await client.aclose()
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+    return latencies, failures, wall, timelines
+
+
+async def run_rmq(args, orders: List[Dict[str, Any]], rng: random.Random):
+    import profiling
+    import rmq_app
+    import setup
+    from app import app
+    broker = InProcessBroker(args.prefetch)
+    messages: List[FakeIncomingMessage] = []
+    async with setup.lifespan(app):
+        await setup.startup_state.wait_ready()
+        broker.consume(rmq_app.process_message)
+
+        async def submit(i: int):
+            messages.append(await broker.publish(json.dumps(orders[i]).encode()))
+
+        start = time.perf_counter()
+        # Closed loop makes no sense for a queue, the whole backlog is published at once without --rate
+        await arrivals(len(orders), args.rate, len(orders), rng, submit)
+        await broker.queue.join()
+        wall = time.perf_counter() - start
+        await broker.close()
+
+    latencies, failures = [], {}
+    for message in broker.done:
+        if message.outcome == "ack":
+            latencies.append(message.settled_at - message.published_at)
+        else:
+            failures[message.outcome] = failures.get(message.outcome, 0) + 1
+    timelines = [timeline for timeline in (profiling.get_timeline(order["id"]) for order in orders) if timeline is not None]
+    return latencies, failures, wall, timelines
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["http", "rmq"], default="http")
+    parser.add_argument("--orders", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4, help="Closed loop clients, http mode")
+    parser.add_argument("--rate", type=float, help="Open loop arrivals, orders/s")
+    parser.add_argument("--prefetch", type=int, default=4, help="RMQ prefetch, rmq mode")
+    parser.add_argument("--images-per-order", type=int, default=4)
+    parser.add_argument("--resolution", default="3mp", choices=list(harness.PHONE_RESOLUTIONS))
+    parser.add_argument("--fixtures", default=os.path.join(harness.ROOT, "benchmarks", "fixtures"))
+    parser.add_argument("--target", help="Base URL of a running API server instead of the in-process app, http mode")
+    parser.add_argument("--config-key", help="CONFIG_KEY of --target, to fetch stage timelines")
+    parser.add_argument("--webui-url", help="Use this WebUI instead of starting the fake one")
+    parser.add_argument("--webui-port", type=int, default=17860)
+    parser.add_argument("--json", help="Also write the report to this file")
+    add_arguments(parser)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    fake_webui = None
+    webui_url = args.webui_url
+    if webui_url is None:
+        fake_webui = FakeWebUIServer(config_from_args(args), port=args.webui_port).start()
+        webui_url = fake_webui.url
+
+    if not args.target:
+        # Must be set before the server modules are imported
+        work_dir = tempfile.mkdtemp(prefix="loadgen-")
+        os.environ.update({
+            "WEBUI_URLS": webui_url,
+            "WEBUI_URL": webui_url,
+            "STORAGE_BACKEND": "local",
+            "LOCAL_STORAGE_DIR": work_dir,
+            "BUCKET_NAME": "loadgen-src",
+            "BUCKET_PREFIX": "loadgen",
+            "RMQ_HOST": "",
+            "RMQ_PREFETCH": str(args.prefetch),
+            "NOTIFY_URL": "",
+            "TIMELINE_KEEP": str(max(200, args.orders)),
+        })
+    harness.setup_env()
+    missing = [path for path in ("female_preset.png", "male_preset.png") if not os.path.exists(path)]
+    if missing and not args.target:
+        print(f"Missing {', '.join(missing)} in {harness.ROOT}", file=sys.stderr)
+        return 2
+
+    photos = harness.load_fixtures(args.fixtures) or [harness.phone_jpeg(harness.PHONE_RESOLUTIONS[args.resolution], seed=seed)
+                                                      for seed in range(args.images_per_order)]
+    run_id = uuid.uuid4().hex[:8]
+    if args.target:
+        image_paths = [f"loadgen/{i}.jpg" for i in range(args.images_per_order)]    # must exist in the target bucket
+    else:
+        image_paths = stage_input_photos(photos, args.images_per_order)
+    orders = [make_order(f"loadgen-{run_id}-{i}", image_paths, rng) for i in range(args.orders)]
+
+    try:
+        runner = run_http if args.mode == "http" else run_rmq
+        latencies, failures, wall, timelines = asyncio.run(runner(args, orders, rng))
+    finally:
+        if fake_webui is not None:
+            fake_webui.stop()
+
+    result = report(args.mode, latencies, failures, wall, timelines,
+                    dict(fake_webui.fake.requests) if fake_webui is not None else None)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    return 0 if not failures else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
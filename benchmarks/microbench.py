@@ -0,0 +1,218 @@
+""" CPU microbenchmarks of the preprocessing and post-processing hot paths.
+
+    python benchmarks/microbench.py                              # run & print
+    python benchmarks/microbench.py --save-baseline base.json    # record a baseline
+    python benchmarks/microbench.py --baseline base.json --fail-on-regression
+
+Photos are synthetic phone-camera JPEGs, real ones are added with --fixtures DIR.
+Cases that need a missing model or package are reported as skipped.
+Baselines are machine specific, compare runs made on the same host only.
+"""
+import argparse
+import io
+import os
+import sys
+from typing import Any, Callable, Dict, List, Tuple
+import numpy as np
+from PIL import Image
+import harness
+
+harness.setup_env()
+
+# (name, setup) where setup(count, photos) returns (run, items)
+Case = Tuple[str, Callable[[int, List[bytes]], Tuple[Callable[[], Any], int]]]
+CROP_SIZE = (1200, 1500)
+
+
+def _photos_as_arrays(face_preprocess, photos: List[bytes], count: int) -> List[np.ndarray]:
+    return [face_preprocess.to_rgb_array(Image.open(io.BytesIO(photos[i % len(photos)]))) for i in range(count)]
+
+
+def _crops(count: int) -> List[np.ndarray]:
+    return [np.asarray(harness.synthetic_photo(CROP_SIZE, seed=i)) for i in range(count)]
+
+
+# @@ Preprocessing ############################
+def align(count: int, photos: List[bytes]):
+    import face_preprocess
+    blobs = [photos[i % len(photos)] for i in range(count)]
+
+    def run():
+        # Decoding is part of the cost, Image.open is lazy
+        return [np.asarray(face_preprocess.align_pil_image(Image.open(io.BytesIO(blob)))) for blob in blobs]
+    return run, count
+
+
+def lazy_proxy(count: int, photos: List[bytes]):
+    import face_preprocess
+    blobs = [photos[i % len(photos)] for i in range(count)]
+    # Detection input without the full resolution decode of align_pil_image
+    return (lambda: [face_preprocess.LazyImage(blob).proxy() for blob in blobs]), count
+
+
+def convert(count: int, photos: List[bytes]):
+    import face_preprocess
+    arrays = [np.asarray(Image.open(io.BytesIO(photos[i % len(photos)])).convert("RGBA")) for i in range(count)]
+    return (lambda: [face_preprocess.convert_to_rgb(array) for array in arrays]), count
+
+
+_face_detector = None
+_head_segmenter = None
+
+
+def _get_face_detector():
+    global _face_detector
+    import face_preprocess
+    from config import FACE_MODEL_PATH
+    if not os.path.exists(FACE_MODEL_PATH):
+        raise FileNotFoundError(f"{FACE_MODEL_PATH} (FACE_MODEL_PATH)")
+    if _face_detector is None:
+        _face_detector = face_preprocess.build_face_detector(FACE_MODEL_PATH)
+    return _face_detector
+
+
+def _get_head_segmenter():
+    global _head_segmenter
+    import face_preprocess
+    if _head_segmenter is None:
+        _head_segmenter = face_preprocess.build_head_segmenter("cpu")
+    return _head_segmenter
+
+
+def detect_crop(count: int, photos: List[bytes]):
+    import face_preprocess
+    face_detector = _get_face_detector()
+    arrays = _photos_as_arrays(face_preprocess, photos, count)
+
+    def run():
+        results = face_detector.detect(arrays)
+        return face_detector.crop_faces(results=results, image=arrays, margin=2.5)
+    return run, count
+
+
+def segment_and_color(count: int, photos: List[bytes]):
+    head_segmenter = _get_head_segmenter()
+    crops = _crops(count)
+    return (lambda: head_segmenter.segment_and_color(crops)), count
+
+
+def remove_small_components(count: int, photos: List[bytes]):
+    import face_preprocess
+    from dto import Background
+    bg_color = face_preprocess.BG_COLORS[Background.CRIMSON]
+    images = []
+    for crop in _crops(count):
+        mask = np.zeros(crop.shape[:2], dtype=bool)
+        mask[crop.shape[0] // 6:, crop.shape[1] // 5:-crop.shape[1] // 5] = True
+        mask[:40, :40] = True    # stray blob the cleanup has to drop
+        images.append(Image.fromarray(face_preprocess.composite_background(crop, mask, bg_color)))
+    return (lambda: [face_preprocess.remove_smaller_components_pil(image, bg_color) for image in images]), count
+
+
+# @@ Post-processing ############################
+def encode(fmt: str):
+    def setup(count: int, photos: List[bytes]):
+        import utils
+        images = [Image.fromarray(crop) for crop in _crops(count)]
+        return (lambda: [utils.encodeImg2Base64(image, fmt) for image in images]), count
+    return setup
+
+
+def decode(count: int, photos: List[bytes]):
+    import utils
+    encoded = [utils.encodeImg2Base64(harness.synthetic_photo(utils.GENERATED_SIZE, seed=i)) for i in range(count)]
+
+    def run():
+        images = [utils.decodeBase642Img(data) for data in encoded]
+        for image in images:
+            image.load()
+        return images
+    return run, count
+
+
+def merge(count: int, photos: List[bytes]):
+    import utils
+    from dto import Background
+    utils.frame_store.load()
+    generated = [harness.synthetic_photo(utils.GENERATED_SIZE, seed=i) for i in range(count)]
+
+    def run():
+        merged, start = [], 0
+        while start < len(generated):
+            for bg in Background:
+                chunk = generated[start:start + len(utils.FRAME_INDICES[bg])]
+                merged += utils.merge_frame(chunk, bg)
+                start += len(chunk)
+        return merged
+    return run, count
+
+
+CASES: List[Case] = [
+    ("align_pil_image", align),
+    ("LazyImage.proxy", lazy_proxy),
+    ("convert_to_rgb", convert),
+    ("detect_crop", detect_crop),
+    ("segment_and_color", segment_and_color),
+    ("remove_smaller_components_pil", remove_small_components),
+    ("encodeImg2Base64:png", encode("png")),
+    ("encodeImg2Base64:webp", encode("webp")),
+    ("encodeImg2Base64:jpeg", encode("jpeg")),
+    ("decodeBase642Img", decode),
+    ("merge_frame", merge),
+]
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--counts", default="1,4,8", help="Image counts per call, comma separated")
+    parser.add_argument("--resolutions", default=",".join(harness.PHONE_RESOLUTIONS), help="Synthetic photo resolutions")
+    parser.add_argument("--fixtures", default=os.path.join(harness.ROOT, "benchmarks", "fixtures"), help="Directory of real photos")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default="", help="Only cases whose name contains this")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc pass")
+    parser.add_argument("--baseline", help="Baseline JSON to compare against")
+    parser.add_argument("--save-baseline", help="Write the results as a baseline JSON")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Slowdown reported as regression, 0.1 for 10%%")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args(argv)
+
+    counts = [int(count) for count in args.counts.split(",") if count]
+    inputs: Dict[str, List[bytes]] = {}
+    for name in args.resolutions.split(","):
+        size = harness.PHONE_RESOLUTIONS[name]
+        inputs[f"synthetic_{name}"] = [harness.phone_jpeg(size, seed=seed) for seed in range(2)]
+    fixtures = harness.load_fixtures(args.fixtures)
+    if fixtures:
+        inputs["fixtures"] = fixtures
+
+    results: Dict[str, Dict[str, Any]] = {}
+    for case_name, setup in CASES:
+        if args.filter and args.filter not in case_name:
+            continue
+        # Only the photo based cases depend on the input set
+        photo_based = setup in (align, lazy_proxy, convert, detect_crop)
+        for input_name, photos in (inputs.items() if photo_based else [("synthetic", [])]):
+            for count in counts:
+                case_id = f"{case_name}[{input_name}x{count}]"
+                try:
+                    run, items = setup(count, photos)
+                    results[case_id] = harness.run_case(run, items, args.repeat, memory=not args.no_memory)
+                except (ImportError, OSError, RuntimeError) as e:
+                    results[case_id] = {"skipped": f"{type(e).__name__}: {e}"}
+                print(f"{case_id} done", file=sys.stderr)
+
+    regressions = []
+    if args.baseline:
+        regressions = harness.compare(results, harness.load_baseline(args.baseline), args.threshold)
+    print(harness.format_table(results))
+    if args.save_baseline:
+        harness.save_baseline(args.save_baseline, {k: v for k, v in results.items() if "skipped" not in v})
+    if regressions:
+        print(f"\nRegressions over {args.threshold:.0%}: {', '.join(regressions)}")
+        if args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,33 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_WEBUI_PORT = 17861
+
+# config reads the environment at import, a .env or the shell still wins
+_tmp_dir = tempfile.mkdtemp(prefix="ai-api-server-tests-")
+for key, value in {
+    "BATCH_NO": "0",
+    "RMQ_PORT": "5672",
+    "RMQ_HOST": "",
+    "CONTROLNET_WEIGHTING": "[]",
+    "POS_PROMPT": "portrait",
+    "NEG_PROMPT": "blurry",
+    "PRESET_DIR": os.path.join(_tmp_dir, "preset"),
+    "LOG_PATH": os.path.join(_tmp_dir, "test.log"),
+    "STORAGE_BACKEND": "local",
+    "LOCAL_STORAGE_DIR": os.path.join(_tmp_dir, "storage"),
+    "CHECKPOINT_DIR": os.path.join(_tmp_dir, "checkpoints"),
+    "ASSET_CACHE_DIR": "",
+    "BUCKET_NAME": "test-src",
+    "BUCKET_PREFIX": "test",
+    "NOTIFY_URL": "",
+    "WEBUI_URLS": f"http://127.0.0.1:{FAKE_WEBUI_PORT}",
+    "CUDA_VISIBLE_DEVICES": "",
+}.items():
+    os.environ.setdefault(key, value)
+
+# Server modules use flat imports, as when started with "python ai_api_server/app.py"
+sys.path.insert(0, os.path.join(ROOT, "ai_api_server"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
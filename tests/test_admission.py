@@ -0,0 +1,95 @@
+import asyncio
+from admission import AdmissionController
+from config import STAGE_LIMITS
+from pipeline import Pipeline, PipelineResult, Stage
+
+
+async def noop(inputs):
+    return None
+
+
+PIPELINE = Pipeline([Stage("segment", noop, resource="preprocess"), Stage("t2i", noop, deps=["segment"], resource="webui")])
+
+
+def finished(segment_sec: float, t2i_sec: float, restored=()) -> PipelineResult:
+    return PipelineResult(results={}, timings={"segment": segment_sec, "t2i": t2i_sec}, waits={}, restored=list(restored))
+
+
+def test_every_order_is_admitted_before_the_first_one_finishes():
+    controller = AdmissionController(slo_sec=1)
+    for _ in range(10):
+        controller.start()
+    assert controller.check() == (True, 0)
+
+
+def test_orders_that_would_miss_the_slo_are_turned_away():
+    controller = AdmissionController(slo_sec=200, alpha=1.0)
+    controller.observe(PIPELINE, finished(10, 40))
+    assert controller.estimate() == (50, 0)
+    # An idle server always admits, even when one order alone exceeds the SLO
+    controller.observe(PIPELINE, finished(10, 300))
+    assert controller.check() == (True, 0)
+
+    controller.observe(PIPELINE, finished(10, 40))
+    orders = STAGE_LIMITS["webui"] * 2
+    for _ in range(orders):
+        controller.start()
+    # Queued behind the in-flight orders on the WebUI, the busiest resource
+    predicted, wait = controller.estimate()
+    assert wait == orders * 40 / STAGE_LIMITS["webui"]
+    assert controller.check() == (True, 0)
+    for _ in range(orders):
+        controller.start()
+    admitted, retry_after = controller.check()
+    assert not admitted and retry_after >= 1
+    for _ in range(orders * 2):
+        controller.finish()
+    assert controller.check() == (True, 0)
+
+
+def test_restored_orders_are_not_observed():
+    controller = AdmissionController(alpha=1.0)
+    controller.observe(PIPELINE, finished(10, 40))
+    controller.observe(PIPELINE, finished(0, 0, restored=["segment"]))
+    assert controller.service_sec == 50
+
+
+def test_wait_admitted_gives_up_after_max_hold():
+    controller = AdmissionController(slo_sec=1, alpha=1.0)
+    controller.observe(PIPELINE, finished(10, 40))
+    controller.start()
+    assert asyncio.run(controller.wait_admitted(poll_sec=0.01, max_hold_sec=0.05)) is False
+    controller.finish()
+    assert asyncio.run(controller.wait_admitted(poll_sec=0.01, max_hold_sec=0.05)) is True
+
+
+def test_duplicate_orders_are_counted_once(monkeypatch):
+    import workflow
+    from admission import admission_controller
+    from dto import ProcessRequestParam
+
+    release = None
+    inflight = []
+
+    async def run(req_payload, write_db):
+        inflight.append(admission_controller.inflight)
+        await release.wait()
+        return "result"
+
+    async def orders():
+        nonlocal release
+        release = asyncio.Event()
+        payload = ProcessRequestParam.validate({"id": "dup", "param": {"gender": "girl", "hair": "long", "glasses": False},
+                                                "email": "", "userId": "", "imagePaths": [], "requestedAt": "2024-05-01T00:00:00",
+                                                "title": ""})
+        runs = [asyncio.create_task(workflow.run_profile_pipeline(payload)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        inflight.append(admission_controller.inflight)
+        release.set()
+        return await asyncio.gather(*runs)
+
+    monkeypatch.setattr(workflow, "_run", run)
+    before = admission_controller.inflight
+    assert asyncio.run(orders()) == ["result"] * 3
+    assert inflight == [before + 1, before + 1]
+    assert admission_controller.inflight == before
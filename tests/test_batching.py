@@ -0,0 +1,69 @@
+import asyncio
+from batching import MicroBatcher
+
+
+def doubling(calls):
+    def fn(items):
+        calls.append(list(items))
+        return [item * 2 for item in items]
+    return fn
+
+
+async def submit_all(batcher, requests):
+    try:
+        return await asyncio.gather(*[batcher.submit(items) for items in requests], return_exceptions=True)
+    finally:
+        batcher.close()
+
+
+def test_concurrent_requests_share_one_batch():
+    calls = []
+    batcher = MicroBatcher("test", doubling(calls), max_size=16, max_wait_sec=0.05)
+    results = asyncio.run(submit_all(batcher, [[1, 2], [3], [4, 5, 6]]))
+    assert results == [[2, 4], [6], [8, 10, 12]]
+    assert calls == [[1, 2, 3, 4, 5, 6]]
+
+
+def test_batches_close_at_max_size():
+    calls = []
+    batcher = MicroBatcher("test", doubling(calls), max_size=3, max_wait_sec=0.05)
+    results = asyncio.run(submit_all(batcher, [[1, 2], [3], [4, 5], [6, 7, 8, 9]]))
+    assert results == [[2, 4], [6], [8, 10], [12, 14, 16, 18]]
+    # A request is never split, one larger than max_size runs alone
+    assert calls == [[1, 2, 3], [4, 5], [6, 7, 8, 9]]
+
+
+def test_errors_reach_every_request_of_the_batch():
+    def fail(items):
+        raise RuntimeError("model failed")
+
+    batcher = MicroBatcher("test", fail, max_size=16, max_wait_sec=0.05)
+    results = asyncio.run(submit_all(batcher, [[1], [2]]))
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_batcher_survives_a_new_event_loop():
+    calls = []
+    batcher = MicroBatcher("test", doubling(calls), max_size=16, max_wait_sec=0.01)
+    assert asyncio.run(batcher.submit([])) == []
+    assert asyncio.run(submit_all(batcher, [[1]])) == [[2]]
+    assert asyncio.run(submit_all(batcher, [[2]])) == [[4]]
+    assert calls == [[1], [2]]
+
+
+def test_cancelled_requests_are_dropped():
+    calls = []
+    batcher = MicroBatcher("test", doubling(calls), max_size=16, max_wait_sec=0.05)
+
+    async def run():
+        cancelled = asyncio.create_task(batcher.submit([1]))
+        kept = asyncio.create_task(batcher.submit([2]))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        try:
+            return await kept
+        finally:
+            batcher.close()
+
+    assert asyncio.run(run()) == [4]
+    assert calls == [[2]]
@@ -0,0 +1,150 @@
+import asyncio
+import inspect
+import os
+import time
+import httpx
+import numpy as np
+import pytest
+import harness
+from conftest import FAKE_WEBUI_PORT, ROOT
+from fake_webui import FakeWebUIConfig, FakeWebUIServer
+
+
+class CenterFaceDetector:
+    """ One face box in the middle of every photo. """
+    def detect(self, images, imgsz=640, max_det=1):
+        import face_preprocess
+        results = []
+        for image in images:
+            height, width = image.shape[:2]
+            xyxy = np.array([[width * 0.35, height * 0.3, width * 0.65, height * 0.6]], dtype=np.float32)
+            boxes = face_preprocess.OrtBoxes(xyxy, np.array([0.9], dtype=np.float32), np.array([0]))
+            results.append(face_preprocess.OrtResult(boxes, (height, width)))
+        return results
+
+
+class EllipseHeadSegmenter:
+    def segment_masks(self, images):
+        masks = []
+        for image in images:
+            height, width = image.shape[:2]
+            ys, xs = np.mgrid[0:height, 0:width]
+            masks.append(((xs - width / 2) / (width * 0.4)) ** 2 + ((ys - height / 2) / (height * 0.45)) ** 2 <= 1)
+        return masks
+
+
+@pytest.fixture(scope="module")
+def served():
+    """ In-process app against the fake WebUI, with stand-in models and presets. """
+    import api
+    import face_preprocess
+    import setup
+    import utils
+    from cloud_utils import storage_backend
+    from config import BUCKET_NAME
+
+    cwd = os.getcwd()
+    os.chdir(ROOT)    # frames/ is read relative to the working directory
+    server = FakeWebUIServer(FakeWebUIConfig(t2i_latency="fixed:0.05", facemodel_latency="fixed:0.05", seed=0),
+                             port=FAKE_WEBUI_PORT).start()
+    utils.frame_store.load()
+    preset = utils.encodeImg2Base64(harness.synthetic_photo((64, 64)))
+    api._preset_images.update({"female": preset, "male": preset})
+    face_preprocess.face_detector, face_preprocess.head_segmenter = CenterFaceDetector(), EllipseHeadSegmenter()
+    paths = []
+    for i in range(2):
+        paths.append(f"e2e/{i}.jpg")
+        storage_backend.write_bytes(BUCKET_NAME, paths[-1], harness.phone_jpeg((480, 640), seed=i), "image/jpeg")
+    setup.startup_state.ready = True
+    try:
+        yield server, paths
+    finally:
+        setup.startup_state.ready = False
+        face_preprocess.face_detector, face_preprocess.head_segmenter = None, None
+        server.stop()
+        os.chdir(cwd)
+
+
+def order(order_id: str, paths, gender: str = "girl") -> dict:
+    return {"id": order_id, "param": {"gender": gender, "hair": "long", "glasses": False},
+            "email": "e2e@example.com", "userId": "e2e", "imagePaths": paths,
+            "requestedAt": "2024-05-01T00:00:00", "title": "e2e"}
+
+
+async def post_orders(orders):
+    import pipeline
+    import utils
+    from app import app
+    # Limiters and HTTP clients are bound to the loop of the first run
+    pipeline._stage_limiters.clear()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test", timeout=60) as client:
+            return await asyncio.gather(*[client.post("/api/process", json=body) for body in orders])
+    finally:
+        await utils.closeHttpClients()
+
+
+def test_process_orders_end_to_end(served):
+    server, paths = served
+    responses = asyncio.run(post_orders([order(f"e2e-{i}", paths) for i in range(3)]))
+    for response in responses:
+        assert response.status_code == 200, response.text
+        # 3 crimson + 3 black + 2 ivory generated images, one framed output each
+        assert len(response.json()["data"]["image_paths"]) == 8
+    assert server.fake.requests["txt2img"] >= 3
+    from admission import admission_controller
+    assert admission_controller.inflight == 0
+
+
+def test_retry_resumes_from_checkpointed_t2i(served, monkeypatch):
+    import cloud_utils
+    server, paths = served
+    upload_images = cloud_utils.upload_images
+
+    async def fail_upload(images, dest_file_names):
+        return False
+
+    monkeypatch.setattr(cloud_utils, "upload_images", fail_upload)
+    assert asyncio.run(post_orders([order("e2e-retry", paths)]))[0].status_code == 500
+    generated = server.fake.requests["txt2img"]
+    from checkpoint import checkpoint_store
+    # The photos are downloaded again if needed, the expensive stages are saved
+    assert not checkpoint_store.has("e2e-retry", "download")
+    assert checkpoint_store.has("e2e-retry", "segment")
+
+    # The generated images were saved encoded, the retry merges them without calling WebUI again
+    monkeypatch.setattr(cloud_utils, "upload_images", upload_images)
+    response = asyncio.run(post_orders([order("e2e-retry", paths)]))[0]
+    assert response.status_code == 200, response.text
+    assert len(response.json()["data"]["image_paths"]) == 8
+    assert server.fake.requests["txt2img"] == generated
+
+
+def test_failed_order_cancels_pending_merges(served, monkeypatch):
+    import utils
+    import workflow
+    server, paths = served
+    pipelines = []
+    build_profile_pipeline = workflow.build_profile_pipeline
+
+    def capture(*args, **kwargs):
+        pipelines.append(build_profile_pipeline(*args, **kwargs))
+        return pipelines[-1]
+
+    def slow_merge(image, bg, idx):
+        # The first streamed frame makes every later txt2img fail while its merges are still running
+        server.fake.config.failure_rate = 1.0
+        time.sleep(0.5)
+
+    monkeypatch.setattr(workflow, "build_profile_pipeline", capture)
+    monkeypatch.setattr(utils, "merge_one_frame", slow_merge)
+    try:
+        responses = asyncio.run(post_orders([order("e2e-fail", paths)]))
+    finally:
+        server.fake.config.failure_rate = 0.0
+    assert responses[0].status_code == 500
+
+    cancel_pending_merges = pipelines[0].on_finish[-1]
+    merge_tasks = inspect.getclosurevars(cancel_pending_merges).nonlocals["merge_tasks"]
+    tasks = [task for tasks in merge_tasks.values() for task in tasks.values()]
+    assert tasks and all(task.cancelled() for task in tasks)
@@ -0,0 +1,111 @@
+import asyncio
+import os
+import pytest
+from PIL import Image
+import face_models
+import utils
+from face_models import MODEL_PREFIX, FaceModelManager
+
+BACKEND = "http://webui:7860"
+OTHER_BACKEND = "http://webui-b:7860"
+
+
+@pytest.fixture
+def webui(monkeypatch):
+    """ Records the face models built, with one model left over by a previous run. """
+    built = []
+
+    async def build_face_model(img_list, model_name, base_url=None):
+        await asyncio.sleep(0.01)
+        built.append(model_name)
+        return True, {}
+
+    async def list_face_models(url, timeout=None):
+        return {"facemodels": [MODEL_PREFIX + "previous", "manual"]}
+
+    monkeypatch.setattr(face_models, "build_face_model", build_face_model)
+    monkeypatch.setattr(utils, "requestGetAsync", list_face_models)
+    return built
+
+
+def photos(seed: int):
+    return [Image.new("RGB", (8, 8), (seed, i, 0)) for i in range(3)]
+
+
+def test_the_same_photos_share_one_model(webui):
+    manager = FaceModelManager(max_models=10)
+
+    async def acquire_twice():
+        return await asyncio.gather(manager.acquire(BACKEND, photos(1)), manager.acquire(BACKEND, photos(1)[::-1]))
+
+    (succ_a, name_a), (succ_b, name_b) = asyncio.run(acquire_twice())
+    assert succ_a and succ_b and name_a == name_b
+    assert webui == [name_a]
+    assert manager.refs[(BACKEND, name_a)] == 2
+    # The model on the backend is reused by a later order
+    assert asyncio.run(manager.acquire(BACKEND, photos(1))) == (True, name_a)
+    assert webui == [name_a]
+
+
+def test_least_recently_used_models_are_evicted(webui, tmp_path):
+    manager = FaceModelManager(max_models=2, model_dirs={BACKEND: str(tmp_path)})
+    names = [manager.model_name(photos(seed)) for seed in range(3)]
+    for name in names + [MODEL_PREFIX + "previous"]:
+        (tmp_path / f"{name}.safetensors").write_bytes(b"")
+
+    async def orders():
+        # The first stays in flight while the others come and go
+        assert await manager.acquire(BACKEND, photos(0)) == (True, names[0])
+        for seed in (1, 2):
+            assert await manager.acquire(BACKEND, photos(seed)) == (True, names[seed])
+            manager.release(BACKEND, names[seed])
+
+    asyncio.run(orders())
+    # Leftovers from a previous run go first, a model in use is kept even if least recently used
+    assert list(manager.models[BACKEND]) == [names[0], names[2]]
+    assert sorted(os.listdir(tmp_path)) == sorted(f"{name}.safetensors" for name in (names[0], names[2]))
+    manager.release(BACKEND, names[0])
+    assert (BACKEND, names[0]) not in manager.refs
+
+
+def test_failed_builds_are_not_indexed(monkeypatch, webui):
+    async def build_face_model(img_list, model_name, base_url=None):
+        return False, "No face found"
+
+    monkeypatch.setattr(face_models, "build_face_model", build_face_model)
+    manager = FaceModelManager()
+    assert asyncio.run(manager.acquire(BACKEND, photos(0))) == (False, "No face found")
+    assert manager.model_name(photos(0)) not in manager.models[BACKEND]
+    assert manager.refs == {}
+
+
+def test_models_are_only_deleted_on_their_own_backend(webui, tmp_path):
+    manager = FaceModelManager(max_models=1, model_dirs={BACKEND: str(tmp_path)})
+    names = [manager.model_name(photos(seed)) for seed in range(2)]
+    for name in names:
+        (tmp_path / f"{name}.safetensors").write_bytes(b"")
+
+    async def orders():
+        for seed in range(2):
+            assert await manager.acquire(OTHER_BACKEND, photos(seed)) == (True, names[seed])
+            manager.release(OTHER_BACKEND, names[seed])
+
+    asyncio.run(orders())
+    # Evicted from the other backend, whose model directory is not mounted here
+    assert list(manager.models[OTHER_BACKEND]) == [names[1]]
+    assert sorted(os.listdir(tmp_path)) == sorted(f"{name}.safetensors" for name in names)
+    assert manager._undeletable == {OTHER_BACKEND}
+
+
+def test_failed_listing_is_synced_again(monkeypatch, webui):
+    listings = [{"error": "ConnectError"}, {"facemodels": [MODEL_PREFIX + "previous"]}]
+
+    async def list_face_models(url, timeout=None):
+        return listings.pop(0)
+
+    monkeypatch.setattr(utils, "requestGetAsync", list_face_models)
+    manager = FaceModelManager()
+    asyncio.run(manager._sync(BACKEND))
+    assert BACKEND not in manager._synced
+    asyncio.run(manager._sync(BACKEND))
+    assert BACKEND in manager._synced and MODEL_PREFIX + "previous" in manager.models[BACKEND]
@@ -0,0 +1,138 @@
+import io
+import numpy as np
+import onnx
+import pytest
+import harness
+from onnx import TensorProto, helper
+from PIL import Image
+from face_preprocess import LazyImage, OrtFaceDetector, largest_component_mask
+
+IMGSZ = 64
+PAD = OrtFaceDetector.PAD_VALUE / 255.0
+# Letterbox space predictions as the model emits them: center x, center y, width, height, face score
+PREDICTIONS = [
+    (32, 32, 20, 16, 0.9),
+    (33, 32, 20, 16, 0.8),    # the same face again, NMS drops it
+    (10, 30, 8, 8, 0.6),
+    (50, 40, 8, 8, 0.1),      # below conf_thres
+    (60, 20, 16, 8, 0.5),     # reaches past the right edge of the photo
+]
+
+
+@pytest.fixture(scope="module")
+def detector(tmp_path_factory) -> OrtFaceDetector:
+    """ yolov8-face shaped model that ignores its input and always predicts PREDICTIONS. """
+    constant = np.array(PREDICTIONS, dtype=np.float32).T[None]
+    graph = helper.make_graph(
+        [helper.make_node("ReduceSum", ["images"], ["total"], keepdims=0),
+         helper.make_node("Mul", ["total", "zero"], ["nothing"]),
+         helper.make_node("Add", ["predictions", "nothing"], ["output0"])],
+        "detector",
+        [helper.make_tensor_value_info("images", TensorProto.FLOAT, [1, 3, IMGSZ, IMGSZ])],
+        [helper.make_tensor_value_info("output0", TensorProto.FLOAT, list(constant.shape))],
+        initializer=[onnx.numpy_helper.from_array(constant, "predictions"),
+                     onnx.numpy_helper.from_array(np.array(0, dtype=np.float32), "zero")])
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 17)])
+    model.ir_version = 8
+    helper.set_model_props(model, {"names": "{0: 'face'}"})
+    path = tmp_path_factory.mktemp("models") / "face.onnx"
+    onnx.save(model, str(path))
+    return OrtFaceDetector(str(path), providers=["CPUExecutionProvider"])
+
+
+def test_model_shape_is_read_from_the_session(detector):
+    assert (detector.max_batch, detector.input_size, detector.num_classes) == (1, IMGSZ, 1)
+
+
+def test_letterbox_keeps_the_aspect_ratio_and_pads(detector):
+    image = np.zeros((64, 128, 3), dtype=np.uint8)
+    image[..., 0] = 255
+    batch, transforms = detector.letterbox([image], IMGSZ)
+    assert batch.shape == (1, 3, IMGSZ, IMGSZ)
+    assert transforms == [(0.5, 0, 16)]
+    # Padded above and below, the photo in between with its channels flipped as ultralytics does
+    assert np.allclose(batch[0, :, :16], PAD) and np.allclose(batch[0, :, 48:], PAD)
+    assert np.allclose(batch[0, 0, 16:48], 0.0) and np.allclose(batch[0, 2, 16:48], 1.0)
+
+
+def test_boxes_are_filtered_suppressed_and_mapped_back(detector):
+    image = np.zeros((64, 128, 3), dtype=np.uint8)
+    result, = detector.detect([image], max_det=10)
+    assert result.orig_shape == (64, 128)
+    np.testing.assert_allclose(result.boxes.conf, [0.9, 0.6, 0.5])
+    np.testing.assert_allclose(result.boxes.xyxy, [[44, 16, 84, 48], [12, 20, 28, 36], [104, 0, 128, 16]])
+    assert result.boxes.cls.tolist() == [0, 0, 0]
+
+
+def test_max_det_keeps_the_best_boxes(detector):
+    images = [np.zeros((64, 128, 3), dtype=np.uint8), np.zeros((128, 64, 3), dtype=np.uint8)]
+    results = detector.detect(images)
+    # The static model runs one image at a time, each keeps only its best box
+    assert [len(result.boxes) for result in results] == [1, 1]
+    np.testing.assert_allclose(results[0].boxes.xyxy, [[44, 16, 84, 48]])
+    crops = detector.crop_faces(results=results[:1], image=images[:1], margin=0)
+    assert crops[0].shape == (32, 40, 3)
+
+
+def test_size_is_that_of_the_aligned_photo():
+    # Stored 1600x1200 landscape with EXIF orientation 6
+    image = LazyImage(harness.phone_jpeg((1200, 1600)))
+    assert image.format == "JPEG"
+    assert image.size == (1200, 1600)
+    assert image.decode().size == (1200, 1600)
+
+
+def test_jpeg_proxy_is_draft_decoded():
+    image = LazyImage(harness.phone_jpeg((1200, 1600)))
+    # 1/4 DCT scale is the smallest that keeps both sides >= 200
+    assert image.decode(200).size == (300, 400)
+    proxy, sx, sy = image.proxy(side=200)
+    assert proxy.shape == (400, 300, 3)
+    assert (sx, sy) == (0.25, 0.25)
+
+
+def test_crop_is_decoded_at_the_needed_scale():
+    image = LazyImage(harness.phone_jpeg((1200, 1600)))
+    full = image.crop((300, 400, 900, 1000), min_side=0)
+    reduced = image.crop((300, 400, 900, 1000), min_side=150)
+    assert full.shape == (600, 600, 3)
+    assert reduced.shape == (150, 150, 3)
+    # Same region, only at a lower resolution
+    downscaled = np.asarray(Image.fromarray(full).resize((150, 150), Image.BILINEAR), dtype=np.float32)
+    assert np.abs(downscaled - reduced).mean() < 12
+
+
+def test_small_crop_keeps_every_pixel():
+    image = LazyImage(harness.phone_jpeg((1200, 1600)))
+    # Already below min_side, no DCT scale is small enough
+    small = image.crop((300, 400, 500, 600), min_side=1024)
+    assert small.shape == (200, 200, 3)
+    assert np.array_equal(small, np.asarray(image.decode())[400:600, 300:500])
+
+
+def test_mpo_takes_the_draft_path():
+    photo = harness.synthetic_photo((1200, 1600))
+    buffer = io.BytesIO()
+    photo.save(buffer, format="MPO", save_all=True, append_images=[photo])
+    image = LazyImage(buffer.getvalue())
+    assert image.format == "MPO"
+    assert image.decode(200).size == (300, 400)
+
+
+def test_other_formats_are_decoded_once():
+    buffer = io.BytesIO()
+    harness.synthetic_photo((320, 240)).save(buffer, format="PNG")
+    image = LazyImage(buffer.getvalue())
+    decoded = image.decode(100)
+    assert decoded.size == (320, 240)
+    assert image.decode() is decoded
+    image.release()
+    assert image.decode() is not decoded
+
+
+def test_cleanup_keeps_the_full_resolution_outline():
+    ys, xs = np.mgrid[0:1000, 0:900]
+    head = (xs - 450) ** 2 / 300 ** 2 + (ys - 480) ** 2 / 380 ** 2 <= 1
+    speck = (xs - 60) ** 2 + (ys - 60) ** 2 <= 15 ** 2
+    cleaned = largest_component_mask(head | speck, max_side=256)
+    assert np.array_equal(cleaned, head)
@@ -0,0 +1,51 @@
+import base64
+import json
+import pytest
+from json_stream import Base64ArrayExtractor
+
+PAYLOADS = [bytes(range(256)) * 3, b"\x89PNG small", b"x" * 1001]
+
+
+def t2i_response() -> bytes:
+    """ Shaped like a txt2img response, with decoys for the key and escaped strings. """
+    return json.dumps({
+        "parameters": {"images": ["bm90IHRoaXM="], "prompt": "a \"quoted\" \\ prompt"},
+        "note": "images",
+        "images": [base64.b64encode(payload).decode() for payload in PAYLOADS],
+        "info": "{\"seed\": 1}",
+    }).encode()
+
+
+def feed_in_chunks(document: bytes, size: int) -> list:
+    extractor = Base64ArrayExtractor("images")
+    items = []
+    for i in range(0, len(document), size):
+        items += extractor.feed(document[i:i + size])
+    return items
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 4, 7, 64, 1 << 20])
+def test_items_are_decoded_whatever_the_chunking(size):
+    assert feed_in_chunks(t2i_response(), size) == PAYLOADS
+
+
+def test_items_are_returned_as_soon_as_complete():
+    document = t2i_response()
+    first_end = document.index(base64.b64encode(PAYLOADS[0])) + len(base64.b64encode(PAYLOADS[0]))
+    extractor = Base64ArrayExtractor("images")
+    assert extractor.feed(document[:first_end]) == []
+    assert extractor.feed(document[first_end:first_end + 1]) == [PAYLOADS[0]]
+    assert extractor.feed(document[first_end + 1:]) == PAYLOADS[1:]
+
+
+def test_escaped_slashes_are_unescaped():
+    # Some JSON encoders write "/" as "\/", which occurs in base64
+    payload = b"\xff\xef\xff" * 10
+    encoded = base64.b64encode(payload).decode()
+    assert "/" in encoded
+    document = ('{"images": ["' + encoded.replace("/", "\\/") + '"]}').encode()
+    assert feed_in_chunks(document, 5) == [payload]
+
+
+def test_other_keys_yield_nothing():
+    assert feed_in_chunks(b'{"image": ["aGk="], "other": {"images": ["aGk="]}}', 3) == []
@@ -0,0 +1,74 @@
+import json
+import logging
+import multiprocessing
+import queue
+import logger as log
+from config import LOG_PATH
+
+
+def record(msg: str = "Error-POST", lineno: int = 10) -> logging.LogRecord:
+    return logging.LogRecord("test", logging.ERROR, "workflow.py", lineno, msg, None, None)
+
+
+def test_records_are_queued_with_their_request_id():
+    records = queue.Queue()
+    handler = log.ContextQueueHandler(records)
+    with log.request_context("order-1"):
+        handler.handle(record("Timings:%s"))
+    handler.handle(record())
+    tagged, untagged = records.get_nowait(), records.get_nowait()
+    # Formatting is left to the listener thread
+    assert (tagged.request_id, tagged.msg) == ("order-1", "Timings:%s")
+    assert untagged.request_id is None
+
+
+def test_full_queue_drops_instead_of_blocking():
+    handler = log.ContextQueueHandler(queue.Queue(maxsize=1))
+    dropped = log.ContextQueueHandler.dropped
+    handler.handle(record())
+    handler.handle(record())
+    assert log.ContextQueueHandler.dropped == dropped + 1
+
+
+def test_sampling_keeps_a_burst_per_call_site(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(log.time, "monotonic", lambda: now[0])
+    sampler = log.SamplingFilter(burst=2, window_sec=10)
+    assert [sampler.filter(record()) for _ in range(5)] == [True, True, False, False, False]
+    # Another call site has its own budget
+    assert sampler.filter(record(lineno=11))
+
+    now[0] += 10
+    kept = record()
+    assert sampler.filter(kept)
+    assert kept.sampled_out == 3
+    assert not hasattr(record(), "sampled_out")
+
+
+def test_json_records_keep_fields_typed():
+    entry = record("Timings:order-1")
+    entry.request_id = "order-1"
+    entry.fields = {"t2i_sec": 1.5, "restored": "", "resumed": False, "note": None, "long": "x" * 10}
+    formatted = json.loads(log.JsonFormatter().format(entry))
+    assert formatted["request_id"] == "order-1" and formatted["level"] == "ERROR"
+    assert formatted["fields"] == {"t2i_sec": 1.5, "restored": "", "resumed": False, "note": None, "long": "x" * 10}
+
+
+def test_listener_writes_the_log_file():
+    log.logger.warning("Listener:check", extra={"fields": {"answer": 42}})
+    log.log_queue.join()
+    with open(LOG_PATH) as f:
+        lines = [json.loads(line) for line in f if "Listener:check" in line]
+    assert lines[-1]["fields"] == {"answer": 42}
+
+
+def handler_types() -> list:
+    import logger
+    return [type(handler).__name__ for handler in logger.handlers]
+
+
+def test_only_the_main_process_writes_the_file():
+    assert "RotatingFileHandler" in handler_types()
+    # Spawned preprocess workers import the module again
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        assert pool.apply(handler_types) == ["StreamHandler"]
@@ -0,0 +1,156 @@
+import asyncio
+import os
+import threading
+import pytest
+from checkpoint import CheckpointStore
+from pipeline import Pipeline, Stage
+
+
+def stage_fn(calls, name, fn=None, fail=False):
+    async def run(inputs):
+        calls.append(name)
+        if fail:
+            raise RuntimeError(f"{name} failed")
+        return fn(inputs) if fn else name
+    return run
+
+
+def order_pipeline(calls, store, fail_t2i=False) -> Pipeline:
+    """ download -> segment -> t2i -> upload, like one background of an order. """
+    return Pipeline([
+        Stage("download", stage_fn(calls, "download", lambda _: b"photo"), checkpoint=True),
+        Stage("segment", stage_fn(calls, "segment", lambda inputs: inputs["download"] + b":head"), deps=["download"]),
+        Stage("t2i", stage_fn(calls, "t2i", lambda inputs: [inputs["segment"]], fail=fail_t2i), deps=["segment"], checkpoint=True),
+        Stage("upload", stage_fn(calls, "upload", lambda inputs: [f"{len(inputs['t2i'])}.png"]), deps=["t2i"], checkpoint=True),
+    ], checkpoint_store=store, checkpoint_key="order-1")
+
+
+def test_stages_get_the_results_of_their_deps():
+    calls = []
+    pipeline = Pipeline([
+        Stage("sum", stage_fn(calls, "sum", lambda inputs: inputs["left"] + inputs["right"]), deps=["left", "right"]),
+        Stage("left", stage_fn(calls, "left", lambda _: 1)),
+        Stage("right", stage_fn(calls, "right", lambda _: 2)),
+    ])
+    result = asyncio.run(pipeline.run())
+    assert result.results == {"left": 1, "right": 2, "sum": 3}
+    assert calls[-1] == "sum"
+    assert set(result.timings) == {"left", "right", "sum"}
+
+
+def test_independent_stages_overlap():
+    running, peak = [0], [0]
+
+    async def slow(inputs):
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        await asyncio.sleep(0.05)
+        running[0] -= 1
+
+    pipeline = Pipeline([Stage("crimson", slow), Stage("black", slow), Stage("ivory", slow)])
+    asyncio.run(pipeline.run())
+    assert peak[0] == 3
+
+
+def test_invalid_graphs_are_rejected():
+    noop = stage_fn([], "noop")
+    with pytest.raises(ValueError):
+        Pipeline([Stage("a", noop, deps=["b"]), Stage("b", noop, deps=["a"])])
+    with pytest.raises(ValueError):
+        Pipeline([Stage("a", noop, deps=["missing"])])
+    with pytest.raises(ValueError):
+        Pipeline([Stage("a", noop), Stage("a", noop)])
+
+
+def test_failure_cancels_running_stages_and_calls_on_finish():
+    finished, cancelled = [], []
+
+    async def slow(inputs):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append("slow")
+            raise
+
+    pipeline = Pipeline([Stage("slow", slow), Stage("fail", stage_fn([], "fail", fail=True))],
+                        on_finish=[lambda: finished.append(True)])
+    with pytest.raises(RuntimeError):
+        asyncio.run(pipeline.run())
+    assert cancelled == ["slow"]
+    assert finished == [True]
+
+
+def test_resume_after_the_last_checkpoint(tmp_path):
+    store = CheckpointStore(root=str(tmp_path))
+    calls = []
+    with pytest.raises(RuntimeError):
+        asyncio.run(order_pipeline(calls, store, fail_t2i=True).run())
+    assert calls == ["download", "segment", "t2i"]
+
+    # The retry restores the download, only the unsaved stages run again
+    calls.clear()
+    result = asyncio.run(order_pipeline(calls, store).run())
+    assert calls == ["segment", "t2i", "upload"]
+    assert result.restored == ["download"]
+    assert result.results["upload"] == ["1.png"]
+
+    # Everything needed is saved, a duplicate runs nothing
+    calls.clear()
+    result = asyncio.run(order_pipeline(calls, store).run())
+    assert calls == []
+    assert result.restored == ["upload"]
+
+
+def test_unreadable_checkpoint_runs_the_stage_again(tmp_path):
+    store = CheckpointStore(root=str(tmp_path))
+    asyncio.run(order_pipeline([], store).run())
+    with open(store._path("order-1", "upload"), "wb") as f:
+        f.write(b"not a pickle")
+    calls = []
+    result = asyncio.run(order_pipeline(calls, store).run())
+    assert calls == ["upload"]
+    assert result.restored == ["t2i"]
+    assert result.results["upload"] == ["1.png"]
+
+
+def test_checkpoints_are_looked_up_off_the_event_loop(tmp_path):
+    store = CheckpointStore(root=str(tmp_path))
+    asyncio.run(order_pipeline([], store).run())
+    threads = []
+    has = store.has
+    store.has = lambda key, stage: threads.append(threading.current_thread()) or has(key, stage)
+    asyncio.run(order_pipeline([], store).run())
+    assert threads and threading.main_thread() not in threads
+
+
+def test_checkpoint_round_trip_and_prune(tmp_path):
+    store = CheckpointStore(root=str(tmp_path))
+    assert store.load("order-1", "download") == (False, None)
+    store.save("order-1", "download", [b"a", b"b"])
+    store.save("order-1", "upload", ["1.png"])
+    assert store.load("order-1", "download") == (True, [b"a", b"b"])
+    store.prune("order-1", keep=["upload"])
+    assert not store.has("order-1", "download")
+    assert store.has("order-1", "upload")
+
+
+def test_concurrent_saves_of_one_order_do_not_collide(tmp_path):
+    store = CheckpointStore(root=str(tmp_path))
+    errors = []
+
+    def save(value: int):
+        try:
+            for _ in range(20):
+                store.save("order-1", "t2i", [value] * 1000)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save, args=(value,)) for value in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    succ, value = store.load("order-1", "t2i")
+    assert succ and len(set(value)) == 1
+    assert os.listdir(os.path.dirname(store._path("order-1", "t2i"))) == ["t2i.pkl"]
@@ -0,0 +1,81 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import pytest
+import preprocess_pool
+from preprocess_pool import PreprocessPool, put_shared, release_shared
+
+PHOTO = b"\xff\xd8 encoded photo"
+
+
+@pytest.fixture
+def pool():
+    """ Runs the worker function on a thread, without models. """
+    pool = PreprocessPool(workers=1)
+    pool.executor.shutdown()
+    pool.executor = ThreadPoolExecutor(max_workers=1)
+    yield pool
+    pool.executor.shutdown()
+
+
+def exists(name: str) -> bool:
+    try:
+        shm = SharedMemory(name=name)
+    except FileNotFoundError:
+        return False
+    shm.close()
+    return True
+
+
+def fake_worker(created, fail=False, started=None, proceed=None):
+    def segment(photo_descs, out_prefix):
+        if started is not None:
+            started.set()
+            proceed.wait(5)
+        blocks, descs = [], []
+        for i in range(2):
+            shm, desc = put_shared(np.full((4, 4), i, dtype=np.uint8), f"{out_prefix}_{i}")
+            blocks.append(shm)
+            descs.append(desc)
+            created.append(desc.name)
+        release_shared(blocks)
+        if fail:
+            raise RuntimeError("worker failed after writing its outputs")
+        return [tuple(descs)], {}
+    return segment
+
+
+def test_outputs_are_read_and_unlinked(pool, monkeypatch):
+    created = []
+    monkeypatch.setattr(preprocess_pool, "_segment_in_worker", fake_worker(created))
+    head, = asyncio.run(pool.segment_photos([PHOTO]))
+    assert head.crop.tolist() == np.zeros((4, 4)).tolist() and head.mask.tolist() == np.ones((4, 4)).tolist()
+    assert created and not any(exists(name) for name in created)
+
+
+def test_failed_worker_outputs_are_unlinked(pool, monkeypatch):
+    created = []
+    monkeypatch.setattr(preprocess_pool, "_segment_in_worker", fake_worker(created, fail=True))
+    with pytest.raises(RuntimeError):
+        asyncio.run(pool.segment_photos([PHOTO]))
+    assert created and not any(exists(name) for name in created)
+
+
+def test_cancelled_order_outputs_are_unlinked(pool, monkeypatch):
+    created, started, proceed = [], threading.Event(), threading.Event()
+    monkeypatch.setattr(preprocess_pool, "_segment_in_worker", fake_worker(created, started=started, proceed=proceed))
+
+    async def cancel():
+        task = asyncio.create_task(pool.segment_photos([PHOTO]))
+        await asyncio.to_thread(started.wait, 5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel())
+    # The worker keeps running and writes its outputs after the order is gone
+    proceed.set()
+    pool.executor.shutdown(wait=True)
+    assert created and not any(exists(name) for name in created)
@@ -11,5 +11,29 @@ def test_status():
     response = client.get("/api/status")
     print("res:",response.json())
     assert response.status_code == 200
-    assert response.json() == {"message": "Hello, World!"}
+    body = response.json()
+    assert body["message"] in ("ai-api-server is connected to webui", "ai-api-server is NOT connected to webui")
+    assert body["data"]["webui_status"] == (body["message"] == "ai-api-server is connected to webui")
 
+
+def test_health_turns_ready_after_startup(monkeypatch):
+    import setup
+    from webui_pool import webui_pool
+    monkeypatch.setattr(setup.startup_state, "ready", False)
+    response = client.get("/api/health")
+    assert response.status_code == 503
+    assert response.json()["message"] == "ai-api-server is starting"
+
+    # Only WEBUI_URLS is set in the tests, the pool is reported as on /api/status
+    monkeypatch.setattr(setup.startup_state, "ready", True)
+    response = client.get("/api/health")
+    assert response.status_code == 200
+    assert response.json()["data"]["webui_url"] == ",".join(backend.url for backend in webui_pool.backends)
+
+def test_health_reports_a_failed_startup(monkeypatch):
+    import setup
+    monkeypatch.setattr(setup.startup_state, "ready", False)
+    monkeypatch.setattr(setup.startup_state, "error", "RuntimeError: no model")
+    response = client.get("/api/health")
+    assert response.status_code == 503
+    assert response.json()["message"] == "ai-api-server failed to start"
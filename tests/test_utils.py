@@ -0,0 +1,95 @@
+import asyncio
+import base64
+import io
+import httpx
+import pytest
+from PIL import Image
+import utils
+
+
+def image(color) -> Image.Image:
+    return Image.new("RGB", (32, 24), color)
+
+
+def decode(img_str: str) -> Image.Image:
+    return Image.open(io.BytesIO(base64.b64decode(img_str)))
+
+
+def test_equal_content_is_encoded_once(monkeypatch):
+    utils._encode_cache.clear()
+    calls = []
+    encode = utils.encodeImg2Base64
+    monkeypatch.setattr(utils, "encodeImg2Base64", lambda img, fmt="png": calls.append(fmt) or encode(img, fmt))
+
+    first = utils.encodeImgCached(image("red"), "png")
+    assert utils.encodeImgCached(image("red"), "png") == first
+    assert calls == ["png"]
+
+    utils.encodeImgCached(image("red"), "webp")
+    utils.encodeImgCached(image("blue"), "png")
+    assert calls == ["png", "webp", "png"]
+
+
+def test_cache_is_bounded(monkeypatch):
+    utils._encode_cache.clear()
+    monkeypatch.setattr(utils, "ENCODE_CACHE_SIZE", 2)
+    images = [image((i, 0, 0)) for i in range(3)]
+    for img in images:
+        utils.encodeImgCached(img, "png")
+    assert list(utils._encode_cache) == [(utils.imageDigest(img), "png") for img in images[1:]]
+
+
+def test_digest_is_forgotten_with_the_image():
+    img = image("green")
+    utils.imageDigest(img)
+    key = id(img)
+    assert key in utils._digest_by_id
+    del img
+    assert key not in utils._digest_by_id
+
+
+def test_wire_formats():
+    img = image((10, 200, 30))
+    assert decode(utils.encodeImg2Base64(img, "png")).format == "PNG"
+
+    webp = decode(utils.encodeImg2Base64(img, "webp"))
+    assert webp.format == "WEBP"
+    # Lossless, the pixels survive the round trip
+    assert webp.convert("RGB").tobytes() == img.tobytes()
+
+    jpeg = decode(utils.encodeImg2Base64(img.convert("RGBA"), "jpeg"))
+    assert jpeg.format == "JPEG" and jpeg.mode == "RGB"
+
+
+def stream_t2i(monkeypatch, status_code: int, body: dict, expected=None):
+    client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(status_code, json=body)))
+    monkeypatch.setattr(utils, "getHttpClient", lambda name: client)
+    items = []
+
+    async def on_item(idx, item):
+        items.append(item)
+
+    async def post():
+        async with client:
+            return await utils.requestPostAsyncStream("http://webui/sdapi/v1/txt2img", {}, on_item=on_item, expected=expected)
+
+    return asyncio.run(post()), items
+
+
+def test_streamed_images_are_counted(monkeypatch):
+    images = [base64.b64encode(b"one").decode(), base64.b64encode(b"two").decode()]
+    (succ, count), items = stream_t2i(monkeypatch, 200, {"images": images}, expected=2)
+    assert (succ, count, items) == (True, 2, [b"one", b"two"])
+
+
+@pytest.mark.parametrize("body, expected", [({"images": []}, None), ({"detail": "done"}, None),
+                                            ({"images": [base64.b64encode(b"one").decode()]}, 3)])
+def test_responses_missing_images_fail(monkeypatch, body, expected):
+    (succ, detail), _ = stream_t2i(monkeypatch, 200, body, expected=expected)
+    # Counted against the backend, like a 5xx
+    assert not succ and isinstance(detail, utils.ServerError)
+
+
+def test_error_responses_are_decoded(monkeypatch):
+    (succ, detail), _ = stream_t2i(monkeypatch, 422, {"detail": "Invalid"})
+    assert (succ, detail) == (False, {"detail": "Invalid"})
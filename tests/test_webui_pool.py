@@ -0,0 +1,63 @@
+import httpx
+import utils
+from config import WEBUI_EJECT_FAILURES
+from webui_pool import WebUIPool
+
+
+def pool() -> WebUIPool:
+    return WebUIPool(["http://webui-a:7860", "http://webui-b:7860/"])
+
+
+def test_least_loaded_backend_is_picked():
+    webui = pool()
+    a, b = webui.backends
+    assert b.url == "http://webui-b:7860"
+    a.outstanding, b.queue_depth = 1, 2
+    assert webui.pick() is a
+
+
+def test_backend_failures_eject_after_the_threshold():
+    webui = pool()
+    a, b = webui.backends
+    failures = [httpx.ConnectTimeout("timed out"), httpx.ConnectError("refused"), utils.ServerError(502, "Bad Gateway")]
+    for i in range(WEBUI_EJECT_FAILURES):
+        assert a.healthy
+        webui.report(a, False, failures[i % len(failures)])
+    assert not a.healthy
+    a.outstanding, b.outstanding = 0, 5
+    assert webui.pick() is b
+
+
+def test_rejected_requests_do_not_count():
+    webui = pool()
+    a, _ = webui.backends
+    for _ in range(WEBUI_EJECT_FAILURES * 2):
+        webui.report(a, False, "Invalid_Gender")
+        webui.report(a, False, {"detail": "No face found"})
+    assert a.healthy and a.failures == 0
+
+
+def test_success_resets_the_consecutive_failures():
+    webui = pool()
+    a, _ = webui.backends
+    for _ in range(WEBUI_EJECT_FAILURES - 1):
+        webui.report(a, False)
+    webui.report(a, True)
+    webui.report(a, False)
+    assert a.healthy and a.failures == 1
+
+
+def test_all_ejected_falls_back_to_the_least_failing():
+    webui = pool()
+    a, b = webui.backends
+    for _ in range(WEBUI_EJECT_FAILURES + 1):
+        webui.report(a, False)
+    for _ in range(WEBUI_EJECT_FAILURES):
+        webui.report(b, False)
+    assert webui.pick() is b
+
+
+def test_only_5xx_responses_are_server_errors():
+    error = utils._error_detail(502, b"<html>Bad Gateway</html>")
+    assert isinstance(error, utils.ServerError) and error.status_code == 502
+    assert utils._error_detail(422, b'{"detail": "Invalid"}') == {"detail": "Invalid"}